@@ -0,0 +1,40 @@
+"""
+Helpers shared by the benchmark scripts. Each script prints its results as
+one JSON object per line, see :py:func:`fpesa.bench.summarize`.
+"""
+import json
+import time
+
+from fpesa.bench import summarize
+
+
+def measure(benchmark, params, func, number):
+    """
+    Call ``func()`` ``number`` times and print the latencies.
+    """
+    latencies = []
+    start = time.perf_counter()
+    for i in range(number):
+        t = time.perf_counter()
+        func()
+        latencies.append(time.perf_counter() - t)
+    duration = time.perf_counter() - start
+    print(json.dumps(summarize(benchmark, params, latencies, duration)))
+
+
+def measure_async(loop, benchmark, params, coroutine_function, number):
+    """
+    Like :py:func:`measure` for coroutine functions, the calls run one
+    after the other in ``loop``.
+    """
+    async def run():
+        latencies = []
+        start = time.perf_counter()
+        for i in range(number):
+            t = time.perf_counter()
+            await coroutine_function()
+            latencies.append(time.perf_counter() - t)
+        return latencies, time.perf_counter() - start
+
+    latencies, duration = loop.run_until_complete(run())
+    print(json.dumps(summarize(benchmark, params, latencies, duration)))
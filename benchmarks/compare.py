@@ -0,0 +1,73 @@
+"""
+Compare the results of two benchmark runs, e.g. of two versions of fpesa::
+
+    python benchmarks/json_handling.py > old.ndjson
+    ...
+    python benchmarks/compare.py old.ndjson new.ndjson --threshold 0.1
+
+Results with the same ``benchmark`` and ``params`` are compared. A
+throughput (``per_second``) that dropped or a latency (``mean`` and the
+percentiles) that grew by more than ``threshold`` is a regression, the
+exit status is 1 if there is any.
+"""
+import sys
+import json
+import argparse
+
+HIGHER_IS_BETTER = ('per_second',)
+LOWER_IS_BETTER = ('mean', 'p50', 'p90', 'p99', 'p99.9')
+
+
+def load(path):
+    results = {}
+    with open(path) as fo:
+        for line in fo:
+            if line.strip():
+                result = json.loads(line)
+                key = json.dumps(
+                    [result['benchmark'], result.get('params')],
+                    sort_keys=True)
+                results[key] = result
+    return results
+
+
+def compare(old, new, threshold):
+    """
+    :returns: lines describing the changes and the number of regressions
+    """
+    lines = []
+    regressions = 0
+    for key in sorted(old.keys() & new.keys()):
+        for name in HIGHER_IS_BETTER + LOWER_IS_BETTER:
+            before, after = old[key].get(name), new[key].get(name)
+            if not before or after is None:
+                continue
+            change = after / before - 1
+            if name in HIGHER_IS_BETTER:
+                regression = change < -threshold
+            else:
+                regression = change > threshold
+            regressions += regression
+            lines.append('{} {} {}: {:.6g} -> {:.6g} ({:+.1%})'.format(
+                'REGRESSION' if regression else 'ok        ',
+                key, name, before, after, change))
+    return lines, regressions
+
+
+def main(args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('old')
+    parser.add_argument('new')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='relative change that is a regression')
+    options = parser.parse_args(args)
+
+    lines, regressions = compare(
+        load(options.old), load(options.new), options.threshold)
+    for line in lines:
+        print(line)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
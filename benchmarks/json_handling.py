@@ -0,0 +1,64 @@
+"""
+Cost of the JSON handling of a message on its way through fpesa::
+
+    python benchmarks/json_handling.py --number 10000 --sizes 100,1000,10000
+
+* ``envelope`` encoding the envelope in the restmapper
+* ``decode_message`` :py:func:`fpesa.liveupdate.decode_message`
+* ``frame`` encoding a :py:class:`fpesa.liveupdate.Frame` for websockets
+  with and without ids and compression
+* ``dump_line`` a line of an archive segment, see
+  :py:func:`fpesa.archive.dump_line`
+"""
+import sys
+import json
+import argparse
+import datetime
+
+from fpesa import tracing
+from fpesa.archive import dump_line
+from fpesa.liveupdate import decode_message, Frame, DEFAULT_OPTIONS
+
+from common import measure
+
+
+def main(args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--number', type=int, default=10000)
+    parser.add_argument('--sizes', default='100,1000,10000',
+                        help='approximate sizes of a message in bytes')
+    options = parser.parse_args(args)
+
+    inserted = datetime.datetime.now()
+    for size in [int(s) for s in options.sizes.split(',')]:
+        message = {'id': 17, 'device': 'x17', 'text': 'x' * size}
+        body = json.dumps({
+            'data': message, 'args': None,
+            'trace': tracing.start('restmapper')}).encode()
+        payload = json.dumps(message)
+
+        def envelope():
+            json.dumps({
+                'data': message, 'args': None,
+                'trace': tracing.start('restmapper')}).encode('utf-8')
+
+        def frame(ids, compress):
+            Frame([(1, payload)]).get(
+                DEFAULT_OPTIONS._replace(ids=ids, compress=compress))
+
+        params = {'size': size}
+        measure('json_envelope', params, envelope, options.number)
+        measure('json_decode_message', params,
+                lambda: decode_message(body), options.number)
+        for ids in (False, True):
+            for compress in (False, True):
+                measure(
+                    'json_frame',
+                    dict(params, ids=ids, compress=compress),
+                    lambda: frame(ids, compress), options.number)
+        measure('json_dump_line', params,
+                lambda: dump_line(1, inserted, message), options.number)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
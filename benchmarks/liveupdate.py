@@ -0,0 +1,90 @@
+"""
+Messages per second through the liveupdate pipeline for several numbers of
+connected clients::
+
+    python benchmarks/liveupdate.py --messages 10000 --clients 1,10,100,1000
+
+The message bus is replaced by a list of message bodies and the websockets by
+objects that only count the frames they receive, so the numbers show the cost
+of :py:func:`fpesa.liveupdate.decode_message` and the fanout itself. Each
+result is printed as one JSON object per line, ``per_second`` are the
+messages per second.
+"""
+import sys
+import json
+import time
+import asyncio
+import argparse
+
+import fpesa
+from fpesa import liveupdate
+
+
+class CountingWebsocket():
+    def __init__(self):
+        self.frames = 0
+
+    async def send(self, frame):
+        self.frames += 1
+
+
+async def run(loop, bodies, clients, options):
+    websockets_ = [CountingWebsocket() for i in range(clients)]
+    if options.batch:
+        target = liveupdate.batch_connections
+    else:
+        target = liveupdate.connections
+    for websocket in websockets_:
+        liveupdate.connection_options[websocket] = options
+    target[:] = websockets_
+
+    pending = asyncio.Queue(maxsize=100)
+    broadcaster = loop.create_task(liveupdate.broadcast_messages(pending))
+    start = time.perf_counter()
+    for body in bodies:
+        payload, trace = liveupdate.decode_message(body)
+        await pending.put((None, payload, trace))
+    await pending.join()
+    await liveupdate.flush_batch()
+    duration = time.perf_counter() - start
+    broadcaster.cancel()
+
+    del target[:]
+    liveupdate.connection_options.clear()
+    return {
+        'benchmark': 'liveupdate',
+        'version': fpesa.__version__,
+        'params': {
+            'clients': clients,
+            'options': dict(options._asdict()),
+            'messages': len(bodies),
+        },
+        'frames': sum(w.frames for w in websockets_),
+        'duration': duration,
+        'per_second': len(bodies) / duration,
+    }
+
+
+def main(args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=10000)
+    parser.add_argument('--clients', default='1,10,100,1000')
+    parser.add_argument('--size', type=int, default=200,
+                        help='approximate size of a message in bytes')
+    options = parser.parse_args(args)
+
+    bodies = [
+        json.dumps({'data': {'i': i, 'text': 'x' * options.size}}).encode()
+        for i in range(options.messages)]
+    loop = asyncio.get_event_loop()
+    for clients in [int(c) for c in options.clients.split(',')]:
+        for batch in (False, True):
+            connection_options = liveupdate.DEFAULT_OPTIONS._replace(
+                batch=batch)
+            result = loop.run_until_complete(
+                run(loop, bodies, clients, connection_options))
+            print(json.dumps(result))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
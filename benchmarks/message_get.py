@@ -0,0 +1,70 @@
+"""
+Latency of :py:func:`fpesa.message.message_get` against the database of the
+:ref:`config`::
+
+    python benchmarks/message_get.py --fill 100000 --number 100
+
+``--fill`` first inserts messages until the table holds that many, so run it
+against a database made for benchmarking. The requests are answered one
+after the other, like by a ``messages_get`` worker without ``--concurrency``.
+"""
+import sys
+import argparse
+
+from sqlalchemy import func
+
+from fpesa.config import get_config
+from fpesa.postgres import Session, Message
+from fpesa.message import message_get
+
+from common import measure
+
+
+def fill(count, size, batch_size=10000):
+    session = Session()
+    try:
+        missing = count - session.query(func.count(Message.id)).scalar()
+        while missing > 0:
+            n = min(missing, batch_size)
+            session.bulk_save_objects([
+                Message({'device': 'x{}'.format(i % 100), 'text': 'x' * size})
+                for i in range(n)])
+            session.commit()
+            missing -= n
+    finally:
+        session.close()
+
+
+def main(args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--number', type=int, default=100)
+    parser.add_argument('--fill', type=int, default=0,
+                        help='make sure the table holds this many messages')
+    parser.add_argument('--size', type=int, default=200,
+                        help='approximate size of a message in bytes')
+    parser.add_argument('--offsets', default='0,1000,100000')
+    options = parser.parse_args(args)
+
+    if options.fill:
+        fill(options.fill, options.size)
+    pagination_id = message_get({'offset': '0', 'limit': '1'})['paginationId']
+    requests = []
+    for offset in options.offsets.split(','):
+        requests.append({'offset': offset, 'limit': '10'})
+    requests.extend([
+        {'offset': '0', 'limit': '100'},
+        {'offset': '0', 'limit': '10', 'fields': 'device'},
+    ])
+    if get_config()['postgres'].getboolean('contains'):
+        requests.append(
+            {'offset': '0', 'limit': '10', 'contains': '{"device": "x17"}'})
+    for params in requests:
+        # the same page for every call, no matter what is inserted meanwhile
+        request_arguments = dict(params, paginationId=str(pagination_id))
+        measure(
+            'message_get', params,
+            lambda: message_get(dict(request_arguments)), options.number)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
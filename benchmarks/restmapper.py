@@ -0,0 +1,77 @@
+"""
+Requests per second through :py:meth:`fpesa.restmapper.Endpoint.
+request_handler` with the endpoints of :py:mod:`fpesa.restapp`::
+
+    python benchmarks/restmapper.py --number 10000
+
+The adapters are replaced by one that answers ``{}`` right away, so the
+numbers show the cost of parsing and validating the request and encoding the
+response.
+"""
+import sys
+import json
+import asyncio
+import argparse
+
+from multidict import MultiDict
+
+from fpesa.config import get_config
+from fpesa.restapp import get_endpoints
+from fpesa.restmapper import Adapter
+
+from common import measure_async
+
+
+class NullAdapter(Adapter):
+    async def init(self, endpoint):
+        self.endpoint = endpoint
+
+    async def adapt(self, request_data, request_args):
+        return {}
+
+
+class Request():
+    # just what Endpoint.request_handler uses of aiohttp.web.Request
+    def __init__(self, body=None, query=None):
+        self.body = body
+        self.has_body = body is not None
+        self.query = MultiDict(query or {})
+
+    async def json(self):
+        return json.loads(self.body)
+
+
+def main(args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--number', type=int, default=10000)
+    parser.add_argument('--size', type=int, default=200,
+                        help='approximate size of a message in bytes')
+    options = parser.parse_args(args)
+
+    # the search endpoint only exists with search enabled, no database is
+    # used here
+    get_config()['postgres']['search'] = 'yes'
+    endpoints = {
+        (endpoint.path, endpoint.method): endpoint
+        for endpoint in get_endpoints()}
+    requests = [
+        ('/messages/', 'POST', Request(body=json.dumps(
+            {'text': 'x' * options.size}))),
+        ('/messages/', 'GET', Request(query={
+            'offset': '0', 'limit': '10', 'paginationId': '12345'})),
+        ('/messages/search', 'GET', Request(query={
+            'q': 'error', 'offset': '0', 'limit': '10'})),
+    ]
+    loop = asyncio.get_event_loop()
+    for path, method, request in requests:
+        endpoint = endpoints[path, method]
+        endpoint.adapter = NullAdapter()
+        loop.run_until_complete(endpoint.adapter.init(endpoint))
+        measure_async(
+            loop, 'restmapper',
+            {'endpoint': '{}:{}'.format(path, method), 'size': options.size},
+            lambda: endpoint.request_handler(request), options.number)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,86 @@
+"""
+Time from starting a python process until a subcommand of ``fpesa`` could
+run, that is importing :py:mod:`fpesa.cli`, building the argument parser and
+importing the module of the subcommand::
+
+    python benchmarks/startup.py --number 20 --details 5
+
+Each start is a new process, so nothing is cached between them. ``cli`` is
+the start without any subcommand. With ``--details`` the slowest imports of
+each subcommand, as reported by ``python -X importtime``, are printed to
+stderr.
+"""
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+from fpesa.bench import summarize
+
+SUBCOMMANDS = {
+    'cli': None,
+    'restmapper': 'fpesa.restapp',
+    'liveupdate': 'fpesa.liveupdate',
+    'messages_post': 'fpesa.message',
+    'messages_get': 'fpesa.message',
+    'retention': 'fpesa.retention',
+    'all-in-one': 'fpesa.allinone',
+    'bench': 'fpesa.bench',
+}
+
+CODE = "import fpesa.cli; fpesa.cli.get_argument_parser()"
+
+
+def get_code(module):
+    if module is None:
+        return CODE
+    return CODE + "; import {}".format(module)
+
+
+def slowest_imports(code, number):
+    """
+    :returns: the ``number`` imports with the largest cumulative time in
+        microseconds, as ``(microseconds, module)``
+    """
+    process = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    imports = []
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        _, cumulative, module = line.split('|')
+        if cumulative.strip().isdigit():
+            imports.append((int(cumulative), module.strip()))
+    return sorted(imports, reverse=True)[:number]
+
+
+def main(args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--number', type=int, default=20)
+    parser.add_argument('--subcommands', default=','.join(SUBCOMMANDS),
+                        help='comma separated')
+    parser.add_argument('--details', type=int, default=0,
+                        help='print this many of the slowest imports')
+    options = parser.parse_args(args)
+
+    for subcommand in options.subcommands.split(','):
+        code = get_code(SUBCOMMANDS[subcommand])
+        latencies = []
+        start = time.perf_counter()
+        for i in range(options.number):
+            t = time.perf_counter()
+            subprocess.run([sys.executable, '-c', code], check=True)
+            latencies.append(time.perf_counter() - t)
+        duration = time.perf_counter() - start
+        print(json.dumps(summarize(
+            'startup', {'subcommand': subcommand}, latencies, duration)))
+        if options.details:
+            for cumulative, module in slowest_imports(code, options.details):
+                sys.stderr.write('{} {:8.1f} ms {}\n'.format(
+                    subcommand, cumulative / 1000, module))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -3,24 +3,48 @@
 fpesa
 #####
 
+.. automodule:: fpesa.allinone
+   :members:
+
+.. automodule:: fpesa.archive
+   :members:
+
+.. automodule:: fpesa.bench
+   :members:
+
 .. automodule:: fpesa.cli
    :members:
 
 .. automodule:: fpesa.config
    :members:
 
+.. automodule:: fpesa.gapindex
+   :members:
+
 .. automodule:: fpesa.helper
    :members:
 
 .. automodule:: fpesa.liveupdate
    :members:
 
+.. automodule:: fpesa.membroker
+   :members:
+
 .. automodule:: fpesa.message
    :members:
 
+.. automodule:: fpesa.metrics
+   :members:
+
 .. automodule:: fpesa.postgres
    :members:
 
+.. automodule:: fpesa.profiling
+   :members:
+
+.. automodule:: fpesa.querylog
+   :members:
+
 .. automodule:: fpesa.rabbitmq
    :members:
 
@@ -29,7 +53,37 @@ fpesa
 
 .. automodule:: fpesa.restmapper
    :members:
+
+.. automodule:: fpesa.retention
+   :members:
+
+.. automodule:: fpesa.tracing
+   :members:
 """
-import pkg_resources
 
-__version__ = pkg_resources.require("fpesa")[0].version
+
+import sys
+import types
+
+
+class _Module(types.ModuleType):
+    # a module subclass instead of a module __getattr__ (PEP 562), that
+    # needs python 3.7
+    def __getattr__(self, name):
+        # scanning the installed distributions takes long, so the version
+        # is only looked up when needed
+        if name == '__version__':
+            try:
+                from importlib.metadata import version
+            except ImportError:  # python < 3.8
+                import pkg_resources
+                __version__ = pkg_resources.require("fpesa")[0].version
+            else:
+                __version__ = version("fpesa")
+            self.__version__ = __version__
+            return __version__
+        raise AttributeError(
+            "module {!r} has no attribute {!r}".format(self.__name__, name))
+
+
+sys.modules[__name__].__class__ = _Module
@@ -0,0 +1,65 @@
+"""
+----------
+all-in-one
+----------
+
+``fpesa all-in-one`` runs restmapper, liveupdate and the workers for
+``messages_post`` and ``messages_get`` in one process and one event loop.
+Instead of RabbitMQ they talk through the in-process broker of
+:py:mod:`fpesa.membroker`, so a message takes no network hop between the
+components. The database is still needed, its queries run in threads.
+
+Meant for small installations and for benchmarking: messages not yet
+inserted are lost if the process ends and the components can not be scaled
+independently.
+"""
+import asyncio
+import logging
+
+from aiohttp import web
+
+from fpesa import liveupdate
+from fpesa import restapp
+from fpesa.config import get_config
+from fpesa.postgres import create_all
+from fpesa.message import consume_messages_post, consume_messages_get
+
+logger = logging.getLogger(__name__)
+
+
+def main(options):
+    get_config()['rabbitmq']['broker'] = 'memory'
+    create_all()
+    loop = asyncio.get_event_loop()
+
+    # restmapper declares and binds the queues of the workers
+    runner = web.AppRunner(restapp.get_app())
+    loop.run_until_complete(runner.setup())
+    loop.run_until_complete(
+        web.TCPSite(runner, options.bind, options.port).start())
+
+    stop = asyncio.Future()
+    server, tasks = liveupdate.start(
+        loop, stop, options.bind, options.liveupdate_port)
+    tasks.append(loop.create_task(consume_messages_post(loop)))
+    tasks.append(loop.create_task(
+        consume_messages_get(loop, options.concurrency, options.debug)))
+    logger.info("restmapper on {}:{}, liveupdate on {}:{}".format(
+        options.bind, options.port, options.bind, options.liveupdate_port))
+    try:
+        # the tasks only end if a component failed
+        done, _ = loop.run_until_complete(
+            asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED))
+        for task in done:
+            task.result()
+    except KeyboardInterrupt:
+        logger.info("shutting down")
+    finally:
+        stop.set_result(None)
+        for task in tasks:
+            task.cancel()
+        loop.run_until_complete(
+            asyncio.gather(*tasks, return_exceptions=True))
+        loop.run_until_complete(server)
+        loop.run_until_complete(runner.cleanup())
+    loop.close()
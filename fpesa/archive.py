@@ -0,0 +1,288 @@
+"""
+-------
+archive
+-------
+
+Messages removed from the database by :py:mod:`fpesa.retention` can be kept
+in segment files. A segment holds the messages of a range of ids as
+newline delimited JSON, each line is ``{"id": <int>, "inserted": <str>,
+"message": <Object>}``. The file is a sequence of gzip members of at most
+:py:data:`BLOCK_SIZE` lines, so it can be read with ``zcat`` and stays
+readable if writing is interrupted.
+
+Next to each segment an index file ``.idx`` holds one :py:data:`RECORD` per
+message: its id and the offset of the gzip member holding it. The index is
+memory mapped and searched with bisect, so a page of messages is found
+without reading the segment and only one or two members are decompressed.
+
+With ``directory`` in the ``[archive]`` section of the :ref:`config`,
+:py:func:`fpesa.message.message_get` reads the pages beyond the oldest
+message in the database from the archive.
+"""
+import os
+import re
+import gzip
+import json
+import mmap
+import struct
+import bisect
+import logging
+from functools import lru_cache
+
+from fpesa.config import get_config
+
+logger = logging.getLogger(__name__)
+
+BLOCK_SIZE = 100
+""" messages per gzip member """
+RECORD = struct.Struct('<qQ')
+""" index record: message id and offset of the gzip member """
+SEGMENT_RE = re.compile(r'^messages-(\d+)-(\d+)\.ndjson\.gz$')
+
+_archive = None
+
+
+def dump_line(message_id, inserted, message):
+    """
+    :param int message_id: id of the message
+    :param datetime.datetime inserted: insertion time
+    :param dict message: the message
+    :rtype: str
+    :returns: json line as used in the segment files
+    """
+    return json.dumps({
+        'id': message_id,
+        'inserted': inserted.isoformat(),
+        'message': message,
+    }) + '\n'
+
+
+class SegmentWriter():
+    """
+    Writes messages into segment files named
+    ``messages-<first id>-<last id>.ndjson.gz`` in ``directory``.
+
+    :param str directory: where to put the segment files
+    :param int segment_size: start a new segment after this many messages
+
+    The messages have to be written in the order of their ids. While a
+    segment is written it is named ``messages-<first id>.ndjson.gz.part``,
+    :py:meth:`close` gives it and its index the final name.
+    """
+    def __init__(self, directory, segment_size):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.fo = None
+        os.makedirs(directory, exist_ok=True)
+
+    def _open(self, first_id):
+        self.first_id = first_id
+        self.count = 0
+        self.path = os.path.join(
+            self.directory, 'messages-{}.ndjson.gz.part'.format(first_id))
+        self.fo = open(self.path, 'ab')
+        self.fo_index = open(self.path[:-len('.ndjson.gz.part')] +
+                             '.idx.part', 'ab')
+
+    def _write_block(self, rows):
+        offset = self.fo.tell()
+        lines = [dump_line(*row) for row in rows]
+        self.fo.write(gzip.compress(''.join(lines).encode()))
+        self.fo_index.write(b''.join(
+            RECORD.pack(message_id, offset) for message_id, _, _ in rows))
+
+    def write(self, rows):
+        """
+        Append messages, they are on disk when this returns.
+
+        :param list rows: tuples of id, insertion time and message
+        """
+        rows = list(rows)
+        while rows:
+            if self.fo is None:
+                self._open(rows[0][0])
+            n = min(self.segment_size - self.count, len(rows))
+            for i in range(0, n, BLOCK_SIZE):
+                self._write_block(rows[i:min(i + BLOCK_SIZE, n)])
+            for fo in (self.fo, self.fo_index):
+                fo.flush()
+                os.fsync(fo.fileno())
+            self.count += n
+            self.last_id = rows[n - 1][0]
+            rows = rows[n:]
+            if self.count >= self.segment_size:
+                self.close()
+
+    def close(self):
+        """
+        finish the current segment
+        """
+        if self.fo is None:
+            return
+        self.fo.close()
+        self.fo_index.close()
+        self.fo = None
+        path = os.path.join(
+            self.directory, 'messages-{}-{}'.format(
+                self.first_id, self.last_id))
+        os.rename(self.fo_index.name, path + '.idx')
+        # the segment is visible to readers when the index is in place
+        os.rename(self.path, path + '.ndjson.gz')
+        logger.info("wrote segment {}.ndjson.gz".format(path))
+
+
+class _IndexColumn():
+    # sequence view on one field of the index records, for bisect
+    def __init__(self, index, field):
+        self.index = index
+        self.field = field
+
+    def __len__(self):
+        return len(self.index) // RECORD.size
+
+    def __getitem__(self, i):
+        return RECORD.unpack_from(self.index, i * RECORD.size)[self.field]
+
+
+class Segment():
+    """
+    read only access to a segment file and its index
+
+    :param str path: path of the segment file
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path[:-len('.ndjson.gz')] + '.idx', 'rb') as fo:
+            self.index = mmap.mmap(fo.fileno(), 0, access=mmap.ACCESS_READ)
+        with open(path, 'rb') as fo:
+            self.data = mmap.mmap(fo.fileno(), 0, access=mmap.ACCESS_READ)
+        self.ids = _IndexColumn(self.index, 0)
+        self.offsets = _IndexColumn(self.index, 1)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def count(self, max_id):
+        """
+        :rtype: int
+        :returns: number of messages with an id up to ``max_id``
+        """
+        return bisect.bisect_right(self.ids, max_id)
+
+    def get(self, position):
+        """
+        :param int position: position of the message in the segment
+        :returns: the message
+        """
+        offset = self.offsets[position]
+        first = bisect.bisect_left(self.offsets, offset, 0, position)
+        return _read_block(self, offset)[position - first]['message']
+
+
+@lru_cache(maxsize=16)
+def _read_block(segment, offset):
+    # a page usually needs one or two blocks
+    end = bisect.bisect_right(segment.offsets, offset)
+    if end < len(segment):
+        end = segment.offsets[end]
+    else:
+        end = len(segment.data)
+    data = gzip.decompress(segment.data[offset:end])
+    return [json.loads(line) for line in data.decode().splitlines()]
+
+
+class Archive():
+    """
+    all segments in ``directory``, ordered by id. New segments are picked
+    up by :py:meth:`refresh`.
+
+    :param str directory: where the segment files are
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.names = None
+        # segments and the position of their first message in the archive
+        self.segments = ([], [0])
+
+    def refresh(self):
+        """
+        open new segments
+        """
+        try:
+            names = sorted(
+                name for name in os.listdir(self.directory)
+                if SEGMENT_RE.match(name))
+        except FileNotFoundError:
+            return
+        if names == self.names:
+            return
+        self.names = names
+        known = {segment.path: segment for segment in self.segments[0]}
+        segments = []
+        for name in names:
+            match = SEGMENT_RE.match(name)
+            path = os.path.join(self.directory, name)
+            segment = known.get(path)
+            if segment is None:
+                segment = Segment(path)
+            segments.append((int(match.group(1)), segment))
+        segments.sort(key=lambda item: item[0])
+        starts = [0]
+        for _, segment in segments:
+            starts.append(starts[-1] + len(segment))
+        # replaced at once, other threads may be reading
+        self.segments = ([segment for _, segment in segments], starts)
+
+    def __len__(self):
+        return self.segments[1][-1]
+
+    @property
+    def max_id(self):
+        """ largest archived id or ``None`` """
+        segments = self.segments[0]
+        return segments[-1].ids[-1] if segments else None
+
+    def count(self, max_id):
+        """
+        :rtype: int
+        :returns: number of archived messages with an id up to ``max_id``
+        """
+        segments, starts = self.segments
+        for i in reversed(range(len(segments))):
+            n = segments[i].count(max_id)
+            if n:
+                return starts[i] + n
+        return 0
+
+    def newest(self, max_id, offset, limit):
+        """
+        :param int max_id: largest id to return
+        :param int offset: how many messages to skip
+        :param int limit: how many messages to return
+        :rtype: list
+        :returns: archived messages with an id up to ``max_id``, newest
+            first
+        """
+        segments, starts = self.segments
+        end = self.count(max_id) - offset
+        messages = []
+        for position in range(end - 1, max(end - limit, 0) - 1, -1):
+            i = bisect.bisect_right(starts, position) - 1
+            messages.append(segments[i].get(position - starts[i]))
+        return messages
+
+
+def get_archive():
+    """
+    :returns: the archive configured in the :ref:`config` with all known
+        segments or ``None``
+    :rtype: Archive
+    """
+    global _archive
+    directory = get_config()['archive']['directory']
+    if not directory:
+        return None
+    if _archive is None or _archive.directory != directory:
+        _archive = Archive(directory)
+    _archive.refresh()
+    return _archive
@@ -0,0 +1,271 @@
+"""
+-----
+bench
+-----
+
+Load generator for a running fpesa stack, started with ``fpesa bench``.
+
+The load is open-loop: requests are started at a fixed rate, no matter how
+long the previous ones take. The latency of a request is measured from the
+time it was due, so a stack that falls behind shows up in the percentiles
+instead of silently lowering the rate. Requests that would exceed
+``--max-in-flight`` are counted as ``dropped``.
+
+The stages reported are
+
+* ``post`` latency of ``POST /messages/``
+* ``get`` latency of ``GET /messages/``
+* ``delivered`` time from sending a message with ``POST /messages/`` until a
+  websocket connected to liveupdate received it, measured with the clock of
+  the host running the benchmark
+
+Each stage is printed as one JSON object per line, see :py:func:`summarize`.
+The scripts in ``benchmarks/`` use the same format, two runs can be compared
+with ``python benchmarks/compare.py``.
+"""
+import sys
+import json
+import time
+import uuid
+import zlib
+import asyncio
+import logging
+
+import aiohttp
+import websockets
+
+import fpesa
+
+logger = logging.getLogger(__name__)
+
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+def percentile(values, p):
+    """
+    :param list values: sorted values
+    :param float p: percentile between 0 and 100
+    :returns: the smallest value that is at least as large as ``p`` percent
+        of the values (nearest rank), ``None`` if there are no values
+    """
+    if not values:
+        return None
+    rank = max(1, int(-(-len(values) * p // 100)))
+    return values[rank - 1]
+
+
+def summarize(benchmark, params, latencies, duration, errors=0, dropped=0):
+    """
+    :param str benchmark: name of the benchmark
+    :param dict params: what was measured, results with the same benchmark
+        and params are compared by ``benchmarks/compare.py``
+    :param list latencies: seconds per request
+    :param float duration: seconds the benchmark ran
+    :param int errors: failed requests
+    :param int dropped: requests that were not started
+    :rtype: dict
+    :returns: the result as it is printed. ``per_second`` is the throughput,
+        ``mean``, ``max`` and ``p<percentile>`` the latencies in seconds.
+    """
+    latencies = sorted(latencies)
+    result = {
+        'benchmark': benchmark,
+        'version': fpesa.__version__,
+        'params': params,
+        'count': len(latencies),
+        'errors': errors,
+        'dropped': dropped,
+        'duration': duration,
+        'per_second': len(latencies) / duration if duration else None,
+        'mean': sum(latencies) / len(latencies) if latencies else None,
+        'max': latencies[-1] if latencies else None,
+    }
+    for p in PERCENTILES:
+        result['p{:g}'.format(p)] = percentile(latencies, p)
+    return result
+
+
+class Stage():
+    """
+    latencies and failures of one stage
+
+    :param str name: name of the stage
+    """
+    def __init__(self, name):
+        self.name = name
+        self.latencies = []
+        self.errors = 0
+        self.dropped = 0
+
+
+async def _timed(request, due, stage):
+    loop = asyncio.get_event_loop()
+    try:
+        await request()
+    except Exception as e:
+        stage.errors += 1
+        logger.debug("{} failed: {!r}".format(stage.name, e))
+    else:
+        stage.latencies.append(loop.time() - due)
+
+
+async def open_loop(request, rate, duration, stage, max_in_flight=1000):
+    """
+    Start ``request()`` ``rate`` times per second for ``duration`` seconds
+    and wait for the started requests.
+
+    :param callable request: returns an awaitable
+    :param float rate: requests per second
+    :param float duration: seconds
+    :param Stage stage: collects the results
+    :param int max_in_flight: requests running at the same time
+    """
+    loop = asyncio.get_event_loop()
+    start = loop.time()
+    in_flight = set()
+    for i in range(int(rate * duration)):
+        due = start + i / rate
+        delay = due - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if len(in_flight) >= max_in_flight:
+            stage.dropped += 1
+            continue
+        task = asyncio.ensure_future(_timed(request, due, stage))
+        in_flight.add(task)
+        task.add_done_callback(in_flight.discard)
+    if in_flight:
+        await asyncio.wait(in_flight)
+
+
+def decode_frame(frame):
+    """
+    :param frame: frame received from liveupdate, with any of the options
+        of :py:func:`fpesa.liveupdate.parse_options`
+    :rtype: list
+    :returns: the messages in the frame
+    """
+    if isinstance(frame, bytes):
+        try:
+            frame = frame.decode()
+        except UnicodeDecodeError:
+            frame = zlib.decompress(frame, -zlib.MAX_WBITS).decode()
+    messages = json.loads(frame)
+    if not isinstance(messages, list):
+        messages = [messages]
+    return [
+        message['data'] if 'data' in message and 'id' in message
+        else message
+        for message in messages]
+
+
+async def receive(url, run_id, stage, connected):
+    """
+    Receive messages from liveupdate and record the delivery latency of the
+    messages of this run.
+
+    :param str url: websocket url of liveupdate
+    :param str run_id: only messages with ``"bench": run_id`` are recorded
+    :param Stage stage: collects the results
+    :param asyncio.Future connected: result is set once connected
+    """
+    async with websockets.connect(url) as websocket:
+        connected.set_result(None)
+        async for frame in websocket:
+            now = time.time()
+            for message in decode_frame(frame):
+                if isinstance(message, dict) and \
+                        message.get('bench') == run_id:
+                    stage.latencies.append(now - message['sent'])
+
+
+async def run(options):
+    """
+    Run the workloads configured by ``options``, see ``fpesa bench
+    --help``.
+
+    :rtype: list(dict)
+    :returns: one result per stage, see :py:func:`summarize`
+    """
+    run_id = uuid.uuid4().hex
+    url = options.url.rstrip('/') + '/messages/'
+    padding = 'x' * options.size
+    stages = []
+    workloads = []
+    receivers = []
+    async with aiohttp.ClientSession() as session:
+
+        async def request(method, **kwargs):
+            async with session.request(method, url, **kwargs) as response:
+                await response.read()
+                if response.status != 200:
+                    raise RuntimeError(
+                        "status {}".format(response.status))
+
+        def post():
+            return request('POST', json={
+                'bench': run_id, 'sent': time.time(), 'padding': padding})
+
+        def get():
+            return request('GET', params={
+                'offset': '0', 'limit': str(options.limit)})
+
+        if options.websockets:
+            delivered = Stage('delivered')
+            stages.append((delivered, options.post_rate))
+            for i in range(options.websockets):
+                connected = asyncio.Future()
+                receivers.append(asyncio.ensure_future(receive(
+                    options.ws_url, run_id, delivered, connected)))
+                await asyncio.wait(
+                    [connected, receivers[-1]],
+                    return_when=asyncio.FIRST_COMPLETED)
+                if receivers[-1].done():
+                    receivers[-1].result()  # raises why it failed
+        for name, rate, request_ in (
+                ('post', options.post_rate, post),
+                ('get', options.get_rate, get)):
+            if rate:
+                stage = Stage(name)
+                stages.append((stage, rate))
+                workloads.append(open_loop(
+                    request_, rate, options.duration, stage,
+                    options.max_in_flight))
+
+        start = time.monotonic()
+        await asyncio.gather(*workloads)
+        duration = time.monotonic() - start
+        if receivers:
+            # messages may still be on their way
+            await asyncio.sleep(options.drain)
+            for receiver in receivers:
+                receiver.cancel()
+            await asyncio.wait(receivers)
+
+    results = []
+    for stage, rate in stages:
+        params = {
+            'stage': stage.name,
+            'rate': rate,
+            'size': options.size,
+        }
+        if stage.name == 'get':
+            params['limit'] = options.limit
+        if stage.name == 'delivered':
+            params['websockets'] = options.websockets
+            params['query'] = options.ws_url.partition('?')[2]
+        results.append(summarize(
+            'bench', params, stage.latencies, duration,
+            errors=stage.errors, dropped=stage.dropped))
+    return results
+
+
+def main(options):
+    loop = asyncio.get_event_loop()
+    results = loop.run_until_complete(run(options))
+    lines = [json.dumps(result) for result in results]
+    if options.output:
+        with open(options.output, 'a') as fo:
+            fo.writelines(line + '\n' for line in lines)
+    for line in lines:
+        sys.stdout.write(line + '\n')
@@ -37,8 +37,27 @@ def f_messages_post(options):
 
 
 def f_messages_get(options):
-    from fpesa.message import messages_get_worker
-    messages_get_worker(options)
+    if options.concurrency > 1:
+        from fpesa.message import messages_get_worker_async
+        messages_get_worker_async(options)
+    else:
+        from fpesa.message import messages_get_worker
+        messages_get_worker(options)
+
+
+def f_retention(options):
+    from fpesa.retention import main
+    main(options)
+
+
+def f_all_in_one(options):
+    from fpesa.allinone import main
+    main(options)
+
+
+def f_bench(options):
+    from fpesa.bench import main
+    main(options)
 
 
 def get_argument_parser():
@@ -50,6 +69,21 @@ def get_argument_parser():
     parser.add_argument(
         '-q', help='more quiet',
         dest='loglevel', const=+10, action='append_const')
+    parser.add_argument(
+        '--metrics-port', help='serve metrics on this port, see '
+        '[metrics] in the config', dest='metrics_port', type=int)
+    parser.add_argument(
+        '--profile', help='profile with cProfile, write the statistics to '
+        'this file on exit')
+    parser.add_argument(
+        '--profile-samples', help='sample the stacks of all threads, write '
+        'them to this file', dest='profile_samples')
+    parser.add_argument(
+        '--profile-interval', help='seconds between writing the samples',
+        dest='profile_interval', default=10, type=float)
+    parser.add_argument(
+        '--slow-callback', help='log callbacks blocking the event loop '
+        'longer than this many seconds', dest='slow_callback', type=float)
 
     parser.set_defaults(func=lambda options: parser.print_help())
 
@@ -84,8 +118,90 @@ def get_argument_parser():
     p_messages_get.add_argument(
         '--debug', help='response with stacktraces on error',
         action='store_true')
+    p_messages_get.add_argument(
+        '--concurrency', help='number of requests processed at the same time',
+        default=1, type=int)
     p_messages_get.set_defaults(func=f_messages_get)
 
+    p_retention = subparsers.add_parser(
+        'retention', help='remove old messages from the database, options '
+        'not given are taken from the config')
+    p_retention.add_argument(
+        '--max-age', help='remove messages older than this many days',
+        dest='max_age', type=float)
+    p_retention.add_argument(
+        '--max-rows', help='keep at most this many messages',
+        dest='max_rows', type=int)
+    p_retention.add_argument(
+        '--batch-size', help='messages removed in one transaction',
+        dest='batch_size', type=int)
+    p_retention.add_argument(
+        '--sleep', help='seconds to sleep between the transactions',
+        type=float)
+    p_retention.add_argument(
+        '--export', help='write removed messages to segment files in this '
+        'directory', dest='export_directory')
+    p_retention.set_defaults(func=f_retention)
+
+    p_all_in_one = subparsers.add_parser(
+        'all-in-one', help='run restmapper, liveupdate and the workers in '
+        'one process, without rabbitmq')
+    p_all_in_one.add_argument(
+        '--bind', help='bind address',
+        default="127.0.0.1")
+    p_all_in_one.add_argument(
+        '--port', help='port of restmapper',
+        default=8081, type=int)
+    p_all_in_one.add_argument(
+        '--liveupdate-port', help='port of liveupdate',
+        dest='liveupdate_port', default=8082, type=int)
+    p_all_in_one.add_argument(
+        '--debug', help='response with stacktraces on error',
+        action='store_true')
+    p_all_in_one.add_argument(
+        '--concurrency', help='number of get requests processed at the same '
+        'time', default=4, type=int)
+    p_all_in_one.set_defaults(func=f_all_in_one)
+
+    p_bench = subparsers.add_parser(
+        'bench', help='put load on a running fpesa and report the '
+        'latencies as json')
+    p_bench.add_argument(
+        '--url', help='url of restmapper',
+        default='http://127.0.0.1:8081')
+    p_bench.add_argument(
+        '--ws-url', help='websocket url of liveupdate, with options',
+        dest='ws_url', default='ws://127.0.0.1:8082/')
+    p_bench.add_argument(
+        '--duration', help='seconds to put load on fpesa',
+        default=10, type=float)
+    p_bench.add_argument(
+        '--post-rate', help='messages posted per second',
+        dest='post_rate', default=100, type=float)
+    p_bench.add_argument(
+        '--get-rate', help='GET /messages/ requests per second',
+        dest='get_rate', default=0, type=float)
+    p_bench.add_argument(
+        '--limit', help='limit of the GET requests',
+        default=10, type=int)
+    p_bench.add_argument(
+        '--websockets', help='websockets receiving the posted messages',
+        default=0, type=int)
+    p_bench.add_argument(
+        '--size', help='approximate size of a message in bytes',
+        default=200, type=int)
+    p_bench.add_argument(
+        '--max-in-flight', help='requests per workload running at the '
+        'same time, further requests are dropped',
+        dest='max_in_flight', default=1000, type=int)
+    p_bench.add_argument(
+        '--drain', help='seconds to wait for messages on the websockets '
+        'after the load stopped',
+        default=2, type=float)
+    p_bench.add_argument(
+        '--output', help='append the results to this file')
+    p_bench.set_defaults(func=f_bench)
+
     return parser
 
 
@@ -106,6 +222,26 @@ def main(args=None):
         level=max(10, min(50, sum(options.loglevel))),
         format="%(asctime)s %(levelname)s :: %(name)s :: %(message)s",
     )
-    logging.info("starting fpesa version {}".format(fpesa.__version__))
-
-    options.func(options)
+    if logging.getLogger().isEnabledFor(logging.INFO):
+        # looking up the version takes a while
+        logging.info("starting fpesa version {}".format(fpesa.__version__))
+
+    from fpesa.config import get_config
+    config_metrics = get_config()['metrics']
+    metrics_port = options.metrics_port
+    if metrics_port is None:
+        metrics_port = config_metrics.getint('port')
+    if metrics_port:
+        from fpesa.metrics import start_server
+        start_server(metrics_port, config_metrics['bind'])
+
+    if options.profile or options.profile_samples or options.slow_callback:
+        from fpesa.profiling import start
+        stop_profiling = start(options)
+    else:
+        stop_profiling = None
+    try:
+        options.func(options)
+    finally:
+        if stop_profiling is not None:
+            stop_profiling()
@@ -14,20 +14,50 @@ command line utility to change any of the following values
 
 """
 import os
+import sys
+import types
 import configparser
 import logging
 
-config = configparser.ConfigParser()
-"""
-:py:class:`configparser.ConfigParser` object that holds the config
-"""
+logger = logging.getLogger(__name__)
+
+_config = None
+
+
+def get_config():
+    """
+    Read the config files on first use, later calls return the same object.
+    The module attribute ``config`` is the same, so the files are also read
+    by the first ``from fpesa.config import config``. The fpesa modules call
+    this function when they need a value, so importing them reads no files.
+
+    :rtype: configparser.ConfigParser
+    """
+    global _config
+    if _config is None:
+        config = configparser.ConfigParser()
+        with open(os.path.join(
+                os.path.dirname(__file__), 'default.cfg')) as fo:
+            config.read_file(fo)
+
+        additional_config = config.read(["fpesa.cfg"])
+        if additional_config:
+            logger.info("read additional configs: {}".format(
+                [os.path.abspath(p) for p in additional_config]))
+        else:
+            logger.info("no additional configs found")
+        _config = config
+    return _config
+
+
+class _Module(types.ModuleType):
+    # reads the config on the first access of the module attribute config
+    def __getattr__(self, name):
+        if name == 'config':
+            self.config = config = get_config()
+            return config
+        raise AttributeError(
+            "module {!r} has no attribute {!r}".format(self.__name__, name))
 
-with open(os.path.join(os.path.dirname(__file__), 'default.cfg')) as fo:
-    config.read_file(fo)
 
-additional_config = config.read(["fpesa.cfg"])
-if additional_config:
-    logging.info("read additional configs: {}".format(
-        [os.path.abspath(p) for p in additional_config]))
-else:
-    logging.info("no additional configs found")
+sys.modules[__name__].__class__ = _Module
@@ -0,0 +1,235 @@
+"""
+--------
+gapindex
+--------
+
+The ids of the messages come from a sequence. They are contiguous except
+for the ids of rolled back inserts. :py:class:`GapIndex` keeps these holes
+in memory, so :py:func:`fpesa.message.message_get` can translate
+``paginationId`` and ``offset`` into an id and the total number of messages
+is known without counting them.
+
+Ids are only added to the index once they are settled: no transaction that
+got one of them from the sequence may still commit. This is assumed to be
+true ``settle_time`` seconds after the id was the largest id in the table,
+so ``settle_time`` has to be longer than inserting a message takes and than
+a replica lags behind. The few messages newer than the settled ids are
+counted by the database.
+
+The index is filled by a thread in the background, requests never wait for
+a scan. There is one index per database, so a page read from a replica is
+only located with the holes as seen by that replica.
+"""
+import time
+import bisect
+import logging
+import threading
+from array import array
+from collections import deque
+
+from sqlalchemy import text, func
+
+from fpesa import querylog
+from fpesa.config import get_config
+from fpesa.postgres import Message, Session
+
+logger = logging.getLogger(__name__)
+
+_gap_indexes = {}
+_gap_indexes_lock = threading.Lock()
+
+
+class GapIndex():
+    """
+    Holes in the ids of the table ``message`` up to the settled id
+    ``watermark``.
+
+    :param float settle_time: seconds until an id is settled
+    :param int scan_size: maximum range of ids scanned for holes at once
+    :param float refresh_interval: seconds between two refreshes by the
+        thread started with :py:meth:`start`
+    """
+    def __init__(self, settle_time=60, scan_size=1000000, refresh_interval=1):
+        self.settle_time = settle_time
+        self.scan_size = scan_size
+        self.refresh_interval = refresh_interval
+        self.settled = None
+        self.marks = deque()
+        self.stopped = threading.Event()
+        self.thread = None
+        # watermark, first and last id of each hole and the number of ids
+        # in holes before each hole. replaced at once as other threads may
+        # be reading
+        self.state = (None, array('q'), array('q'), array('q', [0]))
+
+    def add(self, holes, watermark):
+        """
+        Extend the index.
+
+        :param list holes: first and last id of each hole above the current
+            watermark, ordered
+        :param int watermark: all ids up to this id are known now
+        """
+        _, starts, ends, counts = self.state
+        starts, ends, counts = array('q', starts), array('q', ends), \
+            array('q', counts)
+        for first, last in holes:
+            if ends and first == ends[-1] + 1:
+                # continues the last hole, e.g. beyond an empty scan
+                ends[-1] = last
+                counts[-1] += last - first + 1
+                continue
+            starts.append(first)
+            ends.append(last)
+            counts.append(counts[-1] + last - first + 1)
+        self.state = (watermark, starts, ends, counts)
+
+    def _rank(self, starts, counts, message_id):
+        # position of a message among all messages, with gaps removed
+        return message_id - counts[bisect.bisect_right(starts, message_id)]
+
+    def _message_id(self, starts, counts, rank):
+        # inverse of _rank, the hole i starts after the message with the
+        # rank starts[i] - counts[i] - 1
+        lo, hi = 0, len(starts)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if starts[mid] - counts[mid] <= rank:
+                lo = mid + 1
+            else:
+                hi = mid
+        return rank + counts[lo]
+
+    def locate(self, session, min_id, pagination_id, offset):
+        """
+        Translate an offset into an id.
+
+        :param sqlalchemy.orm.session.Session session: database session
+        :param int min_id: id of the oldest message
+        :param int pagination_id: see :py:func:`fpesa.message.message_get`
+        :param int offset: how many messages to skip
+        :rtype: tuple
+        :returns: ``None`` if the index is empty, else the number of
+            messages up to ``pagination_id``, the largest id and the offset
+            of the page. The id is ``None`` if the offset is beyond the
+            oldest message.
+        """
+        watermark, starts, ends, counts = self.state
+        if watermark is None or min_id is None:
+            return None
+        recent = 0
+        top = min(pagination_id, watermark)
+        if pagination_id > watermark:
+            recent = session.query(func.count(Message.id))\
+                .filter(Message.id > watermark, Message.id <= pagination_id)\
+                .scalar()
+        else:
+            i = bisect.bisect_right(starts, top) - 1
+            if i >= 0 and top <= ends[i]:
+                top = starts[i] - 1  # the message before the hole
+        if top < min_id:
+            return recent, (pagination_id if recent else None), offset
+        top_rank = self._rank(starts, counts, top)
+        min_rank = self._rank(starts, counts, min_id)
+        total = recent + top_rank - min_rank + 1
+        if offset < recent:
+            return total, pagination_id, offset
+        rank = top_rank - (offset - recent)
+        if rank < min_rank:
+            return total, None, 0
+        return total, self._message_id(starts, counts, rank), 0
+
+    def refresh(self, session):
+        """
+        Add the holes of newly settled ids.
+
+        :param sqlalchemy.orm.session.Session session: database session
+        """
+        now = time.monotonic()
+        self.marks.append((now, session.query(func.max(Message.id)).scalar()))
+        while self.marks and self.marks[0][0] <= now - self.settle_time:
+            self.settled = self.marks.popleft()[1]
+        watermark = self.state[0]
+        if self.settled is None:
+            return
+        if watermark is None:
+            watermark = session.query(func.min(Message.id)).scalar()
+            if watermark is None:
+                return
+        if watermark >= self.settled:
+            return
+        self._scan(session, watermark, min(
+            self.settled, watermark + self.scan_size))
+
+    def run(self, engine):
+        while True:
+            session = Session(bind=engine)
+            try:
+                with querylog.track('gapindex_refresh'):
+                    self.refresh(session)
+            except Exception:
+                logger.exception('refreshing the gap index failed')
+            finally:
+                session.close()
+            if self.stopped.wait(self.refresh_interval):
+                return
+
+    def start(self, engine):
+        """
+        Refresh the index every ``refresh_interval`` seconds in a thread.
+
+        :param sqlalchemy.engine.Engine engine: database of the index
+        """
+        self.thread = threading.Thread(
+            target=self.run, args=(engine,), name='gapindex', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def _scan(self, session, first, last):
+        # the ids up to first are in the index, the ids up to last are
+        # settled
+        holes = session.execute(text(
+            "SELECT prev + 1, id - 1 FROM ("
+            "SELECT id, coalesce(lag(id) OVER (ORDER BY id), :first) AS prev "
+            "FROM message WHERE id > :first AND id <= :last) AS ids "
+            "WHERE id > prev + 1"), {'first': first, 'last': last}).fetchall()
+        holes = [tuple(hole) for hole in holes]
+        watermark = session.query(func.max(Message.id))\
+            .filter(Message.id > first, Message.id <= last)\
+            .scalar()
+        if watermark is None:
+            # no message in the window, e.g. removed by the retention
+            holes.append((first + 1, last))
+            watermark = last
+        self.add(holes, watermark)
+        logger.debug("gap index up to {}, {} holes".format(
+            watermark, len(self.state[1])))
+
+
+def get_gap_index(session):
+    """
+    :param sqlalchemy.orm.session.Session session: the index of the database
+        this session is bound to is returned, it is created and refreshed in
+        the background on first use
+    :returns: the index or ``None`` if disabled in the :ref:`config`
+    :rtype: GapIndex
+    """
+    config_gapindex = get_config()['gapindex']
+    if not config_gapindex.getboolean('enabled'):
+        return None
+    engine = session.get_bind()
+    with _gap_indexes_lock:
+        gap_index = _gap_indexes.get(engine)
+        if gap_index is None:
+            gap_index = _gap_indexes[engine] = GapIndex(
+                settle_time=config_gapindex.getfloat('settle_time'),
+                scan_size=config_gapindex.getint('scan_size'),
+                refresh_interval=config_gapindex.getfloat(
+                    'refresh_interval'),
+            )
+            gap_index.start(engine)
+    return gap_index
@@ -4,21 +4,69 @@ helper
 ------
 
 """
+import psycopg2
 from sqlalchemy import create_engine
 
-from fpesa.config import config
+from fpesa.config import get_config
+from fpesa import querylog
 
 
-def get_engine():
+def get_engine(section='postgres'):
     """
     returns a engine as defined in the :ref:`config`.
 
+    :param str section: config section, values missing in this section are
+        taken from the section ``postgres``
     :rtype: :py:class:`sqlalchemy.engine.Engine`
+
+    The statements are timed, see :py:mod:`fpesa.querylog`.
     """
+    config = get_config()
     config_postgres = config['postgres']
-    return create_engine('postgresql://{}:{}@{}/{}'.format(
-        config_postgres['user'],
-        config_postgres['password'],
-        config_postgres['host'],
-        config_postgres['database'],
-    ))
+
+    def get(key):
+        return config.get(section, key, fallback=config_postgres[key])
+
+    engine = create_engine(
+        'postgresql://{}:{}@{}/{}'.format(
+            get('user'),
+            get('password'),
+            get('host'),
+            get('database'),
+        ),
+        pool_size=int(get('pool_size')),
+        max_overflow=int(get('max_overflow')),
+    )
+    querylog.instrument(engine)
+    return engine
+
+
+def get_replica_engines():
+    """
+    returns a engine for each replica defined in the :ref:`config`, that is
+    each section named ``postgres_replica`` or starting with
+    ``postgres_replica:``.
+
+    :rtype: list(sqlalchemy.engine.Engine)
+    """
+    return [
+        get_engine(section) for section in get_config().sections()
+        if section == 'postgres_replica'
+        or section.startswith('postgres_replica:')
+    ]
+
+
+def get_connection():
+    """
+    returns a plain connection as defined in the :ref:`config`. Used when
+    the engine does not fit, e.g. for ``LISTEN``.
+
+    :rtype: :py:class:`psycopg2.extensions.connection`
+    """
+    config_postgres = get_config()['postgres']
+    return psycopg2.connect(
+        user=config_postgres['user'],
+        password=config_postgres['password'],
+        host=config_postgres['host'],
+        dbname=config_postgres['database'],
+    )
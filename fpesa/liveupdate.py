@@ -8,16 +8,39 @@ messages.
 
 """
 import json
+import time
+import zlib
 import asyncio
 import logging
+import itertools
+from collections import namedtuple, deque
+from urllib.parse import urlparse, parse_qs
 
 import websockets
 from websockets.exceptions import ConnectionClosed
 import aio_pika
 
 from fpesa import rabbitmq
+from fpesa import metrics
+from fpesa import tracing
+from fpesa.config import get_config
 
 logger = logging.getLogger(__name__)
+
+CONNECTIONS = metrics.Gauge(
+    'fpesa_websocket_connections', 'open websocket connections', ['batch'])
+MESSAGES = metrics.Counter(
+    'fpesa_liveupdate_messages_total', 'messages sent to the websockets')
+BROADCAST_DURATION = metrics.Histogram(
+    'fpesa_broadcast_duration_seconds',
+    'time to send one frame to all websockets', ['batch'])
+BATCH_SIZE = metrics.Histogram(
+    'fpesa_liveupdate_batch_size', 'messages per batch frame',
+    buckets=metrics.SIZE_BUCKETS)
+
+LEGACY_QUEUE = 'liveupdate'
+""" durable queue shared by the liveupdate processes of older versions """
+
 connections = []
 """
 Hold all open websocket connections. Please note that those connections are not
@@ -25,6 +48,262 @@ garanteed to be open. The connections are checked every 10 seconds, but a
 timeout may occure in between the checks.
 """
 
+batch_connections = []
+"""
+Like :py:data:`connections` but holds the connections that requested batching.
+See :py:func:`parse_options`.
+"""
+
+connection_options = {}
+"""
+Maps the websockets of :py:data:`connections` and
+:py:data:`batch_connections` to their :py:class:`ConnectionOptions`
+"""
+
+_batch = []
+# (id, json encoded message) waiting for the next call of flush_batch
+
+_ids = itertools.count(int(time.time() * 1000000))
+# ids of messages received from the bus. seeded with the current time so a
+# restarted liveupdate hands out larger ids than the instance before.
+
+ConnectionOptions = namedtuple(
+    'ConnectionOptions', ['batch', 'compress', 'ids', 'last_seen_id'])
+DEFAULT_OPTIONS = ConnectionOptions(
+    batch=False, compress=False, ids=False, last_seen_id=None)
+
+
+def parse_options(path):
+    """
+    Parse the options a client requested via the query string of the
+    websocket URI.
+
+    :param str path: request URI, e.g. ``/?batch=1``
+    :rtype: ConnectionOptions
+
+    * ``batch=1`` the messages are not sent one by one, instead all messages
+      that arrived within ``batch_interval`` seconds (see :ref:`config`) are
+      sent as one text frame containing a JSON array.
+    * ``compress=1`` frames of at least ``compress_threshold`` bytes are sent
+      as binary frames holding the raw deflate (:rfc:`1951`) compressed JSON,
+      smaller frames are sent as text frames. See :py:class:`Frame`.
+    * ``ids=1`` each message is wrapped into ``{"id": <int>, "data":
+      <message>}``.
+    * ``lastSeenId=<int>`` implies ``ids=1``. The messages that arrived after
+      the message with this id are replayed from the
+      :py:data:`replay_buffer` before any new message is sent. If the
+      messages are no longer available ``{"resync": true}`` is sent instead,
+      the client has to fetch the missed messages via ``GET /messages/``.
+    """
+    query = parse_qs(urlparse(path).query)
+    last_seen_id = query.get('lastSeenId', [None])[-1]
+    if last_seen_id is not None:
+        try:
+            last_seen_id = int(last_seen_id)
+        except ValueError:
+            last_seen_id = None
+    return ConnectionOptions(
+        batch=query.get('batch', ['0'])[-1] == '1',
+        compress=query.get('compress', ['0'])[-1] == '1',
+        ids=query.get('ids', ['0'])[-1] == '1' or last_seen_id is not None,
+        last_seen_id=last_seen_id,
+    )
+
+
+class Frame():
+    """
+    A frame that is sent to many websockets. Each variant of the frame is
+    encoded only once, no matter how many websockets receive it.
+
+    :param list messages: ``(id, json encoded message)`` tuples
+    :param bool batch: send all messages as one JSON array, otherwise
+        ``messages`` has to hold exactly one message.
+
+    Single messages are sent as binary frames unless compression was
+    requested, batches as text frames. The compressed variant is a raw
+    deflate stream without context takeover, it does not depend on any
+    previous frame, so the same bytes can be shared by all websockets.
+    """
+    def __init__(self, messages, batch=False):
+        self.messages = messages
+        self.batch = batch
+        self._variants = {}
+
+    def text(self, ids=False):
+        """
+        :param bool ids: wrap each message with its id
+        :returns: JSON encoded content of the frame
+        """
+        # the messages are already json encoded, so there is no need to
+        # decode and encode them again.
+        if ids:
+            parts = [
+                '{{"id": {}, "data": {}}}'.format(message_id, payload)
+                for message_id, payload in self.messages]
+        else:
+            parts = [payload for message_id, payload in self.messages]
+        if self.batch:
+            return '[' + ','.join(parts) + ']'
+        return parts[0]
+
+    def get(self, options=DEFAULT_OPTIONS):
+        """
+        :param ConnectionOptions options: options of the receiving websocket
+        :returns: ``bytes`` for binary frames and ``str`` for text frames
+        """
+        key = (options.ids, options.compress)
+        try:
+            return self._variants[key]
+        except KeyError:
+            pass
+        config_liveupdate = get_config()['liveupdate']
+        text = self.text(options.ids)
+        data = text.encode()
+        if options.compress and \
+                len(data) >= config_liveupdate.getint('compress_threshold'):
+            compressor = zlib.compressobj(
+                config_liveupdate.getint('compress_level'),
+                zlib.DEFLATED, -zlib.MAX_WBITS)
+            frame = compressor.compress(data) + compressor.flush()
+        elif not self.batch and not options.compress:
+            frame = data
+        else:
+            frame = text
+        self._variants[key] = frame
+        return frame
+
+
+class ReplayBuffer():
+    """
+    Holds the most recent messages, so reconnecting clients can catch up
+    without querying the database.
+
+    :param int size: maximum number of messages
+    """
+    def __init__(self, size):
+        self.messages = deque(maxlen=size)
+
+    def resize(self, size):
+        """
+        :param int size: new maximum number of messages
+        """
+        self.messages = deque(self.messages, maxlen=size)
+
+    def append(self, message_id, payload):
+        """
+        :param int message_id: id of the message
+        :param str payload: json encoded message
+        """
+        self.messages.append((message_id, payload))
+
+    def since(self, last_seen_id):
+        """
+        :param int last_seen_id: id of the last message the client received
+        :rtype: list
+        :returns: ``(id, json encoded message)`` of all messages that arrived
+            after the message ``last_seen_id`` or ``None`` if this message is
+            no longer in the buffer.
+
+        The messages are kept in the order they arrived, which may differ
+        from the order of their ids when the ids come from the database.
+        """
+        # searching from the newest message is cheap, as reconnecting
+        # clients usually only missed a few messages
+        result = []
+        for message in reversed(self.messages):
+            if message[0] == last_seen_id:
+                result.reverse()
+                return result
+            result.append(message)
+        return None
+
+
+replay_buffer = ReplayBuffer(1000)
+"""
+:py:class:`ReplayBuffer` holding the recent messages, the size is set with
+``replay_buffer_size`` in the :ref:`config`.
+"""
+
+
+async def send_to_all(websockets_, frame):
+    """
+    Send ``frame`` to all websockets, websockets that turn out to be closed
+    or fail otherwise are removed from ``websockets_``.
+
+    :param list websockets_: :py:data:`connections` or
+        :py:data:`batch_connections`
+    :param Frame frame: frame to send
+    """
+    for websocket in list(websockets_):
+        options = connection_options.get(websocket, DEFAULT_OPTIONS)
+        try:
+            await websocket.send(frame.get(options))
+        except ConnectionClosed:
+            if websocket in websockets_:
+                websockets_.remove(websocket)
+            # don't wait until ping finds this dead connection
+            logger.info('connection {} already closed'.format(websocket))
+        except Exception:
+            # one broken connection must not keep the others from their
+            # messages. closing it makes the client reconnect
+            logger.exception('sending to {} failed'.format(websocket))
+            if websocket in websockets_:
+                websockets_.remove(websocket)
+            asyncio.ensure_future(websocket.close())
+
+
+async def replay(websocket, options):
+    """
+    Send the messages newer than ``options.last_seen_id`` from the
+    :py:data:`replay_buffer`, or ``{"resync": true}`` if they are gone.
+
+    :param websockets.server.WebSocketServerProtocol websocket: Websocket
+        connection
+    :param ConnectionOptions options: options of the websocket
+    """
+    last_seen_id = options.last_seen_id
+    # messages may arrive while sending, keep going until nothing is left
+    # so the connection can be registered without missing a message.
+    while True:
+        messages = replay_buffer.since(last_seen_id)
+        if messages is None:
+            logger.info('can not replay since {}'.format(last_seen_id))
+            await websocket.send('{"resync": true}')
+            return
+        if not messages:
+            return
+        if options.batch:
+            await websocket.send(Frame(messages, batch=True).get(options))
+        else:
+            for message in messages:
+                await websocket.send(Frame([message]).get(options))
+        last_seen_id = messages[-1][0]
+
+
+async def flush_batch():
+    """
+    Send all messages collected since the last call as one JSON array to all
+    :py:data:`batch_connections`.
+    """
+    if not _batch:
+        return
+    BATCH_SIZE.observe(len(_batch))
+    frame = Frame(list(_batch), batch=True)
+    del _batch[:]
+    with BROADCAST_DURATION.labels('yes').time():
+        await send_to_all(batch_connections, frame)
+
+
+async def flush_batches(interval):
+    """
+    Calls :py:func:`flush_batch` every ``interval`` seconds.
+
+    :param float interval: seconds
+    """
+    while True:
+        await asyncio.sleep(interval)
+        await flush_batch()
+
 
 async def liveupdate(websocket, path):
     """
@@ -43,7 +322,17 @@ async def liveupdate(websocket, path):
     to all open connections
     """
     logger.info('open websocket connection {}'.format(websocket))
-    connections.append(websocket)
+    options = parse_options(path)
+    if options.last_seen_id is not None:
+        await replay(websocket, options)
+    if options.batch:
+        websockets_ = batch_connections
+    else:
+        websockets_ = connections
+    connection_options[websocket] = options
+    websockets_.append(websocket)
+    connection_count = CONNECTIONS.labels('yes' if options.batch else 'no')
+    connection_count.inc()
     try:
         while True:
             # just make sure we don't loose the connection
@@ -53,62 +342,283 @@ async def liveupdate(websocket, path):
             await asyncio.sleep(10)  # TODO: how long?
     finally:
         logger.info('closing websocket connection {}'.format(websocket))
-        if websocket in connections:
-            connections.remove(websocket)
+        connection_count.dec()
+        if websocket in websockets_:
+            websockets_.remove(websocket)
+        connection_options.pop(websocket, None)
+
+
+def _queue_arguments():
+    config_liveupdate = get_config()['liveupdate']
+    arguments = {}
+    max_length = config_liveupdate.getint('queue_max_length')
+    if max_length:
+        # a stalled liveupdate drops the oldest messages
+        arguments['x-max-length'] = max_length
+        arguments['x-overflow'] = 'drop-head'
+    message_ttl = config_liveupdate.getint('queue_message_ttl')
+    if message_ttl:
+        arguments['x-message-ttl'] = message_ttl
+    return arguments
+
+
+def decode_message(body):
+    """
+    :param bytes body: body of a message from the ``/messages/:POST``
+        exchange
+    :rtype: tuple
+    :returns: the json encoded message as sent to the websockets and its
+        trace, see :py:mod:`fpesa.tracing`
+    """
+    envelope = json.loads(body.decode())
+    trace = tracing.stage(envelope.get('trace'), 'liveupdate')
+    return json.dumps(envelope['data']), trace
+
+
+async def broadcast(message_id, payload, trace=None):
+    """
+    Send one message to all connected websockets and remember it in the
+    :py:data:`replay_buffer`.
+
+    :param int message_id: database id of the message, ``None`` if unknown
+    :param str payload: json encoded message
+    :param dict trace: trace of the message, see :py:mod:`fpesa.tracing`
+    """
+    if message_id is None:
+        message_id = next(_ids)
+    replay_buffer.append(message_id, payload)
+    MESSAGES.inc()
+    with BROADCAST_DURATION.labels('no').time():
+        await send_to_all(connections, Frame([(message_id, payload)]))
+    tracing.stage(trace, 'delivered', last=True)
+    if batch_connections:
+        _batch.append((message_id, payload))
+
+
+async def broadcast_messages(pending):
+    """
+    Calls :py:func:`broadcast` for each message put into ``pending``.
+
+    :param asyncio.Queue pending: ``(id, json encoded message, trace)``
+    """
+    while True:
+        message_id, payload, trace = await pending.get()
+        try:
+            await broadcast(message_id, payload, trace)
+        except Exception:
+            logger.exception('broadcasting message {} failed'.format(
+                message_id))
+        finally:
+            pending.task_done()
+
+
+def start_broadcaster(loop, pending):
+    """
+    Run :py:func:`broadcast_messages` as task. If the task fails anyway, the
+    failure is logged and a new task is started, otherwise the consumer
+    would wait forever once ``pending`` is full.
+
+    :param asyncio.AbstractEventLoop loop: event loop
+    :param asyncio.Queue pending: see :py:func:`broadcast_messages`
+    :rtype: asyncio.Future
+    :returns: cancel it to stop broadcasting
+    """
+    stopped = loop.create_future()
+
+    def done(task):
+        if task.cancelled() or stopped.done():
+            return
+        logger.error(
+            'broadcaster failed, restarting it', exc_info=task.exception())
+        start()
+
+    def start():
+        task = loop.create_task(broadcast_messages(pending))
+        task.add_done_callback(done)
+        stopped.add_done_callback(lambda stopped: task.cancel())
+
+    start()
+    return stopped
+
+
+async def _delete_legacy_queue(connection):
+    # before each process had its own queue they shared the durable queue
+    # liveupdate. It stays bound to the exchange and keeps every message once
+    # no process consumes it anymore.
+    channel = await connection.channel()
+    try:
+        await channel.queue_delete(LEGACY_QUEUE, if_unused=True)
+    except aio_pika.exceptions.ChannelClosed as e:
+        # closes the channel
+        logger.warning('queue {} is still in use: {}'.format(LEGACY_QUEUE, e))
+    else:
+        await channel.close()
 
 
-async def consume_messages_from_bus(loop):
+async def consume_messages_from_bus(loop, ready=None):
     """
     Opens a connection to the RabbitMQ message bus, waits for messages and
     publishes them to all connected websockets.
 
     :param asyncio.AbstractEventLoop loop: event loop
+    :param asyncio.Event ready: set once the queue is bound, messages
+        published before are not received
+
+    Each liveupdate process consumes from its own exclusive queue, so every
+    instance receives all messages. The queue is deleted when liveupdate
+    disconnects, its length and the age of the messages are limited by
+    ``queue_max_length`` and ``queue_message_ttl`` (see :ref:`config`). The
+    queue :py:data:`LEGACY_QUEUE` shared by older versions is deleted once
+    no process consumes from it.
+
+    Decoding and sending to the websockets is pipelined: while a message is
+    sent by :py:func:`broadcast_messages` the next ``pipeline_size`` messages
+    are already received and decoded. A message is acknowledged once it is
+    in this pipeline and ``prefetch_count`` limits the unacknowledged ones,
+    so a slow liveupdate leaves the other messages in its queue, where
+    ``queue_max_length`` drops the oldest.
     """
+    config_liveupdate = get_config()['liveupdate']
     connection = await rabbitmq.get_aio_connection(loop)
     async with connection:
+        await _delete_legacy_queue(connection)
         channel = await connection.channel()
+        # 0 would mean no limit
+        await channel.set_qos(prefetch_count=max(
+            1, config_liveupdate.getint('prefetch_count')))
         exchange = await channel.declare_exchange(
             '/messages/:POST', type=aio_pika.exchange.ExchangeType.FANOUT)
-        queue = await channel.declare_queue('liveupdate', durable=True)
+        queue = await channel.declare_queue(
+            exclusive=True, auto_delete=True, arguments=_queue_arguments())
         await queue.bind(exchange)
         logger.info('waiting for messages...')
+        if ready is not None:
+            ready.set()
 
-        async with queue.iterator() as message_iterator:
-            async for message in message_iterator:
-                with message.process():
-                    logger.info(
+        pending = asyncio.Queue(
+            maxsize=max(1, config_liveupdate.getint('pipeline_size')))
+        broadcaster = start_broadcaster(loop, pending)
+        try:
+            async with queue.iterator() as message_iterator:
+                async for message in message_iterator:
+                    logger.debug(
                         "message with delivery_tag={}".format(
                             message.delivery_tag))
-                    for websocket in connections:
-                        try:
-                            await websocket.send(
-                                    json.dumps(
-                                        json.loads(
-                                            message.body.decode()
-                                        )['data']
-                                    ).encode()
-                                )
-                        except ConnectionClosed:
-                            connections.remove(websocket)
-                            # don't wait until ping finds this dead connection
-                            logger.info(
-                                'connection {} already closed'
-                                .format(websocket))
+                    with message.process():
+                        payload, trace = decode_message(message.body)
+                        await pending.put((None, payload, trace))
+        finally:
+            broadcaster.cancel()
+
+
+def _notified_messages(notified, fetched):
+    # messages deleted before they were fetched, e.g. by the retention, are
+    # skipped
+    for notification in notified:
+        message_id = notification['id']
+        if 'message' in notification:
+            message = notification['message']
+        elif message_id in fetched:
+            message = fetched[message_id]
+        else:
+            logger.debug('notified message {} is gone'.format(message_id))
+            continue
+        trace = tracing.stage(notification.get('trace'), 'liveupdate')
+        yield message_id, json.dumps(message), trace
+
+
+async def consume_messages_from_postgres(loop):
+    """
+    Listens on the postgres channel ``notify_channel`` and publishes the
+    messages to all connected websockets. Other than
+    :py:func:`consume_messages_from_bus` only messages that were committed
+    to the database are published and they carry their database id.
+
+    :param asyncio.AbstractEventLoop loop: event loop
+
+    The notifications are sent by :py:func:`fpesa.message.message_post`
+    when ``notify`` is enabled in the :ref:`config`. Messages that are too
+    large for the notification only carry their id, they are fetched with
+    one query for all notifications that are waiting.
+    """
+    # imported here, liveupdate does not need a database otherwise
+    from fpesa.helper import get_connection
+    from fpesa.message import message_fetch
+
+    connection = get_connection()
+    connection.autocommit = True
+    with connection.cursor() as cursor:
+        cursor.execute('LISTEN "{}"'.format(
+            get_config()['postgres']['notify_channel']))
+    notifications = asyncio.Queue()
+
+    def on_readable():
+        connection.poll()
+        while connection.notifies:
+            notifications.put_nowait(connection.notifies.pop(0).payload)
+
+    loop.add_reader(connection.fileno(), on_readable)
+    logger.info('waiting for notifications...')
+
+    pending = asyncio.Queue(
+        maxsize=max(1, get_config()['liveupdate'].getint('pipeline_size')))
+    broadcaster = start_broadcaster(loop, pending)
+    try:
+        while True:
+            notified = [json.loads(await notifications.get())]
+            while not notifications.empty():
+                notified.append(json.loads(notifications.get_nowait()))
+            missing = [n['id'] for n in notified if 'message' not in n]
+            fetched = {}
+            if missing:
+                fetched = await loop.run_in_executor(
+                    None, message_fetch, missing)
+            for item in _notified_messages(notified, fetched):
+                await pending.put(item)
+    finally:
+        loop.remove_reader(connection.fileno())
+        broadcaster.cancel()
+        connection.close()
 
 
 async def websocket_server(stop, bind, port):
     # wraps liveupdate in a stoppable server
-    async with websockets.serve(liveupdate, bind, port):
+    kwargs = {}
+    if not get_config()['liveupdate'].getboolean('permessage_deflate'):
+        # compressing every frame again for each connection is expensive,
+        # see Frame for the shared alternative.
+        kwargs['compression'] = None
+    async with websockets.serve(liveupdate, bind, port, **kwargs):
         await stop
 
 
+def start(loop, stop, bind, port):
+    """
+    Start the websocket server and the tasks feeding it.
+
+    :param asyncio.AbstractEventLoop loop: event loop
+    :param asyncio.Future stop: the server stops when this is done
+    :param str bind: bind address
+    :param int port: port to listen on
+    :returns: the task of the server and a list of the other tasks, they
+        run until they are cancelled
+    """
+    config_liveupdate = get_config()['liveupdate']
+    replay_buffer.resize(config_liveupdate.getint('replay_buffer_size'))
+    server = loop.create_task(websocket_server(stop, bind, port))
+    if config_liveupdate['source'] == 'postgres':
+        consume = loop.create_task(consume_messages_from_postgres(loop))
+    else:
+        consume = loop.create_task(consume_messages_from_bus(loop))
+    flush = loop.create_task(
+        flush_batches(config_liveupdate.getfloat('batch_interval')))
+    return server, [consume, flush]
+
+
 def main(options):
     loop = asyncio.get_event_loop()
-
     stop = asyncio.Future()
-    server = loop.create_task(
-        websocket_server(stop, options.bind, options.port))
-    consume = loop.create_task(consume_messages_from_bus(loop))
+    server, tasks = start(loop, stop, options.bind, options.port)
     try:
         loop.run_forever()
     except KeyboardInterrupt:
@@ -116,10 +626,11 @@ def main(options):
     finally:
         from concurrent.futures import CancelledError
         stop.set_result(None)
-        consume.cancel()
-        try:
-            loop.run_until_complete(consume)
-        except CancelledError:
-            pass
+        for task in tasks:
+            task.cancel()
+            try:
+                loop.run_until_complete(task)
+            except CancelledError:
+                pass
         loop.run_until_complete(server)
     loop.close()
@@ -0,0 +1,409 @@
+"""
+---------
+membroker
+---------
+
+An in-process replacement for RabbitMQ, for ``fpesa all-in-one`` and for
+tests. It implements the part of the :py:mod:`aio_pika` api used by
+:py:mod:`fpesa.restmapper`, :py:mod:`fpesa.liveupdate` and the async
+workers in :py:mod:`fpesa.message`: channels with ``prefetch_count``, fanout
+and direct exchanges, named, exclusive and auto delete queues with
+``x-max-length``, ``x-overflow: drop-head`` and ``x-message-ttl``, consuming
+with acknowledgements and :py:meth:`IncomingMessage.process`.
+
+With ``broker: memory`` in the ``[rabbitmq]`` section of the :ref:`config`
+:py:func:`fpesa.rabbitmq.get_aio_connection` returns a connection to the
+:py:func:`get_broker` of the process. The bodies are handed over as they are,
+there is no network and no serialization between the components. Only
+components in the same process reach each other and messages waiting in a
+queue are lost when the process ends, even if the queue is ``durable``.
+"""
+import uuid
+import asyncio
+import logging
+import itertools
+from collections import deque
+from contextlib import contextmanager
+
+from aio_pika.exchange import ExchangeType
+
+logger = logging.getLogger(__name__)
+
+_broker = None
+
+
+def _done():
+    # a future that is already done, so methods like Channel.set_qos can be
+    # awaited as with aio_pika or called without
+    future = asyncio.Future()
+    future.set_result(None)
+    return future
+
+
+class Broker():
+    """
+    exchanges and queues shared by all connections
+    """
+    def __init__(self):
+        self.exchanges = {}
+        self.queues = {}
+        self.delivery_tags = itertools.count(1)
+
+    async def connect(self):
+        """
+        :rtype: Connection
+        """
+        return Connection(self)
+
+
+class Connection():
+    """
+    like :py:class:`aio_pika.Connection`, closing it closes its channels
+    """
+    def __init__(self, broker):
+        self.broker = broker
+        self.channels = []
+        self.is_closed = False
+
+    async def channel(self):
+        """
+        :rtype: Channel
+        """
+        channel = Channel(self)
+        self.channels.append(channel)
+        return channel
+
+    async def close(self):
+        for channel in list(self.channels):
+            await channel.close()
+        self.is_closed = True
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+
+class Channel():
+    """
+    like :py:class:`aio_pika.Channel`, exclusive and auto delete queues
+    declared on the channel are deleted when it is closed.
+    """
+    def __init__(self, connection):
+        self.connection = connection
+        self.broker = connection.broker
+        self.prefetch_count = 0
+        self.closing = asyncio.Future()
+        self.is_closed = False
+        self._temporary = []
+        self._consumers = []
+
+    def set_qos(self, prefetch_count=0):
+        """
+        :param int prefetch_count: unacknowledged messages per consumer, 0
+            means no limit
+        """
+        self.prefetch_count = prefetch_count
+        return _done()
+
+    async def declare_exchange(self, name, type=ExchangeType.FANOUT, **kwds):
+        """
+        :rtype: Exchange
+        """
+        type = ExchangeType(type)
+        exchange = self.broker.exchanges.get(name)
+        if exchange is None:
+            exchange = self.broker.exchanges[name] = Exchange(name, type)
+        elif exchange.type != type:
+            raise ValueError("exchange {} is of type {}".format(
+                name, exchange.type.value))
+        return exchange
+
+    async def declare_queue(
+            self, name=None, durable=False, exclusive=False,
+            auto_delete=False, arguments=None, **kwds):
+        """
+        :param str name: name of the queue, generated if not given
+        :rtype: Queue
+        """
+        if name is None:
+            name = 'amq.gen-' + uuid.uuid4().hex
+        state = self.broker.queues.get(name)
+        if state is None:
+            state = self.broker.queues[name] = _QueueState(
+                name, arguments or {})
+            if exclusive or auto_delete:
+                self._temporary.append(state)
+        return Queue(self, state)
+
+    async def queue_delete(self, queue_name, **kwds):
+        """
+        delete the queue, nothing happens if there is none
+        """
+        state = self.broker.queues.pop(queue_name, None)
+        if state is not None:
+            for exchange in self.broker.exchanges.values():
+                exchange.unbind(state)
+            state.close()
+
+    async def close(self):
+        if self.is_closed:
+            return
+        self.is_closed = True
+        for consumer in self._consumers:
+            await consumer.close()
+            # like rabbitmq, unacknowledged messages are delivered again,
+            # in their original order
+            for message in sorted(
+                    consumer.unacked, key=lambda message: message.delivery_tag,
+                    reverse=True):
+                message.reject(requeue=True)
+        for state in self._temporary:
+            self.broker.queues.pop(state.name, None)
+            for exchange in self.broker.exchanges.values():
+                exchange.unbind(state)
+            state.close()
+        self.connection.channels.remove(self)
+        self.closing.set_result(None)
+
+
+class Exchange():
+    """
+    like :py:class:`aio_pika.Exchange`
+
+    :param str name: name of the exchange
+    :param aio_pika.exchange.ExchangeType type: ``fanout`` or ``direct``
+    """
+    def __init__(self, name, type):
+        self.name = name
+        self.type = type
+        self.bindings = []
+
+    def bind(self, state, routing_key):
+        if (state, routing_key) not in self.bindings:
+            self.bindings.append((state, routing_key))
+
+    def unbind(self, state):
+        self.bindings = [
+            binding for binding in self.bindings if binding[0] is not state]
+
+    async def publish(self, message, routing_key):
+        """
+        Deliver ``message`` to the bound queues, it is dropped if there is
+        none.
+
+        :param aio_pika.Message message: the message
+        :param str routing_key: used by direct exchanges
+        """
+        for state, key in self.bindings:
+            if self.type == ExchangeType.FANOUT or key == routing_key:
+                state.put(message, self.name, routing_key)
+
+
+class _QueueState():
+    # the messages of a queue and the consumers waiting for them
+    def __init__(self, name, arguments):
+        self.name = name
+        self.max_length = arguments.get('x-max-length')
+        self.ttl = arguments.get('x-message-ttl')
+        self.messages = deque()
+        self.waiters = []
+        self.closed = False
+
+    def put(self, message, exchange, routing_key, front=False):
+        loop = asyncio.get_event_loop()
+        expires = None if self.ttl is None else loop.time() + self.ttl / 1000
+        if front:
+            self.messages.appendleft((message, exchange, routing_key, expires))
+        else:
+            self.messages.append((message, exchange, routing_key, expires))
+        if self.max_length is not None:
+            while len(self.messages) > self.max_length:
+                self.messages.popleft()  # drop-head
+        self.wake()
+
+    def pop(self):
+        loop = asyncio.get_event_loop()
+        while self.messages:
+            item = self.messages.popleft()
+            if item[3] is None or item[3] > loop.time():
+                return item[:3]
+        return None
+
+    def wake(self):
+        waiters, self.waiters = self.waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    async def wait(self):
+        waiter = asyncio.Future()
+        self.waiters.append(waiter)
+        await waiter
+
+    def close(self):
+        self.closed = True
+        self.wake()
+
+
+class Queue():
+    """
+    like :py:class:`aio_pika.Queue`, the handle of a queue for one channel
+    """
+    def __init__(self, channel, state):
+        self.channel = channel
+        self.state = state
+        self.name = state.name
+
+    async def bind(self, exchange, routing_key=None):
+        """
+        :param exchange: :py:class:`Exchange` or its name
+        :param str routing_key: defaults to the name of the queue
+        """
+        if isinstance(exchange, str):
+            exchange = self.channel.broker.exchanges[exchange]
+        exchange.bind(
+            self.state, self.name if routing_key is None else routing_key)
+
+    async def get(self, no_ack=False, fail=True):
+        """
+        :returns: the next message, ``None`` if the queue is empty and not
+            ``fail``
+        :rtype: IncomingMessage
+        :raises asyncio.QueueEmpty: if the queue is empty and ``fail``
+        """
+        item = self.state.pop()
+        if item is None:
+            if fail:
+                raise asyncio.QueueEmpty()
+            return None
+        return IncomingMessage(
+            self.state, None, no_ack,
+            next(self.channel.broker.delivery_tags), *item)
+
+    def iterator(self, no_ack=False):
+        """
+        :rtype: QueueIterator
+        """
+        return QueueIterator(self, no_ack)
+
+
+class QueueIterator():
+    """
+    like :py:class:`aio_pika.queue.QueueIterator`, a consumer. Delivered
+    messages that are not acknowledged when the channel is closed are put
+    back into the queue.
+    """
+    def __init__(self, queue, no_ack):
+        self.queue = queue
+        self.state = queue.state
+        self.no_ack = no_ack
+        self.unacked = set()
+        self.closed = False
+        queue.channel._consumers.append(self)
+
+    def _may_deliver(self):
+        prefetch_count = self.queue.channel.prefetch_count
+        return self.no_ack or not prefetch_count or \
+            len(self.unacked) < prefetch_count
+
+    async def __anext__(self):
+        while True:
+            if self.closed or self.state.closed:
+                raise StopAsyncIteration()
+            if self._may_deliver():
+                item = self.state.pop()
+                if item is not None:
+                    message = IncomingMessage(
+                        self.state, self, self.no_ack,
+                        next(self.queue.channel.broker.delivery_tags), *item)
+                    if not self.no_ack:
+                        self.unacked.add(message)
+                    return message
+            await self.state.wait()
+
+    def __aiter__(self):
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        """
+        stop consuming, messages not yet acknowledged can still be
+        acknowledged
+        """
+        self.closed = True
+        self.state.wake()
+
+    def settled(self, message):
+        self.unacked.discard(message)
+        # a slot for the next message is free
+        self.state.wake()
+
+
+class IncomingMessage():
+    """
+    like :py:class:`aio_pika.IncomingMessage`, the properties of the
+    published message are available as attributes.
+    """
+    def __init__(
+            self, state, consumer, no_ack, delivery_tag, message, exchange,
+            routing_key):
+        self._state = state
+        self._consumer = consumer
+        self._message = message
+        self._settled = no_ack
+        self.body = message.body
+        self.exchange = exchange
+        self.routing_key = routing_key
+        self.delivery_tag = delivery_tag
+
+    def __getattr__(self, name):
+        # correlation_id, reply_to, type, headers, ...
+        return getattr(self._message, name)
+
+    def _settle(self):
+        if self._settled:
+            return False
+        self._settled = True
+        if self._consumer is not None:
+            self._consumer.settled(self)
+        return True
+
+    def ack(self):
+        self._settle()
+
+    def reject(self, requeue=False):
+        if self._settle() and requeue and not self._state.closed:
+            self._state.put(
+                self._message, self.exchange, self.routing_key, front=True)
+
+    @contextmanager
+    def process(self, requeue=False):
+        """
+        acknowledge the message at the end of the block, reject it if the
+        block raises an exception
+        """
+        try:
+            yield self
+        except BaseException:
+            self.reject(requeue=requeue)
+            raise
+        else:
+            self.ack()
+
+
+def get_broker():
+    """
+    :returns: the broker of this process
+    :rtype: Broker
+    """
+    global _broker
+    if _broker is None:
+        _broker = Broker()
+    return _broker
@@ -4,39 +4,262 @@ message bus worker
 ------------------
 """
 import json
+import asyncio
+import datetime
 import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 import logging
 
 import pika
+import aio_pika
+from sqlalchemy import text, func, false
+from sqlalchemy.dialects.postgresql import JSONB
 
-from fpesa.postgres import Message, with_session, create_all
+from fpesa import rabbitmq
+from fpesa import metrics
+from fpesa import tracing
+from fpesa.archive import get_archive, dump_line
+from fpesa.gapindex import get_gap_index
+from fpesa.config import get_config
+from fpesa.postgres import Message, SEARCH_CONFIG, search_column
+from fpesa.postgres import with_session, with_read_session
+from fpesa.postgres import create_all, create_partitions, is_partitioned
 from fpesa.rabbitmq import open_connection
 
 logger = logging.getLogger(__name__)
 
+MESSAGES_INSERTED = metrics.Counter(
+    'fpesa_messages_inserted_total', 'messages inserted by messages_post')
+WORKER_REQUESTS = metrics.Counter(
+    'fpesa_worker_requests_total',
+    'requests answered by messages_get', ['queue'])
+WORKER_ERRORS = metrics.Counter(
+    'fpesa_worker_errors_total',
+    'requests of messages_get answered with an error')
+WORKER_IN_FLIGHT = metrics.Gauge(
+    'fpesa_worker_requests_in_flight',
+    'requests processed at the same time by messages_get')
+
+MAX_FIELDS = 20
+""" maximum number of fields of the ``fields`` argument """
+MAX_FIELD_DEPTH = 5
+""" maximum number of keys of one field of the ``fields`` argument """
+
+_partitions_end = None
+# first id without a partition, as known to this worker
+
+_cancelled = deque(maxlen=1000)
+# correlation ids of the last streamed requests the restmapper gave up on,
+# see fpesa.restmapper.StreamingAdapter
+
+
+class ArgumentError(ValueError):
+    """
+    Raised when a request argument can not be used. Other than for
+    unexpected exceptions the description is sent to the client.
+
+    :param str description: the description
+    :param int code: error code sent with the description
+    """
+    def __init__(self, description, code=500):
+        super().__init__(description)
+        self.code = code
+
+
+class Cancelled(Exception):
+    """
+    Raised when a streamed response is sent after the restmapper cancelled
+    the request, e.g. because the client disconnected.
+    """
+
+
+def _parse_datetime(name, value):
+    for date_format in (
+            '%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M',
+            '%Y-%m-%d'):
+        try:
+            return datetime.datetime.strptime(value.replace(' ', 'T'),
+                                              date_format)
+        except ValueError:
+            pass
+    raise ArgumentError(
+        "Can not parse {} '{}', expected YYYY-MM-DDTHH:MM:SS".format(
+            name, value))
+
+
+def _parse_json_object(name, value):
+    try:
+        result = json.loads(value)
+    except ValueError as e:
+        raise ArgumentError(
+            "Can not parse {} as JSON: {}".format(name, e))
+    if not isinstance(result, dict):
+        raise ArgumentError("{} has to be a JSON object".format(name))
+    return result
+
+
+def _parse_fields(value):
+    # turns "a,b.c,b.d" into {'a': None, 'b': {'c': None, 'd': None}}, None
+    # marks a value that is selected as a whole
+    paths = value.split(',')
+    if len(paths) > MAX_FIELDS:
+        raise ArgumentError(
+            "fields can hold at most {} fields".format(MAX_FIELDS))
+    tree = {}
+    for path in paths:
+        keys = path.split('.')
+        if len(keys) > MAX_FIELD_DEPTH:
+            raise ArgumentError(
+                "field {} is nested deeper than {}".format(
+                    path, MAX_FIELD_DEPTH))
+        if not all(keys):
+            raise ArgumentError("field {!r} is invalid".format(path))
+        node = tree
+        for key in keys[:-1]:
+            if key in node and node[key] is None:
+                break  # the parent is already selected as a whole
+            node = node.setdefault(key, {})
+        else:
+            node[keys[-1]] = None
+    return tree
+
+
+def _projection(tree, path=()):
+    args = []
+    for key, subtree in sorted(tree.items()):
+        args.append(key)
+        if subtree is None:
+            args.append(Message.message[path + (key,)])
+        else:
+            args.append(_projection(subtree, path + (key,)))
+    return func.jsonb_build_object(*args, type_=JSONB)
+
+
+def _project(message, tree):
+    # same as _projection, for messages read from the archive
+    result = {}
+    for key, subtree in tree.items():
+        value = message.get(key) if isinstance(message, dict) else None
+        if subtree is not None:
+            value = _project(value, subtree)
+        result[key] = value
+    return result
+
+
+def _message_column(fields):
+    # the projection is done by the database, so only the selected values
+    # are transferred
+    if fields is None:
+        return Message.message
+    return _projection(fields)
+
 
 @with_session
-def message_post(session, message_data):
+def message_post(session, message_data, trace=None):
     """
     save message to database.
 
     :param sqlalchemy.orm.session.Session session: session object injected via
         :py:func:`fpesa.postgres.with_session` decorator.
     :param dict message_data: a json serializeable python dictionary
+    :param dict trace: trace of the message, see :py:mod:`fpesa.tracing`
 
+    If the table is partitioned, upcoming partitions are created when
+    needed, see :py:func:`fpesa.postgres.create_partitions`.
+
+    If ``notify`` is enabled in the :ref:`config` a notification is sent on
+    ``notify_channel`` once the message is committed. The payload is
+    ``{"id": <int>, "message": <message>, "trace": <trace>}``, the message
+    is left out if the payload gets larger than ``notify_max_payload``.
     """
+    global _partitions_end
     message = Message(message_data)
     session.add(message)
 
+    config_postgres = get_config()['postgres']
+    partition_size = config_postgres.getint('partition_size')
+    if partition_size:
+        # the partition for the id has to exist before the row is inserted,
+        # so the id is taken from the sequence first
+        message.id = session.execute(text(
+            "SELECT nextval(pg_get_serial_sequence('message', 'id'))"))\
+            .scalar()
+        if _partitions_end is None and not is_partitioned(session):
+            # the table was created before partitioning was configured
+            _partitions_end = float('inf')
+        if _partitions_end is None or \
+                message.id + partition_size >= _partitions_end:
+            # less than one partition left, create the next ones in time
+            _partitions_end = create_partitions(session, message.id)
+    if config_postgres.getboolean('notify'):
+        session.flush()  # assigns message.id
+        notification = {'id': message.id, 'message': message_data}
+        if trace is not None:
+            notification['trace'] = trace
+        payload = json.dumps(notification)
+        if len(payload.encode()) > \
+                config_postgres.getint('notify_max_payload'):
+            del notification['message']
+            payload = json.dumps(notification)
+        # notifications are delivered on commit
+        session.execute(
+            text('SELECT pg_notify(:channel, :payload)'),
+            {'channel': config_postgres['notify_channel'],
+             'payload': payload})
+
 
 @with_session
+def message_fetch(session, ids):
+    """
+    Fetch messages by id.
+
+    :param sqlalchemy.orm.session.Session session: session object injected via
+        :py:func:`fpesa.postgres.with_session` decorator.
+    :param list(int) ids: ids of the messages
+    :rtype: dict
+    :returns: the messages by their id, deleted messages are missing
+    """
+    query = session.query(Message.id, Message.message)\
+        .filter(Message.id.in_(ids))
+    return {message_id: message for message_id, message in query}
+
+
+def _time_range_filters(session, since, until):
+    # find the ids of the time range with the brin index first, so the
+    # messages can be selected by the primary key
+    filters = []
+    if since is not None:
+        filters.append(Message.inserted >= since)
+    if until is not None:
+        filters.append(Message.inserted < until)
+    min_id, max_id = session.query(func.min(Message.id), func.max(Message.id))\
+        .filter(*filters)\
+        .one()
+    if min_id is None:
+        return [false()]
+    return filters + [Message.id >= min_id, Message.id <= max_id]
+
+
+def _message_get_min_id(request_arguments, **kwds):
+    # a replica has to know all messages the client already knows about
+    ids = [
+        int(request_arguments[key]) for key in ('paginationId', 'afterId')
+        if request_arguments.get(key) is not None]
+    if ids:
+        return max(ids)
+    return None
+
+
+@with_read_session(_message_get_min_id)
 def message_get(session, request_arguments):
     """
     Fetch messages from database, newest to oldest.
 
     :param sqlalchemy.orm.session.Session session: session object injected via
-        :py:func:`fpesa.postgres.with_session` decorator.
+        :py:func:`fpesa.postgres.with_read_session` decorator. Bound to a
+        replica if configured.
 
     :param dict request_arguments: request parameters of the corresponding http
         request. All entries are of the type ``str``. The keys of this
@@ -48,6 +271,27 @@ def message_get(session, request_arguments):
           pagination_id is provided with the first result of message_get
         * ``offset`` how many message should be skipped
         * ``limit`` how many messages should be returned (max: 100)
+        * ``afterId`` only return messages newer than this id, pass the
+          ``paginationId`` of a previous result to get the messages that
+          were inserted since then.
+        * ``since`` and ``until`` only return messages inserted in this time
+          range (``since <= inserted < until``), formatted as
+          ``YYYY-MM-DDTHH:MM:SS``. The time is interpreted as local time of
+          the database.
+        * ``contains`` a JSON object, only return messages that contain it,
+          e.g. ``{"device": "x17"}``. Only if ``contains`` is enabled in the
+          :ref:`config`.
+        * ``fields`` only return these fields of each message, separated by
+          comma, nested fields are separated by dots, e.g.
+          ``device,payload.temperature``. Missing fields are ``null``. At
+          most :py:data:`MAX_FIELDS` fields with :py:data:`MAX_FIELD_DEPTH`
+          keys each.
+
+    If an archive is configured, see :py:mod:`fpesa.archive`, pages beyond
+    the oldest message in the database are read from the archive. Only
+    ``paginationId``, ``offset``, ``limit`` and ``fields`` are supported for
+    archived messages, the other arguments only select messages from the
+    database.
 
     :rtype: dict
     :returns: messages with additional meta information. The entries of the
@@ -64,10 +308,38 @@ def message_get(session, request_arguments):
     pagination_id = request_arguments.get('paginationId', None)
     if pagination_id is not None:
         pagination_id = int(pagination_id)
+    after_id = request_arguments.get('afterId', None)
+    if after_id is not None:
+        after_id = int(after_id)
+    since = request_arguments.get('since', None)
+    if since is not None:
+        since = _parse_datetime('since', since)
+    until = request_arguments.get('until', None)
+    if until is not None:
+        until = _parse_datetime('until', until)
+    contains = request_arguments.get('contains', None)
+    if contains is not None:
+        if not get_config()['postgres'].getboolean('contains'):
+            raise ArgumentError("contains is not enabled", code=400)
+        contains = _parse_json_object('contains', contains)
+    fields = request_arguments.get('fields', None)
+    if fields is not None:
+        fields = _parse_fields(fields)
+    column = _message_column(fields)
     offset = int(request_arguments['offset'])
     limit = min(100, int(request_arguments['limit']))
 
-    if session.query(Message).count() == 0:
+    unfiltered = after_id is None and since is None and until is None and \
+        contains is None
+    archive = None
+    if unfiltered:
+        # only unfiltered pages are read from the archive
+        archive = get_archive()
+    min_id, max_id = session.query(
+        func.min(Message.id), func.max(Message.id)).one()
+    if max_id is None and archive is not None:
+        max_id = archive.max_id
+    if max_id is None:
         return {
             'paginationId': 0,
             'offset': offset,
@@ -77,27 +349,193 @@ def message_get(session, request_arguments):
         }
 
     if pagination_id is None:
-        pagination_id = session.query(Message)\
+        pagination_id = max_id
+    filters = [Message.id <= pagination_id]
+    if after_id is not None:
+        filters.append(Message.id > after_id)
+    if since is not None or until is not None:
+        filters.extend(_time_range_filters(session, since, until))
+    if contains is not None:
+        # @> is served by the gin index
+        filters.append(Message.message.contains(contains))
+    located = None
+    if unfiltered:
+        gap_index = get_gap_index(session)
+        if gap_index is not None:
+            located = gap_index.locate(session, min_id, pagination_id, offset)
+    if located is not None:
+        # deep pages start at the right id instead of skipping offset rows
+        total, page_id, page_offset = located
+        page_filters = [Message.id <= page_id]
+    else:
+        total = session.query(Message)\
+            .filter(*filters)\
+            .count()
+        page_id, page_offset, page_filters = \
+            pagination_id, offset, filters
+    messages = []
+    if page_id is not None and offset < total:
+        query = session.query(column)\
+            .filter(*page_filters)\
             .order_by(Message.id.desc())\
-            .limit(1)\
-            .one().id
-    total = session.query(Message)\
-        .filter(Message.id <= pagination_id)\
-        .count()
-    query = session.query(Message)\
-        .filter(Message.id <= pagination_id)\
+            .offset(page_offset)\
+            .limit(limit)
+        messages = [message for message, in query]
+    if archive is not None:
+        # messages removed by fpesa.retention, older than all messages in
+        # the database
+        if min_id is not None:
+            archive_max_id = min(pagination_id, min_id - 1)
+        else:
+            archive_max_id = pagination_id
+        if len(messages) < limit:
+            archived = archive.newest(
+                archive_max_id, max(0, offset - total),
+                limit - len(messages))
+            if fields is not None:
+                archived = [_project(message, fields) for message in archived]
+            messages.extend(archived)
+        total += archive.count(archive_max_id)
+    return {
+        'paginationId': pagination_id,
+        'offset': offset,
+        'limit': limit,
+        'total': total,
+        'messages': messages,
+    }
+
+
+@with_read_session(_message_get_min_id)
+def message_search(session, request_arguments):
+    """
+    Full text search, best matching messages first.
+
+    :param sqlalchemy.orm.session.Session session: session object injected via
+        :py:func:`fpesa.postgres.with_read_session` decorator. Bound to a
+        replica if configured.
+
+    :param dict request_arguments: request parameters of the corresponding http
+        request. All entries are of the type ``str``. The keys of this
+        dictionary are:
+
+        * ``q`` the search query, see ``websearch_to_tsquery`` in the
+          PostgreSQL documentation. Words are matched against the string and
+          numeric values of the messages.
+        * ``paginationId``, ``offset``, ``limit`` and ``fields`` as for
+          :py:func:`message_get`
+
+    :rtype: dict
+    :returns: like :py:func:`message_get`, ``total`` is at most
+        ``search_max_matches`` from the :ref:`config` as only the newest
+        matches are ranked.
+
+    Only available if ``search`` is enabled in the :ref:`config`.
+    """
+    pagination_id = request_arguments.get('paginationId', None)
+    if pagination_id is not None:
+        pagination_id = int(pagination_id)
+    fields = request_arguments.get('fields', None)
+    if fields is not None:
+        fields = _parse_fields(fields)
+    column = _message_column(fields)
+    offset = int(request_arguments['offset'])
+    limit = min(100, int(request_arguments['limit']))
+    max_matches = get_config()['postgres'].getint('search_max_matches')
+
+    if pagination_id is None:
+        pagination_id = session.query(func.max(Message.id)).scalar() or 0
+    tsquery = func.websearch_to_tsquery(
+        SEARCH_CONFIG, request_arguments['q'])
+    # the gin index finds the matches, ranking needs to read each of them,
+    # so the work is bounded by only ranking the newest ones
+    matches = session.query(Message.id, search_column)\
+        .filter(Message.id <= pagination_id, search_column.op('@@')(tsquery))\
         .order_by(Message.id.desc())\
+        .limit(max_matches)\
+        .subquery()
+    total = session.query(func.count()).select_from(matches).scalar()
+    ranked = session.query(matches.c.id)\
+        .order_by(
+            func.ts_rank(matches.c.search, tsquery).desc(),
+            matches.c.id.desc())\
         .offset(offset)\
         .limit(limit)
+    ids = [message_id for message_id, in ranked]
+    messages = dict(
+        session.query(Message.id, column)
+        .filter(Message.id.in_(ids)))
     return {
         'paginationId': pagination_id,
         'offset': offset,
         'limit': limit,
         'total': total,
-        'messages': [m.message for m in query]
+        'messages': [messages[message_id] for message_id in ids],
     }
 
 
+@with_read_session(_message_get_min_id, retry=False)
+def message_export(session, request_arguments, send, chunk_size=1000):
+    """
+    Export messages, oldest first.
+
+    :param sqlalchemy.orm.session.Session session: session object injected via
+        :py:func:`fpesa.postgres.with_read_session` decorator. Bound to a
+        replica if configured.
+
+    :param dict request_arguments: request parameters of the corresponding http
+        request. All entries are of the type ``str`` and optional:
+
+        * ``afterId`` only export messages newer than this id
+        * ``paginationId`` only export messages up to this id
+        * ``since`` and ``until`` as for :py:func:`message_get`
+
+    :param callable send: called with the next chunk of newline delimited
+        json, each line as written by :py:func:`fpesa.archive.dump_line`
+    :param int chunk_size: number of messages per chunk
+    :rtype: dict
+    :returns: an empty dictionary
+
+    The messages are read with a server side cursor, so only one chunk is
+    held in memory. Messages moved to the archive are not exported.
+    """
+    filters = []
+    pagination_id = request_arguments.get('paginationId', None)
+    if pagination_id is not None:
+        filters.append(Message.id <= int(pagination_id))
+    after_id = request_arguments.get('afterId', None)
+    if after_id is not None:
+        filters.append(Message.id > int(after_id))
+    since = request_arguments.get('since', None)
+    if since is not None:
+        since = _parse_datetime('since', since)
+    until = request_arguments.get('until', None)
+    if until is not None:
+        until = _parse_datetime('until', until)
+    if since is not None or until is not None:
+        filters.extend(_time_range_filters(session, since, until))
+    query = session.query(Message.id, Message.inserted, Message.message)\
+        .filter(*filters)\
+        .order_by(Message.id)\
+        .execution_options(stream_results=True)\
+        .yield_per(chunk_size)
+    lines = []
+    for row in query:
+        lines.append(dump_line(*row))
+        if len(lines) >= chunk_size:
+            send(''.join(lines).encode())
+            lines = []
+    if lines:
+        send(''.join(lines).encode())
+    return {}
+
+
+def _message_post_body(body):
+    envelope = json.loads(body.decode())
+    trace = tracing.stage(envelope.get('trace'), 'messages_post')
+    message_post(envelope['data'], trace=trace)
+    tracing.stage(trace, 'committed', last=True)
+
+
 def messages_post_worker():
     """
     worker that keeps calling :py:func:`message_post` for each message that
@@ -110,8 +548,9 @@ def messages_post_worker():
         # will exit. the worker will then be restarted by the supervisor and
         # the problem will persist. but as the queue is persistant no messages
         # get lost
-        message_post(json.loads(body.decode())['data'])
+        _message_post_body(body)
         channel.basic_ack(delivery_tag=method_frame.delivery_tag)
+        MESSAGES_INSERTED.inc()
 
     create_all()
     connection = open_connection()
@@ -126,47 +565,237 @@ def messages_post_worker():
         connection.close()
 
 
-def _message_get_worker_cb(
-        channel, method_frame, header_frame, body, debug=False):
-    # when an error occures the error should be sent to the client and the
-    # message should be acked anyway.
-    logger.info(
-        "message with delivery_tag={}".format(method_frame.delivery_tag))
+async def consume_messages_post(loop):
+    """
+    like :py:func:`messages_post_worker` for an event loop, used by
+    :py:mod:`fpesa.allinone`. The messages are inserted one after the other
+    in a thread, an error ends the coroutine and the message is not
+    acknowledged.
+
+    :param asyncio.AbstractEventLoop loop: event loop
+    """
+    executor = ThreadPoolExecutor(max_workers=1)
+    connection = await rabbitmq.get_aio_connection(loop)
+    async with connection:
+        channel = await connection.channel()
+        queue = await channel.declare_queue('/messages/:POST', durable=True)
+        async with queue.iterator() as message_iterator:
+            async for message in message_iterator:
+                logger.info(
+                    "message with delivery_tag={}".format(
+                        message.delivery_tag))
+                await loop.run_in_executor(
+                    executor, _message_post_body, message.body)
+                message.ack()
+                MESSAGES_INSERTED.inc()
+
+
+def _message_get_response(body, debug=False, handler=None):
+    # when an error occures the error should be sent to the client
+    if handler is None:
+        handler = message_get
+    trace = None
     try:
-        request_arguments = json.loads(body.decode())['args']
+        envelope = json.loads(body.decode())
+        trace = tracing.stage(envelope.get('trace'), 'messages_get')
+        request_arguments = envelope['args']
 
-        response = message_get(request_arguments)
+        response = handler(request_arguments)
+    except ArgumentError as e:
+        WORKER_ERRORS.inc()
+        response = {'error': {'code': e.code, 'description': str(e)}}
+    except Cancelled as e:
+        logger.info("request cancelled: {}".format(e))
+        response = {'error': {'code': 500, 'description': str(e)}}
     except Exception:
+        WORKER_ERRORS.inc()
         logger.exception("Exception while handling message get")
         if not debug:
             description = "Internal server error"
         else:
             description = "".join(traceback.format_exc())
         response = {'error': {'code': 500, 'description': description}}
+    tracing.stage(trace, 'answered', last=True)
+    return response
+
+
+def _check_cancelled(correlation_id):
+    if correlation_id in _cancelled:
+        raise Cancelled("request {} was cancelled".format(correlation_id))
+
+
+def _receive_cancels(channel, queue_name):
+    # takes the cancels that arrived since the last call
+    while True:
+        method_frame, header_frame, body = channel.basic_get(
+            queue=queue_name, no_ack=True)
+        if method_frame is None:
+            return
+        _cancelled.append(header_frame.correlation_id)
+
+
+def _message_get_worker_cb(
+        channel, method_frame, header_frame, body, debug=False, handler=None,
+        streaming=False, cancel_queue=None):
+    # when an error occures the error should be sent to the client and the
+    # message should be acked anyway.
+    logger.info(
+        "message with delivery_tag={}".format(method_frame.delivery_tag))
+    WORKER_REQUESTS.labels(method_frame.routing_key).inc()
+    properties = partial(
+        pika.BasicProperties, correlation_id=header_frame.correlation_id)
+    if streaming:
+        # see fpesa.restmapper.StreamingAdapter
+        def send(chunk):
+            if cancel_queue is not None:
+                _receive_cancels(channel, cancel_queue)
+            _check_cancelled(header_frame.correlation_id)
+            channel.publish(
+                'RPC', header_frame.reply_to, chunk, properties(type='chunk'))
+        handler = partial(handler, send=send)
+    response = _message_get_response(body, debug, handler)
 
     channel.publish(
         'RPC', header_frame.reply_to, json.dumps(response),
-        pika.BasicProperties(correlation_id=header_frame.correlation_id)
+        properties(type='end') if streaming else properties()
     )
 
     channel.basic_ack(delivery_tag=method_frame.delivery_tag)
 
 
+def _get_handlers():
+    # queue name, the function answering the requests on it and if the
+    # response is streamed
+    handlers = [
+        ('/messages/:GET', message_get, False),
+        ('/messages/export:GET', message_export, True),
+    ]
+    if get_config()['postgres'].getboolean('search'):
+        handlers.append(('/messages/search:GET', message_search, False))
+    return handlers
+
+
 def messages_get_worker(options):
     """
-    worker that keeps calling :py:func:`message_get` for each message that
-    arrives on the message bus.
+    worker that keeps calling :py:func:`message_get`,
+    :py:func:`message_search` and :py:func:`message_export` for each message
+    that arrives on the message bus.
     """
     create_all()
     connection = open_connection()
     channel = connection.channel()
-    channel.queue_declare('/messages/:GET')
-    channel.basic_consume(
-        partial(_message_get_worker_cb, debug=options.debug), '/messages/:GET',
-    )
+    channel.exchange_declare(exchange='RPC:cancel', exchange_type='fanout')
+    cancel_queue = channel.queue_declare(exclusive=True).method.queue
+    channel.queue_bind(cancel_queue, 'RPC:cancel')
+    for queue_name, handler, streaming in _get_handlers():
+        channel.queue_declare(queue_name)
+        channel.basic_consume(
+            partial(
+                _message_get_worker_cb, debug=options.debug, handler=handler,
+                streaming=streaming, cancel_queue=cancel_queue),
+            queue_name,
+        )
     try:
         channel.start_consuming()
     except KeyboardInterrupt:
         channel.stop_consuming()
     finally:
         connection.close()
+
+
+async def consume_messages_get(loop, concurrency, debug=False):
+    """
+    answers the requests of :py:func:`messages_get_worker_async`
+
+    :param asyncio.AbstractEventLoop loop: event loop
+    :param int concurrency: requests processed at the same time
+    :param bool debug: response with stacktraces on error
+    """
+    # database queries block, they are run in a thread pool, while the event
+    # loop keeps receiving requests and sending responses.
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+
+    def respond(body, handler):
+        return json.dumps(
+            _message_get_response(body, debug, handler)).encode()
+
+    connection = await rabbitmq.get_aio_connection(loop)
+    async with connection:
+        channel = await connection.channel()
+        # limits the requests processed at the same time
+        await channel.set_qos(prefetch_count=concurrency)
+        response_exchange = await channel.declare_exchange(
+            'RPC', type=aio_pika.exchange.ExchangeType.DIRECT)
+
+        def publish(message, body, message_type=None):
+            return response_exchange.publish(
+                aio_pika.Message(
+                    body, correlation_id=message.correlation_id,
+                    type=message_type),
+                routing_key=message.reply_to,
+            )
+
+        async def handle(message, handler, streaming):
+            WORKER_REQUESTS.labels(message.routing_key).inc()
+            WORKER_IN_FLIGHT.inc()
+            try:
+                with message.process():
+                    if streaming:
+                        # called from the thread pool, waits until the
+                        # chunk is published
+                        def send(chunk):
+                            _check_cancelled(message.correlation_id)
+                            asyncio.run_coroutine_threadsafe(
+                                publish(message, chunk, 'chunk'),
+                                loop).result()
+                        handler = partial(handler, send=send)
+                    body = await loop.run_in_executor(
+                        executor, respond, message.body, handler)
+                    await publish(message, body, 'end' if streaming else None)
+            finally:
+                WORKER_IN_FLIGHT.dec()
+
+        async def consume_cancels():
+            exchange = await channel.declare_exchange(
+                'RPC:cancel', type=aio_pika.exchange.ExchangeType.FANOUT)
+            queue = await channel.declare_queue(exclusive=True)
+            await queue.bind(exchange)
+            async with queue.iterator(no_ack=True) as message_iterator:
+                async for message in message_iterator:
+                    _cancelled.append(message.correlation_id)
+
+        async def consume(queue_name, handler, streaming):
+            queue = await channel.declare_queue(queue_name)
+            async with queue.iterator() as message_iterator:
+                async for message in message_iterator:
+                    logger.info(
+                        "message with delivery_tag={}".format(
+                            message.delivery_tag))
+                    loop.create_task(handle(message, handler, streaming))
+
+        await asyncio.gather(consume_cancels(), *[
+            consume(*handler) for handler in _get_handlers()])
+
+
+def messages_get_worker_async(options):
+    """
+    like :py:func:`messages_get_worker` but processes up to
+    ``options.concurrency`` requests at the same time, the database queries
+    run in a thread pool. The size of the connection pool is set with
+    ``pool_size`` and ``max_overflow`` in the :ref:`config`.
+    """
+    create_all()
+    loop = asyncio.get_event_loop()
+    consume = loop.create_task(
+        consume_messages_get(loop, options.concurrency, options.debug))
+    try:
+        loop.run_until_complete(consume)
+    except KeyboardInterrupt:
+        logger.info("shutting down")
+        consume.cancel()
+        try:
+            loop.run_until_complete(consume)
+        except asyncio.CancelledError:
+            pass
+    finally:
+        loop.close()
@@ -0,0 +1,253 @@
+"""
+-------
+metrics
+-------
+
+Counters, gauges and histograms in the text format of Prometheus. Each
+component serves them at ``/metrics`` when started with ``fpesa
+--metrics-port <port> <component>``, see :py:func:`start_server`.
+
+Updating a metric is a few attribute accesses, there are no locks: an
+update from another thread may get lost now and then, which is fine for
+monitoring. Metrics with labels return their child per label values with
+:py:meth:`Metric.labels`, hot paths keep the child around. Metrics without
+labels are updated directly.
+"""
+import time
+import bisect
+import logging
+import threading
+from socketserver import ThreadingMixIn
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (
+    .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+""" buckets of latency histograms in seconds """
+SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+""" buckets of histograms of batch sizes """
+
+_metrics = []
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\')
+                         .replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in zip(names, values)) + '}'
+
+
+class Metric():
+    """
+    Base class, the metric is registered for :py:func:`expose` when
+    created.
+
+    :param str name: name of the metric
+    :param str documentation: help text
+    :param tuple labelnames: names of the labels
+    """
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.children = {}
+        if not self.labelnames:
+            self.children[()] = self._child()
+        _metrics.append(self)
+
+    def _child(self):
+        raise NotImplementedError()
+
+    def labels(self, *values):
+        """
+        :returns: the metric for these label values
+        """
+        child = self.children.get(values)
+        if child is None:
+            child = self.children.setdefault(values, self._child())
+        return child
+
+    def expose(self):
+        """
+        :rtype: list(str)
+        :returns: lines of the text format
+        """
+        lines = [
+            '# HELP {} {}'.format(self.name, self.documentation),
+            '# TYPE {} {}'.format(self.name, self.type),
+        ]
+        for values, child in sorted(self.children.items()):
+            lines.extend(child.expose(self.name, self.labelnames, values))
+        return lines
+
+
+class _Value():
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+    def expose(self, name, labelnames, values):
+        return ['{}{} {}'.format(
+            name, _format_labels(labelnames, values), self.value)]
+
+
+class Counter(Metric):
+    """
+    a value that only goes up, use ``inc()``
+    """
+    type = 'counter'
+
+    def _child(self):
+        return _Value()
+
+    def inc(self, amount=1):
+        self.children[()].inc(amount)
+
+
+class Gauge(Metric):
+    """
+    a value that goes up and down, use ``inc()``, ``dec()`` and ``set()``
+    """
+    type = 'gauge'
+
+    def _child(self):
+        return _Value()
+
+    def inc(self, amount=1):
+        self.children[()].inc(amount)
+
+    def dec(self, amount=1):
+        self.children[()].dec(amount)
+
+    def set(self, value):
+        self.children[()].set(value)
+
+
+class _Histogram():
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def time(self):
+        return _Timer(self)
+
+    def expose(self, name, labelnames, values):
+        lines = []
+        total = 0
+        for bound, count in zip(
+                self.buckets + (float('inf'),), self.counts):
+            total += count
+            lines.append('{}_bucket{} {}'.format(
+                name,
+                _format_labels(
+                    labelnames + ('le',),
+                    values + ('+Inf' if bound == float('inf') else bound,)),
+                total))
+        labels = _format_labels(labelnames, values)
+        lines.append('{}_sum{} {}'.format(name, labels, self.sum))
+        lines.append('{}_count{} {}'.format(name, labels, total))
+        return lines
+
+
+class _Timer():
+    # context manager observing the seconds spent inside
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.monotonic() - self.start)
+
+
+class Histogram(Metric):
+    """
+    counts observed values in buckets, use ``observe(value)`` or ``with
+    histogram.time():`` to observe the seconds spent
+
+    :param tuple buckets: upper bounds of the buckets, ordered
+    """
+    type = 'histogram'
+
+    def __init__(
+            self, name, documentation, labelnames=(),
+            buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        super().__init__(name, documentation, labelnames)
+
+    def _child(self):
+        return _Histogram(self.buckets)
+
+    def observe(self, value):
+        self.children[()].observe(value)
+
+    def time(self):
+        return self.children[()].time()
+
+
+def expose():
+    """
+    :rtype: str
+    :returns: all metrics in the text format
+    """
+    lines = []
+    for metric in list(_metrics):
+        lines.extend(metric.expose())
+    return '\n'.join(lines) + '\n'
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = expose().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_server(port, bind='127.0.0.1'):
+    """
+    Serve the metrics at ``http://<bind>:<port>/metrics`` from a thread, so
+    it works for the asyncio components and the blocking workers alike.
+
+    :param int port: port to listen on
+    :param str bind: bind address
+    :rtype: http.server.HTTPServer
+    """
+    server = _Server((bind, port), _Handler)
+    thread = threading.Thread(
+        target=server.serve_forever, name='metrics', daemon=True)
+    thread.start()
+    logger.info("serving metrics on {}:{}".format(bind, port))
+    return server
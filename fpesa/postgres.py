@@ -3,20 +3,66 @@
 postgres
 --------
 """
+import time
+import logging
+import itertools
 from functools import wraps
 
-from sqlalchemy import Column, Integer, DateTime
+from sqlalchemy import Column, Integer, DateTime, Index, MetaData
+from sqlalchemy import text, column
+from sqlalchemy.exc import SQLAlchemyError, OperationalError
 from sqlalchemy.sql import func
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import sessionmaker, Session as _BaseSession
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.dialects.postgresql import JSONB, TSVECTOR
 
-from fpesa.helper import get_engine
+from fpesa.config import get_config
+from fpesa.helper import get_engine, get_replica_engines
+from fpesa import metrics
+from fpesa import querylog
+
+logger = logging.getLogger(__name__)
+
+QUERY_DURATION = metrics.Histogram(
+    'fpesa_db_query_duration_seconds',
+    'time spent in functions using a database session', ['function'])
+COMMIT_DURATION = metrics.Histogram(
+    'fpesa_db_commit_duration_seconds',
+    'time to commit the session of a function', ['function'])
 
 Base = declarative_base()
 
-Session = sessionmaker(bind=get_engine())
-# TODO: move into function and global variable?!
+_engine = None
+
+
+def get_primary_engine():
+    """
+    :returns: the engine of the primary database, created on first use so
+        importing this module does not need the config or a database driver
+    :rtype: :py:class:`sqlalchemy.engine.Engine`
+    """
+    global _engine
+    if _engine is None:
+        _engine = get_engine()
+    return _engine
+
+
+class _Session(_BaseSession):
+    # bound to the primary unless configured or called with another bind
+    def __init__(self, bind=None, **kwds):
+        super().__init__(
+            bind=bind if bind is not None else get_primary_engine(), **kwds)
+
+
+Session = sessionmaker(class_=_Session)
+
+SEARCH_CONFIG = 'simple'
+""" text search configuration of :py:data:`search_column` """
+
+search_column = column('search', TSVECTOR)
+""" words of all string and numeric values of a message, generated by the
+database. The column only exists if ``search`` is enabled in the
+:ref:`config`, see :py:func:`create_search` """
 
 
 class Message(Base):
@@ -24,6 +70,11 @@ class Message(Base):
     Wraps a JSON Message into a database object.
     """
     __tablename__ = 'message'
+    __table_args__ = (
+        # the insertion time grows with the id, a small brin index is
+        # enough to find the ids of a time range
+        Index('ix_message_inserted', 'inserted', postgresql_using='brin'),
+    )
     id = Column(Integer, primary_key=True)
     """ internal database ID used to return messages in order """
     inserted = Column(DateTime, server_default=func.now())
@@ -35,6 +86,21 @@ class Message(Base):
         self.message = message
 
 
+def _call_with_session(session, f, args, kwds):
+    try:
+        with querylog.track(f.__name__):
+            with QUERY_DURATION.labels(f.__name__).time():
+                result = f(session, *args, **kwds)
+            with COMMIT_DURATION.labels(f.__name__).time():
+                session.commit()
+        return result
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
 def with_session(f):
     """
     Decorator that injects a Session object as the first paramter.
@@ -44,19 +110,133 @@ def with_session(f):
     """
     @wraps(f)
     def wrapper(*args, **kwds):
-        session = Session()
-        try:
-            result = f(session, *args, **kwds)
-            session.commit()
-            return result
-        except Exception:
-            session.rollback()
-            raise
-        finally:
-            session.close()
+        return _call_with_session(Session(), f, args, kwds)
     return wrapper
 
 
+class ReplicaRouter():
+    """
+    Chooses the database for read only queries.
+
+    :param list(sqlalchemy.engine.Engine) engines: replicas
+    :param float cooldown: seconds a replica that failed is skipped
+
+    The replicas are used round robin. A replica is only chosen if it already
+    applied the message with the requested id, otherwise the next replica is
+    asked. If no replica is recent enough or no replica is configured, the
+    primary database is used. A replica is asked once for its applied id
+    before it is chosen the first time and again after it failed.
+    """
+    def __init__(self, engines, cooldown=30):
+        self.engines = engines
+        self.cooldown = cooldown
+        # None until the replica answered
+        self._applied_ids = dict.fromkeys(engines)
+        self._unavailable_until = dict.fromkeys(engines, 0)
+        self._next = itertools.cycle(engines)
+
+    def get_bind(self, min_id=None):
+        """
+        :param int min_id: the replica must contain the message with this id
+        :returns: an engine of a replica or ``None`` for the primary
+        :rtype: sqlalchemy.engine.Engine
+        """
+        if min_id is None:
+            min_id = 0
+        now = time.monotonic()
+        for i in range(len(self.engines)):
+            engine = next(self._next)
+            if self._unavailable_until[engine] > now:
+                continue
+            if self._applied_id(engine, min_id) >= min_id:
+                return engine
+        return None
+
+    def failed(self, engine, error):
+        """
+        Skip ``engine`` for ``cooldown`` seconds.
+
+        :param sqlalchemy.engine.Engine engine: the replica
+        :param Exception error: why it failed
+        """
+        logger.warning('replica {} not available, skipped for {} seconds: {}'
+                       .format(engine, self.cooldown, error))
+        self._applied_ids[engine] = None
+        self._unavailable_until[engine] = time.monotonic() + self.cooldown
+
+    def _applied_id(self, engine, min_id):
+        # ids only grow, only ask the replica again if the known id is
+        # too small
+        applied_id = self._applied_ids[engine]
+        if applied_id is None or applied_id < min_id:
+            try:
+                with engine.connect() as connection:
+                    applied_id = connection.execute(
+                        text('SELECT max(id) FROM message')).scalar() or 0
+            except SQLAlchemyError as e:
+                self.failed(engine, e)
+                return -1
+            self._applied_ids[engine] = applied_id
+        return applied_id
+
+
+_replica_router = None
+
+
+def get_replica_router():
+    """
+    :returns: the :py:class:`ReplicaRouter` for the replicas defined in the
+        :ref:`config`
+    :rtype: ReplicaRouter
+    """
+    global _replica_router
+    if _replica_router is None:
+        _replica_router = ReplicaRouter(
+            get_replica_engines(),
+            get_config()['postgres'].getfloat('replica_cooldown'))
+    return _replica_router
+
+
+def _is_connection_error(error):
+    # errors reported by the server carry an error code, failing to reach
+    # it does not
+    return isinstance(error, OperationalError) and \
+        getattr(error.orig, 'pgcode', None) is None
+
+
+def with_read_session(min_id, retry=True):
+    """
+    Like :py:func:`with_session`, but the session is bound to a replica as
+    chosen by :py:func:`get_replica_router`. Only for read only queries.
+
+    :param callable min_id: gets the arguments of the decorated function and
+        returns the id of the message the replica must already contain, or
+        ``None``
+    :param bool retry: if the replica can not be reached, the function is
+        called again with a session of the primary. Set it to ``False`` for
+        functions that already sent part of their result, then the error is
+        raised and only the next call skips the replica.
+    """
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwds):
+            router = get_replica_router()
+            bind = router.get_bind(min_id(*args, **kwds))
+            if bind is not None:
+                try:
+                    return _call_with_session(
+                        Session(bind=bind), f, args, kwds)
+                except SQLAlchemyError as e:
+                    if not _is_connection_error(e):
+                        raise
+                    router.failed(bind, e)
+                    if not retry:
+                        raise
+            return _call_with_session(Session(), f, args, kwds)
+        return wrapper
+    return decorator
+
+
 @with_session
 def create_all(session):
     """
@@ -64,5 +244,106 @@ def create_all(session):
 
     :param sqlalchemy.orm.session.Session session: session object injected via
         :py:func:`fpesa.postgres.with_session` decorator.
+
+    If ``partition_size`` is set in the :ref:`config` the table ``message``
+    is created as partitioned table, see :py:func:`create_partitions`. This
+    only affects newly created tables and requires PostgreSQL 11 or newer.
+
+    Indexes added in later versions or by enabling ``contains`` are also
+    created on an existing table, this blocks inserts and can take a while on
+    a large table.
+    """
+    config_postgres = get_config()['postgres']
+    partition_size = config_postgres.getint('partition_size')
+    metadata = Base.metadata
+    if partition_size:
+        # a copy of the tables, the model is shared by all engines
+        metadata = MetaData()
+        for table in Base.metadata.sorted_tables:
+            table.to_metadata(metadata)
+        metadata.tables['message'].dialect_options['postgresql'][
+            'partition_by'] = 'RANGE (id)'
+    metadata.create_all(session.get_bind())
+    # metadata.create_all only creates the indexes of new tables
+    session.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_message_inserted ON message "
+        "USING brin (inserted)"))
+    if partition_size and is_partitioned(session):
+        create_partitions(session)
+    if config_postgres.getboolean('contains'):
+        # only supports the containment operator @>, but is smaller and
+        # faster than the default operator class
+        session.execute(text(
+            "CREATE INDEX IF NOT EXISTS ix_message_message ON message "
+            "USING gin (message jsonb_path_ops)"))
+    if config_postgres.getboolean('search'):
+        create_search(session)
+
+
+def create_search(session):
+    """
+    Adds the column :py:data:`search_column` and its gin index to the table
+    ``message``, unless it already exists. Requires PostgreSQL 12 or newer.
+
+    :param sqlalchemy.orm.session.Session session: database session
+
+    Adding the column rewrites the table while holding an exclusive lock, so
+    on a large table this takes a while.
+    """
+    if session.execute(text(
+            "SELECT count(*) FROM information_schema.columns "
+            "WHERE table_name = 'message' AND column_name = 'search'"))\
+            .scalar():
+        return
+    logger.info("adding column search to table message")
+    session.execute(text(
+        "ALTER TABLE message ADD COLUMN search tsvector GENERATED ALWAYS AS "
+        "(jsonb_to_tsvector('{}', message, '[\"string\", \"numeric\"]')) "
+        "STORED".format(SEARCH_CONFIG)))
+    session.execute(text(
+        "CREATE INDEX ix_message_search ON message USING gin (search)"))
+
+
+def is_partitioned(session):
+    """
+    :param sqlalchemy.orm.session.Session session: database session
+    :rtype: bool
+    :returns: ``True`` if the table ``message`` is a partitioned table
+    """
+    return session.execute(text(
+        "SELECT count(*) FROM pg_partitioned_table "
+        "WHERE partrelid = 'message'::regclass")).scalar() > 0
+
+
+def create_partitions(session, max_id=None):
+    """
+    Makes sure the partitions for the ids up to ``max_id`` and
+    ``partitions_ahead`` more partitions exist.
+
+    :param sqlalchemy.orm.session.Session session: database session
+    :param int max_id: largest id in use, queried if ``None``
+    :rtype: int
+    :returns: the first id that has no partition yet
+
+    Each partition ``message_p<n>`` holds ``partition_size`` ids, starting
+    with the id ``n * partition_size``. Queries that are restricted by id,
+    as :py:func:`fpesa.message.message_get` does with the ``paginationId``,
+    only read the partitions they need. Old messages can be removed by
+    dropping whole partitions.
     """
-    Base.metadata.create_all(session.get_bind())
+    config_postgres = get_config()['postgres']
+    partition_size = config_postgres.getint('partition_size')
+    partitions_ahead = config_postgres.getint('partitions_ahead')
+    if max_id is None:
+        max_id = session.query(func.max(Message.id)).scalar() or 0
+    # several workers may try to create the same partition
+    session.execute(text(
+        "SELECT pg_advisory_xact_lock(hashtext('fpesa_partitions'))"))
+    first = max_id // partition_size
+    last = first + partitions_ahead
+    for n in range(first, last + 1):
+        session.execute(text(
+            'CREATE TABLE IF NOT EXISTS message_p{} PARTITION OF message '
+            'FOR VALUES FROM ({}) TO ({})'.format(
+                n, n * partition_size, (n + 1) * partition_size)))
+    return (last + 1) * partition_size
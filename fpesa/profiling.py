@@ -0,0 +1,194 @@
+"""
+---------
+profiling
+---------
+
+Profilers for every component, enabled with options of ``fpesa``, e.g.
+``fpesa --profile-samples /tmp/stacks.txt liveupdate``:
+
+* ``--profile <file>`` profiles the main thread with :py:mod:`cProfile`,
+  the statistics are written to the file when fpesa exits. Read them with
+  :py:mod:`pstats` or e.g. snakeviz. The overhead is large, so rather not in
+  production.
+* ``--profile-samples <file>`` a :py:class:`Sampler` takes a snapshot of the
+  stacks of all threads every ``sample_interval`` seconds (see ``[profiling]``
+  in the :ref:`config`) and writes the counted stacks every
+  ``--profile-interval`` seconds. The file is in the folded format of
+  flamegraph.pl, speedscope reads it too.
+* ``--slow-callback <seconds>`` logs each callback that blocks the asyncio
+  event loop longer than this, see :py:func:`detect_slow_callbacks`.
+
+The results are also written when fpesa is stopped with ``SIGTERM``.
+"""
+import os
+import sys
+import time
+import signal
+import asyncio
+import cProfile
+import logging
+import threading
+from collections import Counter
+
+from fpesa import metrics
+from fpesa.config import get_config
+
+logger = logging.getLogger(__name__)
+
+SLOW_CALLBACKS = metrics.Counter(
+    'fpesa_slow_callbacks_total',
+    'callbacks that blocked the event loop longer than --slow-callback')
+
+_handle_run = None
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return '{} ({}:{})'.format(
+        code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+
+class Sampler():
+    """
+    Samples the stacks of all other threads from a thread.
+
+    :param str path: file the counted stacks are written to
+    :param float interval: seconds between two samples
+    :param float write_interval: seconds between writing the file
+    """
+    def __init__(self, path, interval=0.01, write_interval=10):
+        self.path = path
+        self.interval = interval
+        self.write_interval = write_interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def sample(self):
+        """
+        count the current stack of each thread
+        """
+        names = {
+            thread.ident: thread.name for thread in threading.enumerate()}
+        own = threading.get_ident()
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(_frame_name(frame))
+                frame = frame.f_back
+            stack.append(names.get(thread_id, str(thread_id)))
+            self.stacks[';'.join(reversed(stack))] += 1
+
+    def write(self):
+        """
+        write the counted stacks, one ``<stack> <count>`` per line
+        """
+        stacks = sorted(self.stacks.items())
+        with open(self.path + '.tmp', 'w') as fo:
+            for stack, count in stacks:
+                fo.write('{} {}\n'.format(stack, count))
+        # readers never see a partially written file
+        os.replace(self.path + '.tmp', self.path)
+
+    def run(self):
+        next_write = time.monotonic() + self.write_interval
+        while not self.stopped.wait(self.interval):
+            self.sample()
+            if time.monotonic() >= next_write:
+                self.write()
+                next_write += self.write_interval
+
+    def start(self):
+        self.thread = threading.Thread(
+            target=self.run, name='sampler', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """
+        stop sampling and write the file
+        """
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.write()
+
+
+def _describe(handle):
+    # the coroutine is more helpful than the callback waking up its task
+    owner = getattr(handle._callback, '__self__', None)
+    if isinstance(owner, asyncio.Task):
+        return repr(owner)
+    return repr(handle)
+
+
+def detect_slow_callbacks(threshold):
+    """
+    Log a warning for each callback of any asyncio event loop of the process
+    that runs longer than ``threshold`` seconds, they are counted in
+    ``fpesa_slow_callbacks_total``. Unlike the debug mode of asyncio this
+    only adds a clock reading per callback.
+
+    :param float threshold: seconds
+    """
+    global _handle_run
+    if _handle_run is None:
+        _handle_run = asyncio.events.Handle._run
+
+    def _run(handle):
+        start = time.monotonic()
+        _handle_run(handle)
+        duration = time.monotonic() - start
+        if duration >= threshold:
+            SLOW_CALLBACKS.inc()
+            logger.warning(
+                "{} blocked the event loop for {:.3f} seconds".format(
+                    _describe(handle), duration))
+
+    asyncio.events.Handle._run = _run
+
+
+def stop_detecting_slow_callbacks():
+    """
+    undo :py:func:`detect_slow_callbacks`
+    """
+    if _handle_run is not None:
+        asyncio.events.Handle._run = _handle_run
+
+
+def start(options):
+    """
+    Start the profilers requested with the options of ``fpesa``.
+
+    :returns: a function that stops them and writes the results
+    """
+    stops = []
+    if options.profile:
+        profile = cProfile.Profile()
+        profile.enable()
+
+        def stop_profile():
+            profile.disable()
+            profile.dump_stats(options.profile)
+            logger.info("wrote profile to {}".format(options.profile))
+        stops.append(stop_profile)
+    if options.profile_samples:
+        sampler = Sampler(
+            options.profile_samples,
+            get_config()['profiling'].getfloat('sample_interval'),
+            options.profile_interval)
+        sampler.start()
+        stops.append(sampler.stop)
+    if options.slow_callback:
+        detect_slow_callbacks(options.slow_callback)
+        stops.append(stop_detecting_slow_callbacks)
+    if stops and signal.getsignal(signal.SIGTERM) == signal.SIG_DFL:
+        # exit through the finally blocks, so the results are written.
+        # event loops may install their own handler later on
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    def stop():
+        for stop_ in stops:
+            stop_()
+    return stop
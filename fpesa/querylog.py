@@ -0,0 +1,134 @@
+"""
+--------
+querylog
+--------
+
+Times every statement sent to the database, see :py:func:`instrument`:
+
+* ``fpesa_db_statement_duration_seconds`` latency of the statements per
+  function using the session, e.g. ``message_get``
+* ``fpesa_db_statements`` statements per call of such a function, an
+  unexpected extra query shows up here
+* statements taking longer than ``slow_query`` seconds (see ``[postgres]``
+  in the :ref:`config`) are logged with their parameters by the logger
+  ``fpesa.querylog``. A share ``explain_sample_rate`` of the slow ``SELECT``
+  statements is logged with the output of ``EXPLAIN (ANALYZE, BUFFERS)``,
+  which runs the statement once more.
+
+The functions are known through :py:func:`track`, which
+:py:func:`fpesa.postgres.with_session` and
+:py:func:`fpesa.postgres.with_read_session` call. Statements outside are
+labeled ``other``.
+"""
+import time
+import random
+import logging
+import threading
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+from fpesa import metrics
+from fpesa.config import get_config
+
+logger = logging.getLogger(__name__)
+
+STATEMENT_DURATION = metrics.Histogram(
+    'fpesa_db_statement_duration_seconds',
+    'time to execute one statement', ['function'])
+STATEMENTS = metrics.Histogram(
+    'fpesa_db_statements', 'statements per call of a function using the '
+    'database', ['function'], buckets=metrics.SIZE_BUCKETS)
+
+MAX_PARAMETERS_LENGTH = 1000
+""" longer parameters are cut in the log """
+
+_local = threading.local()
+
+
+class _Call():
+    def __init__(self, function):
+        self.function = function
+        self.statements = 0
+
+
+@contextmanager
+def track(function):
+    """
+    Count the statements executed by this thread within the block as
+    statements of ``function``.
+
+    :param str function: name of the function
+    """
+    previous = getattr(_local, 'call', None)
+    call = _local.call = _Call(function)
+    try:
+        yield call
+    finally:
+        _local.call = previous
+        STATEMENTS.labels(function).observe(call.statements)
+
+
+def _explain(cursor, statement, parameters):
+    # the raw cursor bypasses the events. a savepoint keeps the transaction
+    # usable if explain fails
+    explain_cursor = cursor.connection.cursor()
+    try:
+        explain_cursor.execute('SAVEPOINT fpesa_explain')
+        try:
+            explain_cursor.execute(
+                'EXPLAIN (ANALYZE, BUFFERS) ' + statement, parameters)
+            plan = '\n'.join(row[0] for row in explain_cursor.fetchall())
+        except Exception as e:
+            explain_cursor.execute('ROLLBACK TO SAVEPOINT fpesa_explain')
+            plan = 'explain failed: {}'.format(e)
+        explain_cursor.execute('RELEASE SAVEPOINT fpesa_explain')
+    finally:
+        explain_cursor.close()
+    return plan
+
+
+def instrument(engine, slow_query=None, explain_sample_rate=None):
+    """
+    Time the statements of ``engine``.
+
+    :param sqlalchemy.engine.Engine engine: engine to instrument
+    :param float slow_query: log statements taking at least this many
+        seconds, 0 means none. Taken from the :ref:`config` if ``None``
+    :param float explain_sample_rate: share of the logged ``SELECT``
+        statements explained, between 0 and 1. Taken from the :ref:`config`
+        if ``None``
+    """
+    config_postgres = get_config()['postgres']
+    if slow_query is None:
+        slow_query = config_postgres.getfloat('slow_query')
+    if explain_sample_rate is None:
+        explain_sample_rate = config_postgres.getfloat('explain_sample_rate')
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(
+            conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('fpesa_statement_start', []).append(
+            time.monotonic())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(
+            conn, cursor, statement, parameters, context, executemany):
+        duration = time.monotonic() - \
+            conn.info['fpesa_statement_start'].pop()
+        call = getattr(_local, 'call', None)
+        function = 'other'
+        if call is not None:
+            call.statements += 1
+            function = call.function
+        STATEMENT_DURATION.labels(function).observe(duration)
+        if not slow_query or duration < slow_query:
+            return
+        text = "slow statement in {}, {:.3f} seconds: {}\nparameters: {}"\
+            .format(function, duration, statement,
+                    repr(parameters)[:MAX_PARAMETERS_LENGTH])
+        if explain_sample_rate and not executemany and \
+                statement.lstrip()[:6].upper() == 'SELECT' and \
+                random.random() < explain_sample_rate:
+            text += '\n' + _explain(cursor, statement, parameters)
+        logger.warning(text)
@@ -8,7 +8,8 @@ Helper functions for RabbitMQ
 import pika
 import aio_pika
 
-from .config import config
+from .config import get_config
+from . import membroker
 
 _connection = None
 
@@ -19,13 +20,14 @@ def open_connection():
 
     :rtype: pika.adapters.blocking_connection.BlockingConnection
     """
+    config_mq = get_config()['rabbitmq']
     return pika.BlockingConnection(pika.ConnectionParameters(
         credentials=pika.credentials.PlainCredentials(
-            config['rabbitmq']['user'],
-            config['rabbitmq']['password'],
+            config_mq['user'],
+            config_mq['password'],
         ),
-        host=config['rabbitmq']['host'],
-        virtual_host=config['rabbitmq']['virtual_host']
+        host=config_mq['host'],
+        virtual_host=config_mq['virtual_host']
     ))
 
 
@@ -34,8 +36,13 @@ async def get_aio_connection(loop=None):
     returns a open connection as defined in the :ref:`config`.
 
     :rytpe: :py:class:`aio_pika.Connection`
+
+    With ``broker: memory`` the connection is to the in-process broker, see
+    :py:mod:`fpesa.membroker`.
     """
-    config_mq = config['rabbitmq']
+    config_mq = get_config()['rabbitmq']
+    if config_mq['broker'] == 'memory':
+        return await membroker.get_broker().connect()
     connection = await aio_pika.connect_robust(
         host=config_mq['host'],
         virtualhost=config_mq['virtual_host'],
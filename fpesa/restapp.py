@@ -7,17 +7,23 @@ concrete config for :ref:`generic-restmapper`
 """
 import aiohttp
 
+from fpesa.config import get_config
 from fpesa.restmapper import Endpoint, FireAndForgetAdapter
-from fpesa.restmapper import RequestResponseAdapter
+from fpesa.restmapper import RequestResponseAdapter, LongPollAdapter
+from fpesa.restmapper import StreamingAdapter
 from fpesa.restmapper import get_app as r2b_get_app
 
+DATETIME_PATTERN = \
+    '^[0-9]{4}-[0-9]{2}-[0-9]{2}([T ][0-9]{2}:[0-9]{2}[0-9:.]*)?$'
+
 
 def get_endpoints():
     """
     :return: defined rest endpoints
     :rtype: list(fpesa.restmapper.Endpoint)
     """
-    return [
+    config = get_config()
+    endpoints = [
         Endpoint(
             '/messages/', 'POST', FireAndForgetAdapter(),
             schema_req_data={
@@ -25,7 +31,12 @@ def get_endpoints():
             },
         ),
         Endpoint(
-            '/messages/', 'GET', RequestResponseAdapter(),
+            '/messages/', 'GET',
+            LongPollAdapter(
+                '/messages/:POST',
+                is_empty=lambda response: not response['messages'],
+                max_wait=config['restmapper'].getint('max_wait'),
+            ),
             schema_req_args={
                 'type': 'object',
                 'additionalProperties': False,
@@ -34,10 +45,48 @@ def get_endpoints():
                     'offset': {'type': 'string', 'pattern': '^[0-9]+$'},
                     'limit': {'type': 'string', 'pattern': '^[0-9]+$'},
                     'paginationId': {'type': 'string', 'pattern': '^[0-9]+$'},
+                    'afterId': {'type': 'string', 'pattern': '^[0-9]+$'},
+                    'wait': {'type': 'string', 'pattern': '^[0-9]+$'},
+                    'since': {'type': 'string', 'pattern': DATETIME_PATTERN},
+                    'until': {'type': 'string', 'pattern': DATETIME_PATTERN},
+                    'contains': {'type': 'string'},
+                    'fields': {'type': 'string', 'minLength': 1},
+                },
+            },
+        ),
+        Endpoint(
+            '/messages/export', 'GET',
+            StreamingAdapter(
+                timeout=config['restmapper'].getfloat('stream_timeout')),
+            schema_req_args={
+                'type': 'object',
+                'additionalProperties': False,
+                'properties': {
+                    'afterId': {'type': 'string', 'pattern': '^[0-9]+$'},
+                    'paginationId': {'type': 'string', 'pattern': '^[0-9]+$'},
+                    'since': {'type': 'string', 'pattern': DATETIME_PATTERN},
+                    'until': {'type': 'string', 'pattern': DATETIME_PATTERN},
                 },
             },
-        )
+        ),
     ]
+    if config['postgres'].getboolean('search'):
+        endpoints.append(Endpoint(
+            '/messages/search', 'GET', RequestResponseAdapter(),
+            schema_req_args={
+                'type': 'object',
+                'additionalProperties': False,
+                'required': ['q', 'offset', 'limit'],
+                'properties': {
+                    'q': {'type': 'string', 'minLength': 1},
+                    'offset': {'type': 'string', 'pattern': '^[0-9]+$'},
+                    'limit': {'type': 'string', 'pattern': '^[0-9]+$'},
+                    'paginationId': {'type': 'string', 'pattern': '^[0-9]+$'},
+                    'fields': {'type': 'string', 'minLength': 1},
+                },
+            },
+        ))
+    return endpoints
 
 
 def get_app():
@@ -14,6 +14,7 @@ call :func:`get_app` to get a :py:class:`aiohttp.web.Application`
 """
 
 import json
+import asyncio
 import logging
 import uuid
 
@@ -23,9 +24,30 @@ from aiohttp.web import json_response
 import aio_pika
 
 from . import rabbitmq
+from . import metrics
+from . import tracing
 
 logger = logging.getLogger(__name__)
 
+ERROR_STATUS = {
+    400: web.HTTPBadRequest,
+    502: web.HTTPBadGateway,
+    504: web.HTTPGatewayTimeout,
+}
+""" error codes of the workers used as status of the response, see
+:py:meth:`Adapter.adapt` """
+
+REQUEST_DURATION = metrics.Histogram(
+    'fpesa_http_request_duration_seconds',
+    'time to answer a http request', ['endpoint'])
+REQUESTS_IN_FLIGHT = metrics.Gauge(
+    'fpesa_http_requests_in_flight',
+    'http requests currently handled', ['endpoint'])
+RPC_DURATION = metrics.Histogram(
+    'fpesa_rpc_duration_seconds',
+    'time from sending a request to the worker until the response arrived',
+    ['endpoint'])
+
 
 class Endpoint():
     """
@@ -34,8 +56,9 @@ class Endpoint():
     :param str path: rest endpoint path
     :param str method: allowed method
     :param Adapter adapter: how to map the incoming request? currently
-        :py:class:`FireAndForgetAdapter` and :py:class:`RequestResponseAdapter`
-        are available
+        :py:class:`FireAndForgetAdapter`, :py:class:`RequestResponseAdapter`,
+        :py:class:`LongPollAdapter` and :py:class:`StreamingAdapter` are
+        available
     :param dict schema_req_data: a jsonschema describing the valid request body
     :param dict schema_req_args: a jsonschema describing the valid request
         parameters. please note that the request arguments are mapped into a
@@ -51,6 +74,9 @@ class Endpoint():
         self.adapter = adapter
         self.schema_req_data = schema_req_data
         self.schema_req_args = schema_req_args
+        name = "{}:{}".format(path, method.upper())
+        self._request_duration = REQUEST_DURATION.labels(name)
+        self._requests_in_flight = REQUESTS_IN_FLIGHT.labels(name)
 
     async def close(self):
         """
@@ -76,23 +102,33 @@ class Endpoint():
 
         If it can not be parsed returns an error message.
         """
+        self._requests_in_flight.inc()
+        try:
+            with self._request_duration.time():
+                return await self._handle_request(request)
+        finally:
+            self._requests_in_flight.dec()
+
+    async def _handle_request(self, request):
         data = None
         if self.schema_req_data is not None:
             try:
                 data = await request.json()
             except json.JSONDecodeError as e:
-                raise web.HTTPInternalServerError(
-                    reason='Can not parse request body as JSON: ' + str(e))
+                raise http_error(
+                    web.HTTPInternalServerError,
+                    'Can not parse request body as JSON: ' + str(e))
             try:
                 jsonschema.validate(data, self.schema_req_data)
             except jsonschema.ValidationError as e:
-                raise web.HTTPInternalServerError(
-                    reason='Can not validate request data json '
+                raise http_error(
+                    web.HTTPInternalServerError,
+                    'Can not validate request data json '
                     'according to schema:\n' + str(e))
         else:
             if request.has_body:
-                raise web.HTTPInternalServerError(
-                    reason='No request data allowed')
+                raise http_error(
+                    web.HTTPInternalServerError, 'No request data allowed')
 
         request_args = None
         if self.schema_req_args is not None:
@@ -100,15 +136,17 @@ class Endpoint():
             try:
                 jsonschema.validate(request_args, self.schema_req_args)
             except jsonschema.ValidationError as e:
-                raise web.HTTPInternalServerError(
-                    reason='Can not validate request arguments '
+                raise http_error(
+                    web.HTTPInternalServerError,
+                    'Can not validate request arguments '
                     'according to schema:\n' + str(e))
         else:
             if request.query:
-                raise web.HTTPInternalServerError(
-                    reason='No request arguments allowed')
+                raise http_error(
+                    web.HTTPInternalServerError,
+                    'No request arguments allowed')
 
-        return json_response(await self.adapter.adapt(data, request_args))
+        return await self.adapter.respond(request, data, request_args)
 
 
 class Adapter():
@@ -140,16 +178,30 @@ class Adapter():
 
             {
                 "error": {
+                    "code": <int>,
                     "description": <string>
                 }
             }
 
         If the response contains the key ``error`` the status code of the rest
-        response will be set to 500. And the schema shown above will be
-        assumed.
+        response will be set to ``code`` if it is one of
+        :py:data:`ERROR_STATUS`, otherwise to 500. And the schema shown above
+        will be assumed.
         """
         raise NotImplementedError()
 
+    async def respond(self, request, request_data, request_args):
+        """
+        Create the http response, by default the result of :py:meth:`adapt`
+        as json.
+
+        :param aiohttp.web.Request request: HTTP request
+        :param dict request_data: holds contents of request data
+        :param dict request_args: holds contents of request arguments
+        :rtype: aiohttp.web.StreamResponse
+        """
+        return json_response(await self.adapt(request_data, request_args))
+
     def get_endpoint_name(self):
         """
         :rtype: string
@@ -197,6 +249,7 @@ class FireAndForgetAdapter(Adapter):
                 aio_pika.Message(json.dumps({
                     'data': request_data,
                     'args': request_args,
+                    'trace': tracing.start('restmapper'),
                 }).encode('utf-8')),
                 routing_key='',
             )
@@ -241,36 +294,302 @@ class RequestResponseAdapter(Adapter):
         self.response_queue = await self.channel.declare_queue(exclusive=True)
         await self.response_queue.bind(self.response_exchange)
 
+        self._rpc_duration = RPC_DURATION.labels(self.get_endpoint_name())
+
+        # one consumer hands the responses to the waiting requests, so
+        # concurrent requests don't consume each others responses.
+        self._responses = {}
+        self._response_consumer = asyncio.ensure_future(
+            self._consume_responses())
+
+    async def _consume_responses(self):
+        async with self.response_queue.iterator() as q:
+            async for message in q:
+                with message.process():
+                    correlation_id = message.correlation_id
+                    if isinstance(correlation_id, bytes):
+                        correlation_id = correlation_id.decode()
+                    future = self._responses.pop(correlation_id, None)
+                    if future is not None and not future.done():
+                        future.set_result(message.body)
+
     async def adapt(self, request_data, request_args):
         """
         Send the message to RabbitMQ and return the response
         """
-        correlation_id = uuid.uuid4().hex.encode()
+        correlation_id = uuid.uuid4().hex
+        response = asyncio.Future()
+        self._responses[correlation_id] = response
+
+        try:
+            with self._rpc_duration.time():
+                await self.exchange.publish(
+                    aio_pika.Message(
+                        json.dumps({
+                            'data': request_data,
+                            'args': request_args,
+                            'trace': tracing.start('restmapper'),
+                        }).encode('utf-8'),
+                        reply_to=self.response_queue.name,
+                        correlation_id=correlation_id,
+                    ),
+                    routing_key=self.get_endpoint_name(),
+                )
+
+                logger.info(
+                    "waiting for rpc response in {}".format(
+                        self.response_queue.name))
+                # TODO: timeout!
+                body = await response
+        finally:
+            self._responses.pop(correlation_id, None)
 
-        await self.exchange.publish(
-            aio_pika.Message(
-                json.dumps({
-                    'data': request_data,
-                    'args': request_args,
-                }).encode('utf-8'),
-                reply_to=self.response_queue.name,
-                correlation_id=correlation_id,
-            ),
-            routing_key=self.get_endpoint_name(),
-        )
+        result = json.loads(body.decode())
+        if 'error' in result:
+            raise worker_error(result['error'])
+        return result
 
-        logger.info(
-            "waiting for rpc response in {}".format(self.response_queue.name))
-        async with self.response_queue.iterator() as q:
+    async def close(self):
+        """
+        Stops consuming responses and closes the channel.
+        """
+        self._response_consumer.cancel()
+        await super().close()
+
+
+class LongPollAdapter(RequestResponseAdapter):
+    """
+    Like :py:class:`RequestResponseAdapter`, but if the request argument
+    ``wait`` is given and the response is empty, the request is held for up
+    to ``wait`` seconds until a message arrives on the fanout exchange
+    ``notify_exchange``. Then the request is sent again.
+
+    :param str notify_exchange: name of a fanout exchange, each message on
+        this exchange means there may be new data
+    :param callable is_empty: gets the response, returns ``True`` if the
+        request should wait for new data
+    :param int max_wait: upper limit for ``wait`` in seconds
+    :param float notify_delay: seconds to wait after a notification before
+        sending the request again, the notification may arrive before the
+        data is visible to the worker.
+
+    All waiting requests of this adapter share one queue bound to
+    ``notify_exchange``, the worker is only asked again when something
+    happened and not in a loop.
+    """
+    def __init__(
+            self, notify_exchange, is_empty, max_wait=30, notify_delay=0.1):
+        self.notify_exchange = notify_exchange
+        self.is_empty = is_empty
+        self.max_wait = max_wait
+        self.notify_delay = notify_delay
+
+    async def init(self, endpoint):
+        """
+        initialize channel, exchange and notification queue
+        """
+        await super().init(endpoint)
+        self._notified = asyncio.Future()
+        exchange = await self.channel.declare_exchange(
+            self.notify_exchange,
+            type=aio_pika.exchange.ExchangeType.FANOUT)
+        self.notify_queue = await self.channel.declare_queue(
+            exclusive=True, auto_delete=True,
+            # only the latest notification matters
+            arguments={'x-max-length': 1, 'x-overflow': 'drop-head'})
+        await self.notify_queue.bind(exchange)
+        self._notify_consumer = asyncio.ensure_future(
+            self._consume_notifications())
+
+    async def _consume_notifications(self):
+        async with self.notify_queue.iterator(no_ack=True) as q:
             async for message in q:
-                # TODO: timeout!
+                # wake up all waiting requests at once
+                notified, self._notified = self._notified, asyncio.Future()
+                notified.set_result(None)
+
+    async def adapt(self, request_data, request_args):
+        """
+        Send the message to RabbitMQ and return the response, wait for new
+        data if requested.
+        """
+        loop = asyncio.get_event_loop()
+        wait = min(self.max_wait, int((request_args or {}).get('wait', 0)))
+        deadline = loop.time() + wait
+        while True:
+            # take the future before sending the request, so a notification
+            # that arrives in between is not missed
+            notified = self._notified
+            result = await super().adapt(request_data, request_args)
+            timeout = deadline - loop.time()
+            if timeout <= 0 or not self.is_empty(result):
+                return result
+            try:
+                await asyncio.wait_for(asyncio.shield(notified), timeout)
+            except asyncio.TimeoutError:
+                return result
+            await asyncio.sleep(self.notify_delay)
+
+    async def close(self):
+        """
+        Stops consuming notifications and closes the channel.
+        """
+        self._notify_consumer.cancel()
+        await super().close()
+
+
+class StreamingAdapter(Adapter):
+    """
+    Like :py:class:`RequestResponseAdapter`, but the worker answers with a
+    sequence of messages. The body of each message with the type ``chunk``
+    is written to the http response as soon as it arrives. A message with
+    the type ``end`` finishes the response, its body is a json object that
+    may hold an ``error`` as described in :py:meth:`Adapter.adapt`.
+
+    :param str content_type: content type of the http response
+    :param int prefetch_count: chunks held by the restmapper per request,
+        the others wait in rabbitmq until the client read them
+    :param float timeout: seconds to wait for the next message of the
+        worker
+
+    Each request gets its own response queue, named by ``reply_to``, so the
+    chunks of one request are acknowledged as they are written to the
+    client. If an error occurs after the response was started, it is
+    written as the last line ``{"error": {...}}``.
+
+    If the client disconnects, the worker does not answer in time or the
+    response queue ends without an ``end`` message, the ``correlation_id``
+    of the request is published to the fanout exchange ``RPC:cancel``, so
+    the worker can stop.
+    """
+    def __init__(
+            self, content_type='application/x-ndjson', prefetch_count=4,
+            timeout=60):
+        self.content_type = content_type
+        self.prefetch_count = prefetch_count
+        self.timeout = timeout
+
+    async def init(self, endpoint):
+        """
+        initialize channel and exchanges
+        """
+        await super().init(endpoint)
+        self.exchange = await self.channel.declare_exchange(
+            self.get_endpoint_name(),
+            type=aio_pika.exchange.ExchangeType.DIRECT)
+        queue = await self.channel.declare_queue(
+                self.get_endpoint_name())
+        await queue.bind(self.exchange)
+        await self.channel.declare_exchange(
+            'RPC',
+            type=aio_pika.exchange.ExchangeType.DIRECT)
+        self.cancel_exchange = await self.channel.declare_exchange(
+            'RPC:cancel',
+            type=aio_pika.exchange.ExchangeType.FANOUT)
+
+    async def _cancel(self, correlation_id):
+        try:
+            await self.cancel_exchange.publish(
+                aio_pika.Message(b'', correlation_id=correlation_id),
+                routing_key='')
+        except Exception:
+            logger.exception('could not cancel {}'.format(correlation_id))
+
+    async def _stream(self, request, response, queue):
+        # writes the chunks, returns the result of the end message or None
+        # if there is none
+        async with queue.iterator() as q:
+            while True:
+                try:
+                    message = await asyncio.wait_for(
+                        q.__anext__(), self.timeout)
+                except StopAsyncIteration:
+                    return None
                 with message.process():
-                    if message.correlation_id == correlation_id:
-                        result = json.loads(message.body.decode())
-                        if 'error' in result:
-                            raise web.HTTPInternalServerError(
-                                reason=result['error']['reason'])
-                        return result
+                    if message.type == 'end':
+                        return json.loads(message.body.decode())
+                    if not response.prepared:
+                        await response.prepare(request)
+                    await response.write(message.body)
+
+    async def respond(self, request, request_data, request_args):
+        """
+        Send the message to RabbitMQ and stream the responses
+        """
+        response = web.StreamResponse(
+            headers={'Content-Type': self.content_type})
+        correlation_id = uuid.uuid4().hex
+        channel = await self.endpoint.rabbitmq_connection.channel()
+        try:
+            await channel.set_qos(prefetch_count=self.prefetch_count)
+            queue = await channel.declare_queue(
+                exclusive=True, auto_delete=True)
+            await queue.bind('RPC')
+            await self.exchange.publish(
+                aio_pika.Message(
+                    json.dumps({
+                        'data': request_data,
+                        'args': request_args,
+                        'trace': tracing.start('restmapper'),
+                    }).encode('utf-8'),
+                    reply_to=queue.name,
+                    correlation_id=correlation_id,
+                ),
+                routing_key=self.get_endpoint_name(),
+            )
+            try:
+                result = await self._stream(request, response, queue)
+            except asyncio.TimeoutError:
+                result = {'error': {
+                    'code': 504,
+                    'description': 'no answer from the worker within {} '
+                                   'seconds'.format(self.timeout)}}
+                await self._cancel(correlation_id)
+            if result is None:
+                result = {'error': {
+                    'code': 502,
+                    'description': 'the response ended unexpectedly'}}
+                await self._cancel(correlation_id)
+        except (ConnectionResetError, asyncio.CancelledError):
+            # the client is gone
+            await self._cancel(correlation_id)
+            raise
+        finally:
+            await channel.close()
+
+        if 'error' in result:
+            if not response.prepared:
+                raise worker_error(result['error'])
+            await response.write(json.dumps(result).encode() + b'\n')
+        if not response.prepared:
+            await response.prepare(request)
+        await response.write_eof()
+        return response
+
+
+def http_error(exception_class, description):
+    """
+    :param type exception_class: a :py:class:`aiohttp.web.HTTPException`
+    :param str description: sent to the client as described in
+        :py:meth:`Adapter.adapt`, it may span several lines
+    :rtype: aiohttp.web.HTTPException
+    """
+    # aiohttp does not allow line breaks in the reason phrase, so the
+    # description is only used for the json body
+    error = exception_class()
+    error.description = description
+    return error
+
+
+def worker_error(error):
+    """
+    :param dict error: the error answered by a worker, see
+        :py:meth:`Adapter.adapt`
+    :rtype: aiohttp.web.HTTPException
+    """
+    return http_error(
+        ERROR_STATUS.get(error.get('code'), web.HTTPInternalServerError),
+        error['description'])
 
 
 def json_error(code, description):
@@ -287,7 +606,8 @@ async def error_middleware(request, handler):
     try:
         return await handler(request)
     except web.HTTPException as ex:
-        return json_error(ex.status, ex.reason)
+        return json_error(
+            ex.status, getattr(ex, 'description', ex.reason))
 
 
 def get_app(endpoints):
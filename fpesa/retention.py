@@ -0,0 +1,253 @@
+"""
+---------
+retention
+---------
+
+Removes old messages from the database, run it regularly with ``fpesa
+retention``. Messages are removed in small transactions with a pause in
+between, so inserting new messages is not blocked. If the table is
+partitioned, partitions that only hold old messages are dropped as a whole.
+"""
+import re
+import time
+import datetime
+import logging
+
+from sqlalchemy import text, func
+from sqlalchemy.exc import OperationalError
+
+from fpesa.config import get_config
+from fpesa.postgres import Session, Message
+from fpesa.archive import SegmentWriter
+
+logger = logging.getLogger(__name__)
+
+BOUND_RE = re.compile(r'FOR VALUES FROM \((\d+)\) TO \((\d+)\)')
+
+
+def keep_from_id(session, max_age=0, max_rows=0):
+    """
+    :param sqlalchemy.orm.session.Session session: database session
+    :param float max_age: maximum age of a message in days, 0 means no limit
+    :param int max_rows: maximum number of messages, 0 means no limit
+    :rtype: int
+    :returns: the smallest id that is kept or ``None`` if all messages are
+        kept
+    """
+    bounds = []
+    if max_rows:
+        bounds.append(session.query(Message.id)
+                      .order_by(Message.id.desc())
+                      .offset(max_rows - 1)
+                      .limit(1)
+                      .scalar())
+    if max_age:
+        # the brin index only has to look at the most recent block ranges
+        oldest = func.now() - datetime.timedelta(days=max_age)
+        keep_from = session.query(func.min(Message.id))\
+            .filter(Message.inserted >= oldest)\
+            .scalar()
+        if keep_from is None:
+            max_id = session.query(func.max(Message.id)).scalar()
+            keep_from = None if max_id is None else max_id + 1
+        bounds.append(keep_from)
+    bounds = [bound for bound in bounds if bound is not None]
+    return max(bounds) if bounds else None
+
+
+def _partitions(session):
+    # name, first id and the id after the last id of each partition
+    result = session.execute(text(
+        "SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) "
+        "FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = 'message'::regclass"))
+    partitions = []
+    for name, bound in result:
+        match = BOUND_RE.match(bound)
+        if match is not None:
+            partitions.append(
+                (name, int(match.group(1)), int(match.group(2))))
+    return sorted(partitions, key=lambda partition: partition[1])
+
+
+def _export_partition(name, batch_size, segment):
+    last_id = -1
+    while True:
+        session = Session()
+        try:
+            rows = session.execute(text(
+                'SELECT id, inserted, message FROM {} WHERE id > :last_id '
+                'ORDER BY id LIMIT :limit'.format(name)),
+                {'last_id': last_id, 'limit': batch_size}).fetchall()
+        finally:
+            session.close()
+        if not rows:
+            return
+        segment.write(rows)
+        last_id = rows[-1][0]
+
+
+def drop_partitions(keep_from, batch_size, segment=None):
+    """
+    Drop the partitions that only hold messages with ids below
+    ``keep_from``.
+
+    :param int keep_from: see :py:func:`keep_from_id`
+    :param int batch_size: messages exported at once
+    :param SegmentWriter segment: export messages before dropping
+    :rtype: dict
+    :returns: ``rows`` and ``bytes`` removed
+
+    A partition is detached first, then exported and dropped. If it can not
+    be detached, nothing of it was exported and the remaining messages are
+    left to :py:func:`delete_messages`, so no message is exported twice.
+    """
+    result = {'rows': 0, 'bytes': 0}
+    session = Session()
+    try:
+        partitions = _partitions(session)
+    finally:
+        session.close()
+    for name, first_id, end_id in partitions:
+        if end_id > keep_from:
+            break
+        session = Session()
+        try:
+            rows, size = session.execute(text(
+                'SELECT count(*), pg_total_relation_size(:name) '
+                'FROM {}'.format(name)), {'name': name}).one()
+            # don't wait for long running queries, as message_post would
+            # have to wait too
+            session.execute(text("SET LOCAL lock_timeout = '1s'"))
+            session.execute(text(
+                'ALTER TABLE message DETACH PARTITION {}'.format(name)))
+            session.commit()
+        except OperationalError:
+            session.rollback()
+            logger.warning(
+                "could not detach partition {}, deleting rows instead"
+                .format(name))
+            break
+        finally:
+            session.close()
+        if segment is not None:
+            try:
+                _export_partition(name, batch_size, segment)
+            except Exception:
+                logger.error(
+                    "partition {} is detached, but could not be exported"
+                    .format(name))
+                raise
+        session = Session()
+        try:
+            session.execute(text('DROP TABLE {}'.format(name)))
+            session.commit()
+        finally:
+            session.close()
+        logger.info("dropped partition {}".format(name))
+        result['rows'] += rows
+        result['bytes'] += size
+    return result
+
+
+def delete_messages(keep_from, batch_size, sleep, segment=None):
+    """
+    Delete the messages with ids below ``keep_from``, ``batch_size`` at a
+    time, sleeping ``sleep`` seconds between the transactions.
+
+    :param int keep_from: see :py:func:`keep_from_id`
+    :param int batch_size: messages deleted in one transaction
+    :param float sleep: seconds to sleep between the transactions
+    :param SegmentWriter segment: export messages before they are deleted
+    :rtype: dict
+    :returns: ``rows`` and ``bytes`` removed. The space is reused for new
+        messages after the table was vacuumed.
+    """
+    result = {'rows': 0, 'bytes': 0}
+    while True:
+        session = Session()
+        try:
+            rows = session.execute(text(
+                'DELETE FROM message WHERE id IN ('
+                'SELECT id FROM message WHERE id < :keep_from '
+                'ORDER BY id LIMIT :limit) '
+                'RETURNING id, inserted, message, '
+                'pg_column_size(message.*)'),
+                {'keep_from': keep_from, 'limit': batch_size}).fetchall()
+            rows.sort(key=lambda row: row[0])
+            if segment is not None and rows:
+                # the messages are on disk before they are deleted
+                segment.write(row[:3] for row in rows)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+        result['rows'] += len(rows)
+        result['bytes'] += sum(row[3] for row in rows)
+        if len(rows) < batch_size:
+            return result
+        time.sleep(sleep)
+
+
+def retention(
+        max_age=0, max_rows=0, batch_size=1000, sleep=0.1,
+        export_directory=None, segment_size=1000000):
+    """
+    Remove messages older than ``max_age`` days and all but the newest
+    ``max_rows`` messages.
+
+    :param float max_age: see :py:func:`keep_from_id`
+    :param int max_rows: see :py:func:`keep_from_id`
+    :param int batch_size: see :py:func:`delete_messages`
+    :param float sleep: see :py:func:`delete_messages`
+    :param str export_directory: write the messages to segment files in this
+        directory before removing them, see
+        :py:class:`fpesa.archive.SegmentWriter`
+    :param int segment_size: messages per segment file
+    :rtype: dict
+    :returns: ``rows`` and ``bytes`` removed
+    """
+    session = Session()
+    try:
+        keep_from = keep_from_id(session, max_age, max_rows)
+    finally:
+        session.close()
+    result = {'rows': 0, 'bytes': 0}
+    if keep_from is None:
+        return result
+    logger.info("removing messages with id < {}".format(keep_from))
+    segment = None
+    if export_directory:
+        segment = SegmentWriter(export_directory, segment_size)
+    try:
+        for removed in (
+                drop_partitions(keep_from, batch_size, segment),
+                delete_messages(keep_from, batch_size, sleep, segment)):
+            result['rows'] += removed['rows']
+            result['bytes'] += removed['bytes']
+    finally:
+        if segment is not None:
+            segment.close()
+    return result
+
+
+def main(options):
+    config_retention = get_config()['retention']
+
+    def option(name, convert):
+        value = getattr(options, name)
+        if value is None:
+            value = convert(name)
+        return value
+
+    result = retention(
+        max_age=option('max_age', config_retention.getfloat),
+        max_rows=option('max_rows', config_retention.getint),
+        batch_size=option('batch_size', config_retention.getint),
+        sleep=option('sleep', config_retention.getfloat),
+        export_directory=option('export_directory', config_retention.get),
+        segment_size=config_retention.getint('segment_size'),
+    )
+    print("removed {rows} messages, {bytes} bytes".format(**result))
@@ -0,0 +1,88 @@
+"""
+-------
+tracing
+-------
+
+The restmapper adds a trace to each envelope it puts on the message bus::
+
+    "trace": {"id": <hex>, "stages": [["restmapper", <unix time>], ...]}
+
+Each component that handles the envelope appends its stages with
+:py:func:`stage`:
+
+* ``restmapper`` the request arrived
+* ``messages_post`` the worker received the message, ``committed`` it is in
+  the database
+* ``messages_get`` the worker received the request, ``answered`` the
+  response is about to be sent
+* ``liveupdate`` liveupdate received the message, from the bus or from the
+  database notification, ``delivered`` it was sent to all websockets
+
+The histograms ``fpesa_trace_stage_seconds`` (time since the previous
+stage) and ``fpesa_trace_seconds`` (time since the request arrived) show
+where the time goes, see :py:mod:`fpesa.metrics`. With ``sample_rate`` in
+the ``[tracing]`` section of the :ref:`config` a share of the finished
+traces is logged as json by the logger ``fpesa.tracing``.
+
+The timestamps of different hosts are only comparable if their clocks are
+synchronized.
+"""
+import json
+import time
+import uuid
+import random
+import logging
+
+from fpesa import metrics
+from fpesa.config import get_config
+
+logger = logging.getLogger(__name__)
+
+STAGE_SECONDS = metrics.Histogram(
+    'fpesa_trace_stage_seconds',
+    'time from the previous stage of a trace to this stage', ['stage'])
+TRACE_SECONDS = metrics.Histogram(
+    'fpesa_trace_seconds',
+    'time from the start of a trace to this stage', ['stage'])
+
+
+def start(name):
+    """
+    :param str name: name of the first stage
+    :rtype: dict
+    :returns: a new trace
+    """
+    return {'id': uuid.uuid4().hex, 'stages': [[name, time.time()]]}
+
+
+def stage(trace, name, last=False):
+    """
+    Append a stage to ``trace`` and observe its latency.
+
+    :param dict trace: the trace of an envelope, may be ``None`` for
+        envelopes without trace
+    :param str name: name of the stage
+    :param bool last: the trace is finished in this process, it may be
+        logged
+    :rtype: dict
+    :returns: ``trace``
+    """
+    if trace is None:
+        return None
+    now = time.time()
+    stages = trace['stages']
+    STAGE_SECONDS.labels(name).observe(now - stages[-1][1])
+    TRACE_SECONDS.labels(name).observe(now - stages[0][1])
+    stages.append([name, now])
+    if last:
+        sample_rate = get_config()['tracing'].getfloat('sample_rate')
+        if sample_rate and random.random() < sample_rate:
+            start_time = stages[0][1]
+            logger.info(json.dumps({
+                'trace': trace['id'],
+                'start': start_time,
+                'stages': [
+                    [stage_name, round(stage_time - start_time, 6)]
+                    for stage_name, stage_time in stages],
+            }))
+    return trace
@@ -0,0 +1,61 @@
+import os
+import datetime
+import tempfile
+from unittest import TestCase
+
+from fpesa import archive
+
+
+class TestArchive(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.directory = self.tmp.name
+        inserted = datetime.datetime(2018, 1, 1)
+        writer = archive.SegmentWriter(self.directory, 250)
+        # ids with gaps, written in batches that don't match the blocks
+        ids = list(range(1, 1000, 2))
+        for i in range(0, len(ids), 70):
+            writer.write(
+                (message_id, inserted, {'a': message_id})
+                for message_id in ids[i:i + 70])
+        writer.close()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_segments(self):
+        self.assertEqual(
+            sorted(os.listdir(self.directory)),
+            ['messages-1-499.idx', 'messages-1-499.ndjson.gz',
+             'messages-501-999.idx', 'messages-501-999.ndjson.gz'])
+
+    def test_count(self):
+        a = archive.Archive(self.directory)
+        a.refresh()
+        self.assertEqual(len(a), 500)
+        self.assertEqual(a.count(0), 0)
+        self.assertEqual(a.count(1), 1)
+        self.assertEqual(a.count(600), 300)
+        self.assertEqual(a.count(10000), 500)
+
+    def test_newest(self):
+        a = archive.Archive(self.directory)
+        a.refresh()
+        self.assertEqual(
+            a.newest(600, 0, 3), [{'a': 599}, {'a': 597}, {'a': 595}])
+        # crosses the segment boundary
+        self.assertEqual(
+            a.newest(600, 49, 3), [{'a': 501}, {'a': 499}, {'a': 497}])
+        self.assertEqual(a.newest(600, 298, 5), [{'a': 3}, {'a': 1}])
+        self.assertEqual(a.newest(600, 300, 5), [])
+
+    def test_refresh(self):
+        a = archive.Archive(self.directory)
+        a.refresh()
+        writer = archive.SegmentWriter(self.directory, 250)
+        writer.write([(1001, datetime.datetime(2018, 1, 1), {'a': 1001})])
+        self.assertEqual(len(a), 500)  # still writing
+        writer.close()
+        a.refresh()
+        self.assertEqual(len(a), 501)
+        self.assertEqual(a.newest(2000, 0, 1), [{'a': 1001}])
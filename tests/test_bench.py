@@ -0,0 +1,80 @@
+import json
+import zlib
+import asyncio
+from unittest import TestCase
+
+from fpesa import bench
+
+
+class TestBench(TestCase):
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(bench.percentile(values, 50), 50)
+        self.assertEqual(bench.percentile(values, 99), 99)
+        self.assertEqual(bench.percentile(values, 99.9), 100)
+        self.assertEqual(bench.percentile([7], 50), 7)
+        self.assertIsNone(bench.percentile([], 50))
+
+    def test_summarize(self):
+        result = bench.summarize(
+            'test', {'stage': 'post'}, [0.3, 0.1, 0.2], 2, errors=1)
+        self.assertEqual(result['count'], 3)
+        self.assertEqual(result['errors'], 1)
+        self.assertEqual(result['per_second'], 1.5)
+        self.assertEqual(result['p50'], 0.2)
+        self.assertEqual(result['max'], 0.3)
+        self.assertEqual(result['params'], {'stage': 'post'})
+        json.dumps(result)
+
+    def test_open_loop(self):
+        stage = bench.Stage('test')
+        calls = []
+
+        async def request():
+            calls.append(None)
+            if len(calls) % 5 == 0:
+                raise RuntimeError()
+            await asyncio.sleep(0.05)
+
+        loop = asyncio.new_event_loop()
+        try:
+            # the requests take longer than the interval between them, with
+            # an open loop they overlap
+            start = loop.time()
+            loop.run_until_complete(bench.open_loop(
+                request, rate=100, duration=0.2, stage=stage))
+            duration = loop.time() - start
+        finally:
+            loop.close()
+        self.assertEqual(len(calls), 20)
+        self.assertEqual(stage.errors, 4)
+        self.assertEqual(len(stage.latencies), 16)
+        self.assertLess(duration, 0.5)
+        self.assertGreaterEqual(min(stage.latencies), 0.05)
+
+    def test_open_loop_dropped(self):
+        stage = bench.Stage('test')
+
+        async def request():
+            await asyncio.sleep(0.1)
+
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(bench.open_loop(
+                request, rate=100, duration=0.05, stage=stage,
+                max_in_flight=2))
+        finally:
+            loop.close()
+        self.assertEqual(len(stage.latencies), 2)
+        self.assertEqual(stage.dropped, 3)
+
+    def test_decode_frame(self):
+        message = {'bench': 'a', 'sent': 1}
+        text = json.dumps(message)
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+        compressed = compressor.compress(text.encode()) + compressor.flush()
+        for frame in (
+                text, text.encode(), compressed,
+                '[{}]'.format(text),
+                '[{{"id": 1, "data": {}}}]'.format(text)):
+            self.assertEqual(bench.decode_frame(frame), [message])
@@ -1,4 +1,7 @@
+import sys
+import subprocess
 from unittest import TestCase, mock
+
 from fpesa.cli import main
 
 
@@ -16,3 +19,22 @@ class TestCli(TestCase):
         self.assertEqual(10, config_patch.call_args[1]['level'])
         main(['fpesa', '-q', '-q', '-q', '-q'])
         self.assertEqual(50, config_patch.call_args[1]['level'])
+
+    @mock.patch('fpesa.message.messages_get_worker_async')
+    @mock.patch('logging.basicConfig')
+    def test_messages_get_concurrency(self, config_patch, worker_patch):
+        main(['fpesa', 'messages_get', '--concurrency', '4'])
+        self.assertEqual(worker_patch.call_args[0][0].concurrency, 4)
+
+    def test_lazy_imports(self):
+        # in a new process, the tests already imported everything here
+        code = (
+            "import sys, fpesa.cli;"
+            "fpesa.cli.get_argument_parser();"
+            "import fpesa.postgres, fpesa.message, fpesa.restapp;"
+            "import fpesa.liveupdate, fpesa.retention, fpesa.config;"
+            "print('pkg_resources' in sys.modules, fpesa.postgres._engine,"
+            " fpesa.config._config)")
+        output = subprocess.check_output(
+            [sys.executable, '-c', code], universal_newlines=True)
+        self.assertEqual("False None None\n", output)
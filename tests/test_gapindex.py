@@ -0,0 +1,93 @@
+import time
+import threading
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from fpesa.gapindex import GapIndex
+
+
+class TestGapIndex(TestCase):
+    def setUp(self):
+        self.index = GapIndex()
+        self.index.add([(3, 4)], 7)
+        self.index.add([(8, 8), (13, 20)], 25)
+        self.ids = [i for i in range(1, 26) if not 3 <= i <= 4 and
+                    i != 8 and not 13 <= i <= 20]
+        self.session = MagicMock()
+
+    def locate(self, min_id, pagination_id, offset):
+        return self.index.locate(self.session, min_id, pagination_id, offset)
+
+    def test_empty(self):
+        self.assertIsNone(GapIndex().locate(self.session, 1, 10, 0))
+
+    def test_offsets(self):
+        """ compare with the offsets of a list of all ids """
+        for pagination_id in range(1, 26):
+            ids = [i for i in reversed(self.ids) if i <= pagination_id]
+            for offset in range(len(ids) + 2):
+                expected = ids[offset] if offset < len(ids) else None
+                self.assertEqual(
+                    self.locate(1, pagination_id, offset),
+                    (len(ids), expected, 0),
+                    (pagination_id, offset))
+
+    def test_min_id(self):
+        """ old messages were removed """
+        self.assertEqual(self.locate(9, 25, 0), (9, 25, 0))
+        self.assertEqual(self.locate(9, 25, 6), (9, 11, 0))
+        self.assertEqual(self.locate(9, 25, 9), (9, None, 0))
+        self.assertEqual(self.locate(30, 25, 0), (0, None, 0))
+
+    def test_recent(self):
+        """ messages above the watermark are counted by the database """
+        count = self.session.query.return_value.filter.return_value.scalar
+        count.return_value = 3
+        self.assertEqual(self.locate(1, 30, 2), (17, 30, 2))
+        self.assertEqual(self.locate(1, 30, 3), (17, 25, 0))
+        self.assertEqual(self.locate(1, 30, 5), (17, 23, 0))
+
+    def test_empty_window(self):
+        """ a scan without messages moves the watermark to its end """
+        session = MagicMock()
+        holes = session.execute.return_value.fetchall
+        max_id = session.query.return_value.filter.return_value.scalar
+        holes.return_value, max_id.return_value = [], None
+        self.index._scan(session, 25, 40)
+        self.assertEqual(self.index.state[0], 40)
+        holes.return_value, max_id.return_value = [(41, 44)], 50
+        self.index._scan(session, 40, 50)
+        self.assertEqual(self.index.state[0], 50)
+        # the holes 26-40 and 41-44 are one
+        self.assertEqual(list(self.index.state[1]), [3, 8, 13, 26])
+        self.ids.extend(range(45, 51))
+        for pagination_id in (25, 30, 44, 45, 50):
+            ids = [i for i in reversed(self.ids) if i <= pagination_id]
+            for offset in range(len(ids) + 1):
+                expected = ids[offset] if offset < len(ids) else None
+                self.assertEqual(
+                    self.locate(1, pagination_id, offset),
+                    (len(ids), expected, 0),
+                    (pagination_id, offset))
+
+    def test_refresh_in_background(self):
+        """ the thread keeps refreshing after an error until stopped """
+        index = GapIndex(refresh_interval=0.01)
+        refreshed = threading.Event()
+        calls = []
+
+        def refresh(session):
+            calls.append(session)
+            if len(calls) == 1:
+                raise Exception('database gone')
+            refreshed.set()
+
+        with patch.object(index, 'refresh', side_effect=refresh), \
+                patch('fpesa.gapindex.Session'), \
+                self.assertLogs('fpesa.gapindex', 'ERROR'):
+            index.start(MagicMock())
+            self.assertTrue(refreshed.wait(1))
+            index.stop()
+        count = len(calls)
+        time.sleep(0.05)
+        self.assertEqual(len(calls), count)
@@ -1,11 +1,18 @@
+import zlib
+import json
 import asyncio
 from asyncio import sleep as asyncio_sleep
 from unittest import mock
 from unittest import TestCase
 
 from websockets.exceptions import ConnectionClosed
+import aio_pika
 
-from fpesa.liveupdate import liveupdate, consume_messages_from_bus
+from fpesa.liveupdate import liveupdate, consume_messages_from_bus, Frame
+from fpesa.liveupdate import ConnectionOptions, DEFAULT_OPTIONS
+from fpesa.liveupdate import ReplayBuffer, parse_options, LEGACY_QUEUE
+from fpesa.config import config
+from fpesa import membroker
 from common import install_test_config, RabbitMqTestCase
 
 install_test_config()
@@ -63,7 +70,8 @@ async def mock_sleep(duration):
 
 class WebsocketsTestCase(TestCase):
     @mock.patch('asyncio.sleep', new=mock_sleep)
-    def websocket_open_cb_close(self, cb=None, fake_websocket=None):
+    def websocket_open_cb_close(
+            self, cb=None, fake_websocket=None, path='/'):
         """
         if parameter cb is defined:
 
@@ -86,7 +94,7 @@ class WebsocketsTestCase(TestCase):
 
         with self.assertRaises(CloseException):
             asyncio.get_event_loop().run_until_complete(
-                liveupdate(websocket, '/'))
+                liveupdate(websocket, path))
             raise Exception()  # TODO: never called, remove me!
 
 
@@ -106,16 +114,226 @@ class TestLiveUpdateWebsockets(WebsocketsTestCase):
         self.websocket_open_cb_close(callback)
         self.assertEqual(len(connections), 0)
 
+    def test_websocket_batch(self):
+        """
+        see if batched messages are sent as one json array
+        """
+        from fpesa.liveupdate import batch_connections, _batch, flush_batch
+
+        async def callback():
+            self.assertEqual(len(batch_connections), 1)
+            _batch.extend([(1, '"a"'), (2, '{"b": 2}')])
+            await flush_batch()
+            await flush_batch()  # nothing to send
+
+        fake_websocket = FakeWebsocket([(2, callback)])
+        fake_websocket.send = AsyncMock()
+        self.websocket_open_cb_close(
+            fake_websocket=fake_websocket, path='/?batch=1')
+        self.assertEqual(len(batch_connections), 0)
+        self.assertEqual(fake_websocket.send.mock.call_count, 1)
+        self.assertEqual(
+            fake_websocket.send.mock.call_args[0][0], '["a",{"b": 2}]')
+
+
+class TestFrame(TestCase):
+    def test_compressed_once(self):
+        """ large frames are compressed, small ones are sent as text """
+        messages = [(i, '{"a": 1}') for i in range(1000)]
+        text = '[' + ','.join(m for i, m in messages) + ']'
+        frame = Frame(messages, batch=True)
+        options = ConnectionOptions(
+            batch=True, compress=True, ids=False, last_seen_id=None)
+        compressed = frame.get(options)
+        self.assertIs(compressed, frame.get(options))
+        self.assertEqual(zlib.decompress(compressed, -zlib.MAX_WBITS).decode(),
+                         text)
+        self.assertEqual(frame.get(), text)
+        self.assertEqual(Frame([(1, '{}')]).get(options), '{}')
+        self.assertEqual(Frame([(1, '{}')]).get(), b'{}')
+
+    def test_ids(self):
+        options = ConnectionOptions(
+            batch=False, compress=False, ids=True, last_seen_id=None)
+        self.assertEqual(
+            Frame([(7, '"x"')]).get(options), b'{"id": 7, "data": "x"}')
+
+
+class TestReplayBuffer(TestCase):
+    def test_since(self):
+        buffer = ReplayBuffer(3)
+        self.assertIsNone(buffer.since(1))
+        for i in range(5):
+            buffer.append(i * 2, str(i))
+        self.assertEqual(buffer.since(4), [(6, '3'), (8, '4')])
+        self.assertEqual(buffer.since(8), [])
+        # unknown or dropped message, client has to resync
+        self.assertIsNone(buffer.since(5))
+        self.assertIsNone(buffer.since(2))
+
+    def test_since_keeps_arrival_order(self):
+        """ ids from the database arrive in commit order """
+        buffer = ReplayBuffer(5)
+        for i in (3, 5, 4, 6):
+            buffer.append(i, str(i))
+        self.assertEqual(buffer.since(5), [(4, '4'), (6, '6')])
+
+    def test_parse_options(self):
+        self.assertEqual(
+            parse_options('/?batch=1&lastSeenId=12'),
+            ConnectionOptions(
+                batch=True, compress=False, ids=True, last_seen_id=12))
+        self.assertEqual(parse_options('/'), DEFAULT_OPTIONS)
+
+
+class TestBusMemory(TestCase):
+    """ consume_messages_from_bus with the membroker """
+    def setUp(self):
+        membroker._broker = None
+        patcher = mock.patch.dict(config['rabbitmq'], {'broker': 'memory'})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_legacy_queue_deleted(self):
+        """ the queue shared by older versions is deleted """
+        loop = asyncio.get_event_loop()
+
+        async def test():
+            broker = membroker.get_broker()
+            channel = await (await broker.connect()).channel()
+            exchange = await channel.declare_exchange('/messages/:POST')
+            queue = await channel.declare_queue(LEGACY_QUEUE, durable=True)
+            await queue.bind(exchange)
+            ready = asyncio.Event()
+            consumer = loop.create_task(consume_messages_from_bus(loop, ready))
+            await asyncio.wait_for(ready.wait(), 5)
+            self.assertNotIn(LEGACY_QUEUE, broker.queues)
+            # only the queue of this process
+            self.assertEqual(len(exchange.bindings), 1)
+            consumer.cancel()
+            await asyncio.wait([consumer])
+        loop.run_until_complete(test())
+
+
+    @mock.patch.dict(config['liveupdate'], {
+        'prefetch_count': '1', 'pipeline_size': '1', 'queue_max_length': '3'})
+    def test_slow_consumer(self):
+        """ the messages wait in the queue, which drops the oldest """
+        loop = asyncio.get_event_loop()
+
+        async def broadcast_messages(pending):
+            await asyncio_sleep(10)
+
+        async def test():
+            broker = membroker.get_broker()
+            channel = await (await broker.connect()).channel()
+            exchange = await channel.declare_exchange('/messages/:POST')
+            ready = asyncio.Event()
+            consumer = loop.create_task(consume_messages_from_bus(loop, ready))
+            await asyncio.wait_for(ready.wait(), 5)
+            for i in range(10):
+                await exchange.publish(
+                    aio_pika.Message('{{"data": {}}}'.format(i).encode()),
+                    routing_key='')
+                for j in range(3):
+                    await asyncio_sleep(0)
+            queue, = broker.queues.values()
+            # one message in the pipeline, one waits to be put there
+            self.assertEqual(
+                [json.loads(item[0].body.decode())['data']
+                 for item in queue.messages], [7, 8, 9])
+            consumer.cancel()
+            await asyncio.wait([consumer])
+        with mock.patch(
+                'fpesa.liveupdate.broadcast_messages',
+                new=broadcast_messages):
+            loop.run_until_complete(test())
+
+
+class TestBroadcast(TestCase):
+    def test_send_error_drops_connection(self):
+        """ a connection failing to send does not stop the others """
+        from fpesa.liveupdate import send_to_all
+
+        class Websocket():
+            def __init__(self, send):
+                self.send = send
+                self.close = AsyncMock()
+
+        async def broken_send(data):
+            raise ValueError('broken')
+
+        broken = Websocket(broken_send)
+        working = Websocket(AsyncMock())
+        websockets_ = [broken, working]
+
+        async def send():
+            await send_to_all(websockets_, Frame([(1, '"x"')]))
+            await asyncio_sleep(0)  # closing is scheduled
+
+        asyncio.get_event_loop().run_until_complete(send())
+        self.assertEqual(websockets_, [working])
+        self.assertEqual(working.send.mock.call_args[0][0], b'"x"')
+        self.assertEqual(broken.close.mock.call_count, 1)
+
+    def test_broadcaster_restarted(self):
+        """ the broadcaster is restarted if it fails """
+        from fpesa.liveupdate import start_broadcaster
+        loop = asyncio.get_event_loop()
+        runs = []
+
+        async def broadcast_messages(pending):
+            runs.append(pending)
+            if len(runs) == 1:
+                raise ValueError('broken')
+            await asyncio_sleep(10)
+
+        async def run():
+            with mock.patch(
+                    'fpesa.liveupdate.broadcast_messages',
+                    new=broadcast_messages):
+                broadcaster = start_broadcaster(loop, 'pending')
+                for i in range(3):
+                    await asyncio_sleep(0)
+                broadcaster.cancel()
+                await asyncio_sleep(0)
+
+        with self.assertLogs('fpesa.liveupdate', 'ERROR'):
+            loop.run_until_complete(run())
+        self.assertEqual(runs, ['pending', 'pending'])
+
+
+class TestNotifiedMessages(TestCase):
+    def test_gone_messages_skipped(self):
+        """ messages deleted before they were fetched are skipped """
+        from fpesa.liveupdate import _notified_messages
+        notified = [{'id': 1, 'message': 'a'}, {'id': 2}, {'id': 3}]
+        with self.assertLogs('fpesa.liveupdate', 'DEBUG'):
+            messages = list(_notified_messages(notified, {3: 'c'}))
+        self.assertEqual(
+            messages, [(1, '"a"', None), (3, '"c"', None)])
+
 
 class TestLiveUpdateMessages(WebsocketsTestCase, RabbitMqTestCase):
     def setup_channel(self):
+        # liveupdate declares its own queue
         channel = self.connection.channel()
-        channel.queue_declare(queue='liveupdate', durable=True)
         channel.exchange_declare(
             exchange='/messages/:POST', exchange_type='fanout')
-        channel.queue_bind(exchange='/messages/:POST', queue='liveupdate')
         self.channel = channel
 
+    def start_consumer(self):
+        loop = asyncio.get_event_loop()
+        ready = asyncio.Event()
+        consumer = loop.create_task(consume_messages_from_bus(loop, ready))
+        # messages published before the queue of liveupdate is bound are
+        # dropped by the exchange
+        loop.run_until_complete(asyncio.wait(
+            [consumer, loop.create_task(ready.wait())],
+            return_when=asyncio.FIRST_COMPLETED))
+        if consumer.done():
+            consumer.result()  # raises why it failed
+
     async def send_message_callback(self):
         self.channel.basic_publish(
             exchange='/messages/:POST',
@@ -129,9 +347,7 @@ class TestLiveUpdateMessages(WebsocketsTestCase, RabbitMqTestCase):
         see if websocket message is sent when message arrives on rabbitmq
         """
         self.setup_channel()
-
-        asyncio.get_event_loop().create_task(
-            consume_messages_from_bus(asyncio.get_event_loop()))
+        self.start_consumer()
 
         self.websocket_open_cb_close(self.send_message_callback)
 
@@ -145,8 +361,7 @@ class TestLiveUpdateMessages(WebsocketsTestCase, RabbitMqTestCase):
 
         # create worker to fetch messages from the message bus and forward them
         # to the websocket
-        asyncio.get_event_loop().create_task(
-            consume_messages_from_bus(asyncio.get_event_loop()))
+        self.start_consumer()
 
         # no websocket connections yet
         self.assertEqual(len(connections), 0)
@@ -0,0 +1,137 @@
+import asyncio
+from unittest import TestCase
+
+import aio_pika
+from aio_pika.exchange import ExchangeType
+
+from fpesa.membroker import Broker
+
+
+class TestMemBroker(TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.addCleanup(self.loop.close)
+        self.broker = Broker()
+
+    def run_async(self, coroutine):
+        return self.loop.run_until_complete(
+            asyncio.wait_for(coroutine, 5))
+
+    async def channel(self):
+        connection = await self.broker.connect()
+        return await connection.channel()
+
+    async def bodies(self, queue):
+        bodies = []
+        while True:
+            message = await queue.get(no_ack=True, fail=False)
+            if message is None:
+                return bodies
+            bodies.append(message.body)
+
+    def test_fanout(self):
+        async def test():
+            channel = await self.channel()
+            exchange = await channel.declare_exchange(
+                'fanout', type=ExchangeType.FANOUT)
+            queues = []
+            for name in ('a', 'b'):
+                queue = await channel.declare_queue(name)
+                await queue.bind(exchange)
+                queues.append(queue)
+            await exchange.publish(aio_pika.Message(b'1'), routing_key='')
+            for queue in queues:
+                self.assertEqual(await self.bodies(queue), [b'1'])
+        self.run_async(test())
+
+    def test_direct(self):
+        async def test():
+            channel = await self.channel()
+            exchange = await channel.declare_exchange(
+                'RPC', type=ExchangeType.DIRECT)
+            a = await channel.declare_queue(exclusive=True)
+            await a.bind('RPC')
+            b = await channel.declare_queue(exclusive=True)
+            await b.bind(exchange)
+            message = aio_pika.Message(b'1', correlation_id='c', type='end')
+            await exchange.publish(message, routing_key=a.name)
+            await exchange.publish(message, routing_key='nobody')
+            received = await a.get()
+            self.assertEqual(received.body, b'1')
+            self.assertEqual(received.correlation_id, 'c')
+            self.assertEqual(received.type, 'end')
+            self.assertEqual(received.routing_key, a.name)
+            self.assertEqual(await self.bodies(b), [])
+            with self.assertRaises(asyncio.QueueEmpty):
+                await a.get()
+        self.run_async(test())
+
+    def test_prefetch(self):
+        async def test():
+            channel = await self.channel()
+            channel.set_qos(prefetch_count=2)
+            exchange = await channel.declare_exchange('e')
+            queue = await channel.declare_queue('q')
+            await queue.bind(exchange)
+            for body in (b'1', b'2', b'3'):
+                await exchange.publish(aio_pika.Message(body), '')
+            iterator = queue.iterator()
+            received = [
+                await iterator.__anext__(), await iterator.__anext__()]
+            # the third message is held back until one is acknowledged
+            third = asyncio.ensure_future(iterator.__anext__())
+            await asyncio.sleep(0)
+            self.assertFalse(third.done())
+            with received[0].process():
+                pass
+            self.assertEqual((await third).body, b'3')
+            # unacknowledged messages are delivered again
+            await channel.close()
+            channel = await self.channel()
+            queue = await channel.declare_queue('q')
+            self.assertEqual(await self.bodies(queue), [b'2', b'3'])
+        self.run_async(test())
+
+    def test_process_error(self):
+        async def test():
+            channel = await self.channel()
+            exchange = await channel.declare_exchange('e')
+            queue = await channel.declare_queue('q')
+            await queue.bind(exchange)
+            await exchange.publish(aio_pika.Message(b'1'), '')
+            message = await queue.get()
+            with self.assertRaises(ValueError):
+                with message.process(requeue=True):
+                    raise ValueError()
+            self.assertEqual(await self.bodies(queue), [b'1'])
+        self.run_async(test())
+
+    def test_max_length(self):
+        async def test():
+            channel = await self.channel()
+            exchange = await channel.declare_exchange('e')
+            queue = await channel.declare_queue(arguments={
+                'x-max-length': 2, 'x-overflow': 'drop-head'})
+            await queue.bind(exchange)
+            for body in (b'1', b'2', b'3'):
+                await exchange.publish(aio_pika.Message(body), '')
+            self.assertEqual(await self.bodies(queue), [b'2', b'3'])
+        self.run_async(test())
+
+    def test_exclusive_deleted(self):
+        async def test():
+            channel = await self.channel()
+            exchange = await channel.declare_exchange('e')
+            queue = await channel.declare_queue(exclusive=True)
+            await queue.bind(exchange)
+            durable = await channel.declare_queue('durable', durable=True)
+            await durable.bind(exchange)
+            consumer = asyncio.ensure_future(queue.iterator().__anext__())
+            await asyncio.sleep(0)
+            await channel.close()
+            with self.assertRaises(StopAsyncIteration):
+                await consumer
+            self.assertEqual(list(self.broker.queues), ['durable'])
+            self.assertEqual(len(exchange.bindings), 1)
+        self.run_async(test())
@@ -0,0 +1,45 @@
+from unittest import TestCase
+from urllib.request import urlopen
+
+from fpesa import metrics
+
+
+class TestMetrics(TestCase):
+    def test_counter(self):
+        counter = metrics.Counter(
+            'test_requests_total', 'requests', ['path'])
+        counter.labels('/a').inc()
+        counter.labels('/a').inc(2)
+        counter.labels('/"b"').inc()
+        self.assertEqual(counter.expose(), [
+            '# HELP test_requests_total requests',
+            '# TYPE test_requests_total counter',
+            'test_requests_total{path="/\\"b\\""} 1',
+            'test_requests_total{path="/a"} 3',
+        ])
+
+    def test_histogram(self):
+        histogram = metrics.Histogram(
+            'test_duration_seconds', 'duration', buckets=(0.1, 1))
+        histogram.observe(0.1)
+        histogram.observe(0.5)
+        histogram.observe(2)
+        self.assertEqual(histogram.expose()[2:], [
+            'test_duration_seconds_bucket{le="0.1"} 1',
+            'test_duration_seconds_bucket{le="1"} 2',
+            'test_duration_seconds_bucket{le="+Inf"} 3',
+            'test_duration_seconds_sum 2.6',
+            'test_duration_seconds_count 3',
+        ])
+
+    def test_server(self):
+        gauge = metrics.Gauge('test_open', 'open things')
+        gauge.inc()
+        server = metrics.start_server(0)
+        try:
+            body = urlopen('http://127.0.0.1:{}/metrics'.format(
+                server.server_address[1])).read().decode()
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertIn('\ntest_open 1\n', body)
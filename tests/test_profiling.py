@@ -0,0 +1,69 @@
+import os
+import time
+import pstats
+import asyncio
+import tempfile
+import threading
+from unittest import TestCase, mock
+
+from fpesa import profiling
+from fpesa.cli import main
+
+
+def busy(stopped):
+    while not stopped.is_set():
+        sum(range(1000))
+
+
+class TestProfiling(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def test_sampler(self):
+        path = os.path.join(self.directory, 'stacks.txt')
+        stopped = threading.Event()
+        thread = threading.Thread(
+            target=busy, args=(stopped,), name='busy-thread')
+        thread.start()
+        sampler = profiling.Sampler(path, interval=0.001, write_interval=10)
+        sampler.start()
+        time.sleep(0.1)
+        sampler.stop()
+        stopped.set()
+        thread.join()
+        with open(path) as fo:
+            lines = fo.read().splitlines()
+        busy_lines = [
+            line for line in lines if line.startswith('busy-thread;')]
+        self.assertTrue(busy_lines, lines)
+        stack, count = busy_lines[0].rsplit(' ', 1)
+        self.assertIn('busy (test_profiling.py:', stack)
+        self.assertGreater(int(count), 0)
+
+    def test_slow_callbacks(self):
+        async def blocking():
+            time.sleep(0.05)
+
+        profiling.detect_slow_callbacks(0.02)
+        self.addCleanup(profiling.stop_detecting_slow_callbacks)
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        with self.assertLogs('fpesa.profiling', 'WARNING') as logs:
+            loop.run_until_complete(blocking())
+        self.assertIn('blocking()', logs.output[0])
+        self.assertIn('blocked the event loop for', logs.output[0])
+        profiling.stop_detecting_slow_callbacks()
+        with mock.patch.object(profiling.logger, 'warning') as warning:
+            loop.run_until_complete(blocking())
+        warning.assert_not_called()
+
+    @mock.patch('signal.signal')
+    @mock.patch('logging.basicConfig')
+    def test_cli_profile(self, config_patch, signal_patch):
+        path = os.path.join(self.directory, 'profile')
+        main(['fpesa', '--profile', path])
+        stats = pstats.Stats(path)
+        self.assertTrue(any(
+            function[2] == 'print_help' for function in stats.stats))
@@ -0,0 +1,39 @@
+from unittest import TestCase
+
+from sqlalchemy import create_engine, text
+
+from fpesa import querylog
+
+
+class TestQueryLog(TestCase):
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+
+    def test_statements_per_call(self):
+        querylog.instrument(self.engine, slow_query=0, explain_sample_rate=0)
+        histogram = querylog.STATEMENTS.labels('test_statements')
+        with self.engine.connect() as connection:
+            with querylog.track('test_statements') as call:
+                connection.execute(text('SELECT 1'))
+                connection.execute(text('SELECT 2'))
+            connection.execute(text('SELECT 3'))
+        self.assertEqual(call.statements, 2)
+        self.assertEqual(histogram.sum, 2)
+        self.assertEqual(
+            sum(querylog.STATEMENT_DURATION.labels('test_statements').counts),
+            2)
+
+    def test_slow_statement(self):
+        querylog.instrument(
+            self.engine, slow_query=1e-9, explain_sample_rate=1)
+        with self.engine.connect() as connection:
+            with self.assertLogs('fpesa.querylog', 'WARNING') as logs:
+                with querylog.track('test_slow'):
+                    result = connection.execute(
+                        text('SELECT :value'), {'value': 17}).scalar()
+        self.assertEqual(result, 17)
+        self.assertIn('slow statement in test_slow', logs.output[0])
+        self.assertIn('17', logs.output[0])
+        # sqlite knows no EXPLAIN (ANALYZE, BUFFERS), the statement is
+        # logged anyway
+        self.assertIn('explain failed', logs.output[0])
@@ -1,13 +1,17 @@
 import json
 import logging
+from unittest import mock
 
 from aiohttp.test_utils import AioHTTPTestCase, unittest_run_loop
 import aio_pika
 
 from fpesa.restmapper import get_app, Endpoint, FireAndForgetAdapter
-from fpesa.restmapper import RequestResponseAdapter
+from fpesa.restmapper import RequestResponseAdapter, LongPollAdapter
+from fpesa.restmapper import StreamingAdapter
 from fpesa import restapp
 from fpesa import rabbitmq
+from fpesa import membroker
+from fpesa.config import config
 
 from common import ClearRabbitMQ
 from common import install_test_config
@@ -47,10 +51,9 @@ class TestRestBridgeFF(AioHTTPTestCase, ClearRabbitMQ):
 
         message = await (await self.get_queue('/testing/:POST')).get()
 
-        self.assertEqual(
-            json.loads(message.body.decode()),
-            {'args': None, 'data': {'a': 2}}
-        )
+        envelope = json.loads(message.body.decode())
+        self.assertEqual(envelope.pop('trace')['stages'][0][0], 'restmapper')
+        self.assertEqual(envelope, {'args': None, 'data': {'a': 2}})
 
     @unittest_run_loop
     async def test_validation_error(self):
@@ -97,21 +100,26 @@ class TestRestBridgeRR(AioHTTPTestCase, ClearRabbitMQ):
             schema_req_args={'type': 'object', 'properties': {
                 'b': {'type': 'string'}}, 'additionalProperties': False})])
 
-    async def worker(self, return_error=False):
+    async def worker(self, return_error=False, code=None):
         """ dummy rpc worker that responses to RequestResponseAdapter """
         if return_error:
-            body = b'{"error": {"description": "errror"}}'
+            error = {'description': 'errror'}
+            if code is not None:
+                error['code'] = code
+            body = json.dumps({'error': error}).encode()
         else:
             body = b'{"this is": "a response"}'
         connection = await rabbitmq.get_aio_connection(self.loop)
         async with connection:
             channel = await connection.channel()
             queue = await channel.declare_queue("/testing/:GET")
-            message = await queue.get()
+            async with queue.iterator() as q:
+                async for message in q:
+                    break
             with message.process():
-                self.assertEqual(
-                    json.loads(message.body.decode()),
-                    {'args': {'b': 'c'}, 'data': None})
+                envelope = json.loads(message.body.decode())
+                envelope.pop('trace')
+                self.assertEqual(envelope, {'args': {'b': 'c'}, 'data': None})
                 response_exchange = await channel.declare_exchange(
                     'RPC',
                     type=aio_pika.exchange.ExchangeType.DIRECT)
@@ -161,6 +169,166 @@ class TestRestBridgeRR(AioHTTPTestCase, ClearRabbitMQ):
             "GET", "/testing/", params={'b': 'c'})
         self.assertEqual(response.status, 500)
 
+    @unittest_run_loop
+    async def test_rr_client_error_status_code(self):
+        """ the error code of the worker is used if known """
+        self.loop.create_task(self.worker(return_error=True, code=400))
+        response = await self.client.request(
+            "GET", "/testing/", params={'b': 'c'})
+        self.assertEqual(response.status, 400)
+        self.assertEqual(
+            await response.json(),
+            {'error': {'code': 400, 'description': 'errror'}})
+
+
+class TestRestBridgeLongPoll(AioHTTPTestCase, ClearRabbitMQ):
+    def setUp(self):
+        ClearRabbitMQ.setUp(self)
+        super().setUp()
+
+    async def get_application(self):
+        # used by AioHTTPTestCase to construct self.client
+        return get_app([Endpoint(
+            '/testing/', 'GET',
+            LongPollAdapter(
+                '/testing/:POST', is_empty=lambda r: not r['items'],
+                notify_delay=0),
+            schema_req_args={'type': 'object', 'properties': {
+                'wait': {'type': 'string'}}, 'additionalProperties': False})])
+
+    async def worker(self, responses):
+        """ dummy rpc worker, answers with the given responses in order """
+        connection = await rabbitmq.get_aio_connection(self.loop)
+        async with connection:
+            channel = await connection.channel()
+            queue = await channel.declare_queue("/testing/:GET")
+            response_exchange = await channel.declare_exchange(
+                'RPC', type=aio_pika.exchange.ExchangeType.DIRECT)
+            notify_exchange = await channel.declare_exchange(
+                '/testing/:POST', type=aio_pika.exchange.ExchangeType.FANOUT)
+            for items in responses:
+                async with queue.iterator() as q:
+                    async for message in q:
+                        with message.process():
+                            await response_exchange.publish(
+                                aio_pika.Message(
+                                    json.dumps({'items': items}).encode(),
+                                    correlation_id=message.correlation_id,
+                                ),
+                                routing_key=message.reply_to
+                            )
+                        break
+                if not items:
+                    # new data arrived
+                    await notify_exchange.publish(
+                        aio_pika.Message(b'{}'), routing_key='')
+            await channel.close()
+
+    @unittest_run_loop
+    async def test_wait_for_notification(self):
+        """ empty response is held back until notified """
+        self.loop.create_task(self.worker([[], [1]]))
+        response = await self.client.request(
+            "GET", "/testing/", params={'wait': '10'})
+        self.assertEqual(response.status, 200, await response.json())
+        self.assertEqual(await response.json(), {'items': [1]})
+
+
+class TestRestBridgeStreaming(AioHTTPTestCase, ClearRabbitMQ):
+    def setUp(self):
+        ClearRabbitMQ.setUp(self)
+        super().setUp()
+
+    async def get_application(self):
+        # used by AioHTTPTestCase to construct self.client
+        return get_app([
+            Endpoint('/testing/', 'GET', StreamingAdapter(timeout=1))])
+
+    async def worker(self, chunks, end):
+        """ dummy streaming worker, answers with the chunks """
+        connection = await rabbitmq.get_aio_connection(self.loop)
+        async with connection:
+            channel = await connection.channel()
+            queue = await channel.declare_queue("/testing/:GET")
+            response_exchange = await channel.declare_exchange(
+                'RPC', type=aio_pika.exchange.ExchangeType.DIRECT)
+            responses = [(chunk, 'chunk') for chunk in chunks]
+            responses.append((end, 'end'))
+            async with queue.iterator() as q:
+                async for message in q:
+                    with message.process():
+                        for body, message_type in responses:
+                            await response_exchange.publish(
+                                aio_pika.Message(
+                                    body, type=message_type,
+                                    correlation_id=message.correlation_id,
+                                ),
+                                routing_key=message.reply_to
+                            )
+                    break
+            await channel.close()
+
+    @unittest_run_loop
+    async def test_stream(self):
+        self.loop.create_task(
+            self.worker([b'{"a": 1}\n', b'{"a": 2}\n'], b'{}'))
+        response = await self.client.request("GET", "/testing/")
+        self.assertEqual(response.status, 200)
+        self.assertEqual(
+            response.headers['Content-Type'], 'application/x-ndjson')
+        self.assertEqual(await response.text(), '{"a": 1}\n{"a": 2}\n')
+
+    @unittest_run_loop
+    async def test_error_before_first_chunk(self):
+        self.loop.create_task(self.worker(
+            [], b'{"error": {"code": 500, "description": "broken"}}'))
+        response = await self.client.request("GET", "/testing/")
+        self.assertEqual(response.status, 500)
+        self.assertEqual(
+            (await response.json())['error']['description'], 'broken')
+
+    async def stalled_worker(self, cancelled):
+        """ sends one chunk, then waits for the cancel of the request """
+        connection = await rabbitmq.get_aio_connection(self.loop)
+        async with connection:
+            channel = await connection.channel()
+            cancel_queue = await channel.declare_queue(exclusive=True)
+            await cancel_queue.bind(await channel.declare_exchange(
+                'RPC:cancel', type=aio_pika.exchange.ExchangeType.FANOUT))
+            queue = await channel.declare_queue("/testing/:GET")
+            response_exchange = await channel.declare_exchange(
+                'RPC', type=aio_pika.exchange.ExchangeType.DIRECT)
+            async with queue.iterator() as q:
+                async for message in q:
+                    with message.process():
+                        await response_exchange.publish(
+                            aio_pika.Message(
+                                b'{"a": 1}\n', type='chunk',
+                                correlation_id=message.correlation_id,
+                            ),
+                            routing_key=message.reply_to
+                        )
+                    break
+            async with cancel_queue.iterator(no_ack=True) as q:
+                async for cancel in q:
+                    cancelled.set_result(
+                        (message.correlation_id, cancel.correlation_id))
+                    break
+            await channel.close()
+
+    @unittest_run_loop
+    async def test_timeout(self):
+        cancelled = self.loop.create_future()
+        self.loop.create_task(self.stalled_worker(cancelled))
+        response = await self.client.request("GET", "/testing/")
+        self.assertEqual(response.status, 200)
+        lines = (await response.text()).splitlines()
+        self.assertEqual(lines[0], '{"a": 1}')
+        self.assertEqual(json.loads(lines[1])['error']['code'], 504)
+        correlation_id, cancel_id = await cancelled
+        self.assertIsInstance(correlation_id, str)
+        self.assertEqual(cancel_id, correlation_id)
+
 
 # TODO: test generic exception and make sure they return a valid json!
 
@@ -242,3 +410,29 @@ class TestRestApp(AioHTTPTestCase, ClearRabbitMQ):
         self.assertIn(
             "'zzz' does not match '^[0-9]+$'",
             error['description'])
+
+
+class MemoryBroker():
+    """ run the tests of a rest bridge test case without rabbitmq """
+    def setUp(self):
+        membroker._broker = None
+        patcher = mock.patch.dict(config['rabbitmq'], {'broker': 'memory'})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        AioHTTPTestCase.setUp(self)
+
+
+class TestRestBridgeFFMemory(MemoryBroker, TestRestBridgeFF):
+    pass
+
+
+class TestRestBridgeRRMemory(MemoryBroker, TestRestBridgeRR):
+    pass
+
+
+class TestRestBridgeLongPollMemory(MemoryBroker, TestRestBridgeLongPoll):
+    pass
+
+
+class TestRestBridgeStreamingMemory(MemoryBroker, TestRestBridgeStreaming):
+    pass
@@ -0,0 +1,136 @@
+import gzip
+import json
+import os
+import tempfile
+from unittest import TestCase
+
+from fpesa.postgres import Session, create_all
+from fpesa.config import config
+from fpesa.helper import get_engine, get_connection
+from fpesa import archive
+from fpesa import message
+from fpesa import retention
+
+from common import install_test_config
+from test_message import cursor
+
+
+install_test_config()
+Session.configure(bind=get_engine())  # now with test config
+
+
+class TestRetention(TestCase):
+    def setUp(self):
+        with cursor() as c:
+            c.execute(
+                'select tablename from pg_tables where schemaname=\'public\'')
+            tables = [row['tablename'] for row in c]
+            for table in tables:
+                c.execute('drop table {} cascade;'.format(table))
+
+    def test_max_rows(self):
+        """ keep the newest messages, export the others """
+        create_all()
+        for i in range(25):
+            message.message_post({'a': i})
+        with tempfile.TemporaryDirectory() as directory:
+            result = retention.retention(
+                max_rows=10, batch_size=4, sleep=0,
+                export_directory=directory, segment_size=10)
+            self.assertEqual(result['rows'], 15)
+            self.assertGreater(result['bytes'], 0)
+            self.assertEqual(
+                sorted(os.listdir(directory)),
+                ['messages-1-10.idx', 'messages-1-10.ndjson.gz',
+                 'messages-11-15.idx', 'messages-11-15.ndjson.gz'])
+            path = os.path.join(directory, 'messages-11-15.ndjson.gz')
+            with gzip.open(path, 'rt') as fo:
+                lines = [json.loads(line) for line in fo]
+            path = os.path.join(directory, 'messages-11-15.idx')
+            with open(path, 'rb') as fo:
+                index = list(archive.RECORD.iter_unpack(fo.read()))
+        # one gzip member for all five messages
+        self.assertEqual(
+            [message_id for message_id, offset in index], list(range(11, 16)))
+        self.assertEqual(len({offset for message_id, offset in index}), 1)
+        self.assertEqual(
+            [line['message'] for line in lines],
+            [{'a': i} for i in range(10, 15)])
+        result = message.message_get({'offset': 0, 'limit': 100})
+        self.assertEqual(result['total'], 10)
+
+    def test_archive(self):
+        """ removed messages are read from the archive """
+        create_all()
+        for i in range(25):
+            message.message_post({'a': i, 'b': i})
+        with tempfile.TemporaryDirectory() as directory:
+            retention.retention(
+                max_rows=10, sleep=0, export_directory=directory,
+                segment_size=10)
+            config.set('archive', 'directory', directory)
+            try:
+                result = message.message_get(
+                    {'paginationId': '20', 'offset': 8, 'limit': 4,
+                     'fields': 'a'})
+            finally:
+                config.set('archive', 'directory', '')
+        self.assertEqual(result['total'], 20)
+        self.assertEqual(
+            result['messages'], [{'a': 11}, {'a': 10}, {'a': 9}, {'a': 8}])
+
+    def test_max_age(self):
+        """ nothing is old enough """
+        create_all()
+        message.message_post({'a': 1})
+        result = retention.retention(max_age=1)
+        self.assertEqual(result, {'rows': 0, 'bytes': 0})
+
+    def test_partitioned(self):
+        """ drop whole partitions """
+        config.set('postgres', 'partition_size', '10')
+        try:
+            create_all()
+            for i in range(25):
+                message.message_post({'a': i})
+        finally:
+            config.set('postgres', 'partition_size', '0')
+            message._partitions_end = None
+        result = retention.retention(max_rows=3, sleep=0)
+        self.assertEqual(result['rows'], 22)
+        with cursor() as c:
+            c.execute("SELECT to_regclass('message_p1')")
+            self.assertIsNone(c.fetchone()[0])
+        result = message.message_get({'offset': 0, 'limit': 100})
+        self.assertEqual(
+            result['messages'], [{'a': 24}, {'a': 23}, {'a': 22}])
+
+    def test_partition_locked(self):
+        """ a partition that can not be dropped is exported only once """
+        config.set('postgres', 'partition_size', '10')
+        try:
+            create_all()
+            for i in range(25):
+                message.message_post({'a': i})
+        finally:
+            config.set('postgres', 'partition_size', '0')
+            message._partitions_end = None
+        # a running query keeps the partitions from being detached
+        connection = get_connection()
+        try:
+            with connection.cursor() as c:
+                c.execute('SELECT count(*) FROM message')
+            with tempfile.TemporaryDirectory() as directory:
+                result = retention.retention(
+                    max_rows=3, sleep=0, export_directory=directory)
+                ids = []
+                for name in sorted(os.listdir(directory)):
+                    if not archive.SEGMENT_RE.match(name):
+                        continue  # the index files
+                    path = os.path.join(directory, name)
+                    with gzip.open(path, 'rt') as fo:
+                        ids.extend(json.loads(line)['id'] for line in fo)
+        finally:
+            connection.close()
+        self.assertEqual(result['rows'], 22)
+        self.assertEqual(ids, list(range(1, 23)))
@@ -0,0 +1,39 @@
+import json
+from unittest import TestCase, mock
+
+from fpesa import tracing
+from fpesa.config import config
+from fpesa.liveupdate import decode_message
+
+
+class TestTracing(TestCase):
+    def test_stages(self):
+        trace = tracing.start('restmapper')
+        tracing.stage(trace, 'messages_post')
+        tracing.stage(trace, 'committed')
+        self.assertEqual(
+            [name for name, _ in trace['stages']],
+            ['restmapper', 'messages_post', 'committed'])
+        self.assertIsNone(tracing.stage(None, 'committed'))
+        count = tracing.STAGE_SECONDS.labels('committed').counts
+        self.assertGreaterEqual(sum(count), 1)
+
+    def test_sampled(self):
+        trace = tracing.start('restmapper')
+        with mock.patch.dict(config['tracing'], {'sample_rate': '1'}), \
+                self.assertLogs('fpesa.tracing') as logs:
+            tracing.stage(trace, 'delivered', last=True)
+        logged = json.loads(logs.records[0].getMessage())
+        self.assertEqual(logged['trace'], trace['id'])
+        self.assertEqual(
+            [name for name, _ in logged['stages']],
+            ['restmapper', 'delivered'])
+
+    def test_decode_message(self):
+        trace = tracing.start('restmapper')
+        body = json.dumps({'data': {'a': 1}, 'trace': trace}).encode()
+        payload, decoded = decode_message(body)
+        self.assertEqual(json.loads(payload), {'a': 1})
+        self.assertEqual(decoded['stages'][-1][0], 'liveupdate')
+        payload, decoded = decode_message(b'{"data": {}}')
+        self.assertIsNone(decoded)